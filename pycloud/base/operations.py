@@ -1,9 +1,11 @@
 from ..core.cloud import BaseOperation
+from ..core.net import SSHConnectionPool
 
 class SimpleOperation(BaseOperation):
     required_options = ('hosts', 'tasks')
 
     def run(self):
-        for task in self.options['tasks']:
-            task.run(self.options['hosts'])
+        with SSHConnectionPool() as pool:
+            for task in self.options['tasks']:
+                task.run(self.options['hosts'], connection_pool=pool)
 
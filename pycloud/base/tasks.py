@@ -7,6 +7,10 @@ class BashTask(BaseTask):
         result = client.execute(self.options['command'])
         return self.parse_results(*result)
 
+    async def async_shell(self, client):
+        result = await client.execute(self.options['command'])
+        return self.parse_results(*result)
+
     def parse_results(self, exit_code, out, err):
         if exit_code:
             return err
@@ -3,12 +3,19 @@
 from quickconfig import Configuration
 from pycloud.minicloud.utils import new_cloud, path_exists
 from pycloud.minicloud.cloud import LocalCloud
-from pycloud.core.cloud import Host
+from pycloud.core.cloud import Host, TaskShellHandler
 from pycloud.core.utils import dumb_argparse
-from pycloud.core.net import SSHGroup
+from pycloud.core.net import SSHGroup, SSHGroupResult, SSHResult, SSHConnectionPool, Rollout
+from pycloud.core.timing import TimingSummary
+from pycloud.core.concurrency import AdaptiveConcurrency, Limit
+from pycloud.core.asyncnet import AsyncSSHGroup
+from pycloud.core.daemon import DaemonClient, DEFAULT_SOCKET
+from pycloud.core.capture import MemoryCapture
+from pycloud.core.export import get_writer
 from pycloud.core.security import *
 from pycloud.core import policies
 import argparse
+import collections
 import getpass
 import shlex
 import sys
@@ -19,6 +26,47 @@ class CLIHandler():
         '~/.pycloud.yaml',
         'config.yaml'
     ]
+    ROLLOUT_ARGS = [
+        (('--batch-size'), {'default': None, 'help': 'Hosts per batch, count or percentage'}),
+        (('--canary'), {'default': 0, 'help': 'Hosts in a first batch that must succeed'}),
+        (('--max-failures'), {'type': float, 'default': None, 'help': 'Ratio of failed hosts that stops the rollout'}),
+        (('--batch-pause'), {'type': float, 'default': 0, 'help': 'Seconds between batches'}),
+    ]
+    TIMEOUT_ARGS = [
+        (('--connect-timeout'), {'type': float, 'default': None, 'help': 'Seconds to connect to each host'}),
+        (('--command-timeout'), {'type': float, 'default': None, 'help': 'Seconds each command may run'}),
+        (('--deadline'), {'type': float, 'default': None, 'help': 'Seconds the whole run may take'}),
+        (('--quorum'), {'type': float, 'default': None, 'help': 'Return once this ratio of hosts is done'}),
+    ]
+    DAEMON_ARGS = [
+        (('--daemon'), {'dest': 'use_daemon', 'action': 'store_true', 'default': False,
+                        'help': 'Run through the connection daemon (see the daemon command)'}),
+    ]
+    DISPLAY_ARGS = [
+        (('-b', '--group'), {'dest': 'grouped', 'action': 'store_true', 'default': False,
+                             'help': 'Print each distinct output once with the hosts that returned it'}),
+    ]
+    FORMAT_ARGS = [
+        (('--format'), {'dest': 'output_format', 'choices': ['text', 'jsonl', 'csv'], 'default': 'text',
+                        'help': 'Write a row per host to stdout as each one finishes'}),
+    ]
+    TIMING_ARGS = [
+        (('--timings'), {'dest': 'show_timings', 'action': 'store_true', 'default': False,
+                         'help': 'Summarize where the time went: p50/p95/p99 per phase and the slowest hosts'}),
+    ]
+    HEALTH_ARGS = [
+        (('--include-unhealthy'), {'action': 'store_true', 'default': False,
+                                   'help': 'Also try hosts that recently failed to connect'}),
+        (('--retries'), {'type': int, 'default': 0, 'help': 'Times to retry a failed connect, with backoff'}),
+    ]
+    POOL_ARGS = [
+        (('--pool-size'), {'type': int, 'default': 10, 'help': 'Hosts worked on at once, the most with --adaptive'}),
+        (('--adaptive'), {'action': 'store_true', 'default': False,
+                          'help': 'Grow the pool while handshakes stay fast, shrink it on resets and timeouts'}),
+        (('--min-pool-size'), {'type': int, 'default': 2, 'help': 'Smallest pool with --adaptive'}),
+        (('--max-per'), {'action': 'append', 'default': None, 'metavar': 'KEY[=VALUE]:N',
+                         'help': 'Hosts at once per env, tag or attribute, e.g. env=prod:2, tags=database:1 or rack:1'}),
+    ]
     COMMANDS = {
         # command name, function
         'encrypt': {
@@ -46,7 +94,17 @@ class CLIHandler():
                 (('-n','--name'), {}),
                 (('-e','--env'), {}),
                 (('-t','--tags'), {'nargs': '*'}),
+                (('-q','--query'), {'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
                 (('--summary'), {'action': 'store_true', 'default': False})
+            ] + DISPLAY_ARGS + POOL_ARGS + DAEMON_ARGS
+        },
+        'daemon': {
+            'func': 'daemon',
+            'cloud': False,
+            'args': [
+                ('action', {'choices': ['start', 'stop', 'status']}),
+                (('--socket'), {'default': DEFAULT_SOCKET}),
+                (('--idle-timeout'), {'type': float, 'default': 600, 'help': 'Seconds before unused connections close'}),
             ]
         },
         'enforce': {
@@ -56,8 +114,9 @@ class CLIHandler():
                 (('-n','--name'), {}),
                 (('-e','--env'), {}),
                 (('-t','--tags'), {'nargs': '*'}),
+                (('-q','--query'), {'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
                 ('--summary', {'action': 'store_true', 'default': False})
-            ]
+            ] + DISPLAY_ARGS + FORMAT_ARGS + TIMING_ARGS + POOL_ARGS + HEALTH_ARGS + DAEMON_ARGS
         },
         'create_task': {
             'func': 'create_task',
@@ -74,7 +133,8 @@ class CLIHandler():
                 (('-n','--name'), {}),
                 (('-e','--env'), {}),
                 (('-t','--tags'), {'nargs': '*'}),
-            ]
+                (('-q','--query'), {'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
+            ] + DISPLAY_ARGS + FORMAT_ARGS + TIMING_ARGS + ROLLOUT_ARGS + TIMEOUT_ARGS + POOL_ARGS + HEALTH_ARGS + DAEMON_ARGS
         },
         'operation': {
             'func': 'operation',
@@ -83,6 +143,7 @@ class CLIHandler():
                 (('-n','--name'), {}),
                 (('-e','--env'), {}),
                 (('-t','--tags'), {'nargs': '*'}),
+                (('-q','--query'), {'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
             ]
         },
         'ssh': {
@@ -92,8 +153,58 @@ class CLIHandler():
                 (('-n','--name'), {}),
                 (('-e','--env'), {}),
                 (('-t','--tags'), {'nargs': '*'}),
-                (('--summary'), {'action': 'store_true', 'default': False})
-            ]
+                (('-q','--query'), {'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
+                (('--summary'), {'action': 'store_true', 'default': False}),
+                (('--async'), {'dest': 'use_async', 'action': 'store_true', 'default': False}),
+                (('--concurrency'), {'type': int, 'default': 200, 'help': 'Hosts in flight with --async'}),
+                (('--processes'), {'type': int, 'default': None, 'help': 'Shard hosts across worker processes'}),
+            ] + DISPLAY_ARGS + FORMAT_ARGS + TIMING_ARGS + ROLLOUT_ARGS + TIMEOUT_ARGS + POOL_ARGS + HEALTH_ARGS + DAEMON_ARGS
+        },
+        'push': {
+            'func': 'push',
+            'args': [
+                ('local_path', {'help': 'Local file or directory'}),
+                ('remote_path', {'help': 'Remote path'}),
+                (('-n','--name'), {}),
+                (('-e','--env'), {}),
+                (('-t','--tags'), {'nargs': '*'}),
+                (('-q','--query'), {'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
+                (('--check'), {'choices': ['mtime', 'hash', 'none'], 'default': 'mtime', 'help': 'How to detect unchanged files'}),
+                (('--limit'), {'default': None, 'help': 'Bandwidth cap for the whole push, e.g. 500K or 20M bytes/s'}),
+                (('--summary'), {'action': 'store_true', 'default': False}),
+            ] + DISPLAY_ARGS + TIMING_ARGS + ROLLOUT_ARGS + TIMEOUT_ARGS + POOL_ARGS + HEALTH_ARGS
+        },
+        'distribute': {
+            'func': 'distribute',
+            'args': [
+                ('local_path', {'help': 'Local file'}),
+                ('remote_path', {'help': 'Remote path'}),
+                (('-n','--name'), {}),
+                (('-e','--env'), {}),
+                (('-t','--tags'), {'nargs': '*'}),
+                (('-q','--query'), {'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
+                (('--fanout'), {'type': int, 'default': 3, 'help': 'Hosts each host relays the file to'}),
+                (('--no-agent-forwarding'), {'dest': 'forward_agent', 'action': 'store_false', 'default': True}),
+                (('--summary'), {'action': 'store_true', 'default': False}),
+            ] + TIMEOUT_ARGS[:2] + DISPLAY_ARGS + TIMING_ARGS
+        },
+        'pull': {
+            'func': 'pull',
+            'args': [
+                ('remote_path', {'help': 'Remote path, may contain wildcards'}),
+                ('local_dir', {'help': 'Local directory, files land in <local_dir>/<host>/'}),
+                (('-n','--name'), {}),
+                (('-e','--env'), {}),
+                (('-t','--tags'), {'nargs': '*'}),
+                (('-q','--query'), {'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
+                (('--gzip'), {'dest': 'compress', 'action': 'store_true', 'default': False, 'help': 'Compress local copies'}),
+                (('--tail'), {'default': None, 'help': 'Only fetch the last bytes of each file, e.g. 10M'}),
+                (('--offset'), {'default': None, 'help': 'Start fetching at this byte'}),
+                (('--length'), {'default': None, 'help': 'Fetch at most this many bytes'}),
+                (('--max-transfers'), {'type': int, 'default': None, 'help': 'Files in flight across all hosts'}),
+                (('--limit'), {'default': None, 'help': 'Bandwidth cap for the whole pull, e.g. 500K or 20M bytes/s'}),
+                (('--summary'), {'action': 'store_true', 'default': False}),
+            ] + DISPLAY_ARGS + TIMING_ARGS + ROLLOUT_ARGS + TIMEOUT_ARGS + POOL_ARGS + HEALTH_ARGS
         },
         'register': {
             'func': 'register',
@@ -105,13 +216,20 @@ class CLIHandler():
                 (('-u','--user'), {}),
                 (('-p','--password'), {}),
                 (('-P','--ask-for-pass'), {'dest': 'ask_for_pass', 'action': 'store_true', 'default': False}),
+                (('--port'), {'type': int, 'default': 22}),
+                (('--via'), {'help': 'Name of a registered host to connect through'}),
             ]
         },
         'hosts': {
             'func': 'hosts',
+            'args': [
+                ('query', {'nargs': '?', 'default': None, 'help': 'e.g. "tag=ubuntu and env!=prod or name~web*"'}),
+            ]
         }
     }
 
+    DAEMON_SOCKET = DEFAULT_SOCKET
+
     def __init__(self):
         self.cloud = None
 
@@ -193,12 +311,136 @@ class CLIHandler():
         print(self.cloud)
         print('{} hosts found'.format(len(self.cloud.hosts)))
 
-    def hosts(self):
-        for host in self.cloud.hosts:
+    def hosts(self, query=None):
+        hosts = self.cloud.hosts if query is None else self.cloud.query(query)
+        for host in hosts:
             print(host)
 
-    def ssh(self, ssh_command=None, name=None, tags=None, env=None, summary=False):
-        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env})
+    def _arg_defaults(self, args):
+        """ Each option's default, by its dest """
+        defaults = {}
+        for names, options in args:
+            if isinstance(names, str):
+                names = [names]
+            dest = options.get('dest', names[-1].lstrip('-').replace('-', '_'))
+            defaults[dest] = options.get('default')
+        return defaults
+
+    def _group_options(self, batch_size=None, canary=0, max_failures=None, batch_pause=0, pool_size=10, adaptive=False,
+                       min_pool_size=2, max_per=None, **options):
+        options = dict(options)
+        options['max_pool_size'] = pool_size
+        if max_per:
+            options['limits'] = self._parse_limits(max_per)
+        if adaptive:
+            options['adaptive'] = AdaptiveConcurrency(floor=min(min_pool_size, pool_size), ceiling=pool_size)
+        if batch_size or canary or max_failures is not None:
+            options['rollout'] = Rollout(batch_size=batch_size or '100%', canary=canary, max_failure_ratio=max_failures, pause=batch_pause)
+        options.setdefault('health', self.cloud.health)
+        return options
+
+    def ssh(self, ssh_command=None, name=None, tags=None, env=None, query=None, summary=False, use_async=False, concurrency=200,
+            processes=None, use_daemon=False, grouped=False, output_format='text', show_timings=False, **group_options):
+        log = sys.stdout if output_format == 'text' else sys.stderr
+        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env, 'query': query})
+        if not hosts:
+            print('No hosts found!', file=log)
+            return False
+        else:
+            print('Found these hosts:', file=log)
+            for host in hosts:
+                print('\t', host, file=log)
+
+        ssh_commands = ssh_command.split(';')
+        show_stdout = True
+        show_stderr = not summary
+        if use_async:
+            async_options = ['connect_timeout', 'command_timeout']
+            defaults = self._arg_defaults(self.ROLLOUT_ARGS + self.TIMEOUT_ARGS + self.POOL_ARGS + self.HEALTH_ARGS)
+            unsupported = ['--' + name.replace('_', '-') for name, default in defaults.items()
+                           if name not in async_options and group_options.get(name, default) != default]
+            if processes:
+                unsupported.append('--processes')
+            if use_daemon:
+                unsupported.append('--daemon')
+            if unsupported:
+                print('--async does not support:', ', '.join(unsupported), file=log)
+                return False
+            group = AsyncSSHGroup(hosts, max_concurrency=concurrency,
+                                  **{name: group_options[name] for name in async_options})
+            results = group.run_commands(ssh_commands)
+            self._print_results(results, output_format, show_timings, show_stderr=show_stderr, show_stdout=show_stdout,
+                                grouped=grouped)
+            return
+        if processes:
+            group = SSHGroup(hosts, processes=processes, **self._group_options(**group_options))
+            results = group.run_commands(ssh_commands)
+            self._print_results(results, output_format, show_timings, show_stderr=show_stderr, show_stdout=show_stdout,
+                                grouped=grouped)
+            return
+
+        daemon = self._daemon(use_daemon)
+        if output_format != 'text':
+            options = self._group_options(capture=MemoryCapture, **group_options)
+            if daemon is not None:
+                events = daemon.stream_commands(hosts, ssh_commands, **options)
+            else:
+                events = SSHGroup(hosts, **options).stream_commands(ssh_commands)
+            self._export(events, output_format, show_timings)
+            return
+        if grouped:
+            # Output can only be grouped once every host is done
+            if daemon is not None:
+                results = daemon.run_commands(hosts, ssh_commands, **self._group_options(**group_options))
+            else:
+                group = SSHGroup(hosts, **self._group_options(**group_options))
+                results = group.run_commands(ssh_commands)
+            self._print_results(results, output_format, show_timings, show_stderr=show_stderr, show_stdout=show_stdout,
+                                grouped=True)
+            return
+        options = self._group_options(**group_options)
+        if daemon is not None:
+            events = daemon.stream_commands(hosts, ssh_commands, **options)
+        else:
+            events = SSHGroup(hosts, **options).stream_commands(ssh_commands)
+        results = self._stream(events, show_stdout=show_stdout, show_stderr=show_stderr)
+        if daemon is None and 'adaptive' in options:
+            results.concurrency = list(options['adaptive'].history)
+        self._print_results(results, output_format, show_timings)
+
+    def _daemon(self, use_daemon):
+        """ A client for the connection daemon, if asked for and running """
+        if not use_daemon:
+            return None
+        daemon = DaemonClient(self.DAEMON_SOCKET)
+        if not daemon.available():
+            print('Connection daemon is not running, connecting directly. Start it with: minicloud.py daemon start')
+            return None
+        return daemon
+
+    def daemon(self, action=None, socket=DEFAULT_SOCKET, idle_timeout=600):
+        """ Start, stop or check the daemon that keeps connections open """
+        daemon = DaemonClient(socket)
+        if action == 'start':
+            if daemon.start(idle_timeout=idle_timeout):
+                print('Connection daemon running:', daemon.status())
+            else:
+                print('Connection daemon failed to start')
+        elif action == 'stop':
+            if daemon.stop():
+                print('Connection daemon stopped')
+            else:
+                print('Connection daemon is not running')
+        else:
+            status = daemon.status()
+            if status is None:
+                print('Connection daemon is not running')
+            else:
+                print('Connection daemon running: pid {pid}, {connections} open connections'.format(**status))
+
+    def push(self, local_path=None, remote_path=None, name=None, tags=None, env=None, query=None, check='mtime', limit=None,
+             summary=False, grouped=False, show_timings=False, **group_options):
+        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env, 'query': query})
         if not hosts:
             print('No hosts found!')
             return False
@@ -207,16 +449,31 @@ class CLIHandler():
             for host in hosts:
                 print('\t', host)
 
-        group = SSHGroup(hosts, max_pool_size=10)
-        ssh_commands = ssh_command.split(';')
-        results = group.run_commands(ssh_commands)
+        if check == 'none':
+            check = None
+        group = SSHGroup(hosts, **self._group_options(**group_options))
+        results = group.push(local_path, remote_path, check=check, limit=self._parse_size(limit))
+        self._print_results(results, 'text', show_timings, show_stdout=not summary, show_stderr=True, grouped=grouped)
 
-        show_stdout = True
-        show_stderr = not summary
-        print(results.display(show_stderr=show_stderr, show_stdout=show_stdout))
+    def distribute(self, local_path=None, remote_path=None, name=None, tags=None, env=None, query=None, fanout=3,
+                   forward_agent=True, summary=False, grouped=False, show_timings=False, **timeouts):
+        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env, 'query': query})
+        if not hosts:
+            print('No hosts found!')
+            return False
+        else:
+            print('Found these hosts:')
+            for host in hosts:
+                print('\t', host)
+
+        group = SSHGroup(hosts, health=self.cloud.health, **timeouts)
+        results = group.distribute(local_path, remote_path, fanout=fanout, forward_agent=forward_agent)
+        self._print_results(results, 'text', show_timings, show_stdout=not summary, show_stderr=True, grouped=grouped)
 
-    def shell(self, name=None, tags=None, env=None, summary=False):
-        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env})
+    def pull(self, remote_path=None, local_dir=None, name=None, tags=None, env=None, query=None, compress=False, tail=None,
+             offset=None, length=None, max_transfers=None, limit=None, summary=False, grouped=False, show_timings=False,
+             **group_options):
+        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env, 'query': query})
         if not hosts:
             print('No hosts found!')
             return False
@@ -225,23 +482,45 @@ class CLIHandler():
             for host in hosts:
                 print('\t', host)
 
-        group = SSHGroup(hosts, max_pool_size=10)
-        show_stdout = True
-        show_stderr = True
-        while True:
-            try:
-                cmd = input("[cloud]$ ")
-            except KeyboardInterrupt:
-                break
-            if not cmd:
-                continue
-            if cmd == 'exit':
-                break
-            results = group.run_command(cmd)
-            print(results.display(show_summary=False, show_stdout=show_stdout, show_stderr=show_stderr))
-
-    def enforce(self, policy=None, name=None, tags=None, env=None, summary=False):
-        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env})
+        group = SSHGroup(hosts, **self._group_options(**group_options))
+        results = group.pull(
+            remote_path,
+            local_dir,
+            compress=compress,
+            offset=self._parse_size(offset) or 0,
+            length=self._parse_size(length),
+            tail=self._parse_size(tail),
+            max_transfers=max_transfers,
+            limit=self._parse_size(limit)
+        )
+        self._print_results(results, 'text', show_timings, show_stdout=not summary, show_stderr=True, grouped=grouped)
+
+    def _parse_limits(self, rules):
+        """ ['env=prod:2', 'rack:1'] to Limits, one per key """
+        limits = collections.OrderedDict()
+        for rule in rules:
+            key, sep, count = rule.rpartition(':')
+            if not sep or not count.isdigit() or int(count) < 1:
+                raise ValueError('Expected KEY[=VALUE]:N with N at least 1, got ' + rule)
+            key, sep, value = key.partition('=')
+            limit = limits.setdefault(key, Limit(key))
+            if sep:
+                limit.limits[value] = int(count)
+            else:
+                limit.limit = int(count)
+        return list(limits.values())
+
+    def _parse_size(self, text):
+        if not text:
+            return None
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        multiplier = units.get(text[-1].upper())
+        if multiplier is None:
+            return int(text)
+        return int(float(text[:-1]) * multiplier)
+
+    def shell(self, name=None, tags=None, env=None, query=None, summary=False, use_daemon=False, grouped=False, **pool_options):
+        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env, 'query': query})
         if not hosts:
             print('No hosts found!')
             return False
@@ -250,11 +529,115 @@ class CLIHandler():
             for host in hosts:
                 print('\t', host)
 
+        daemon = self._daemon(use_daemon)
+        pool = SSHConnectionPool()
+        group = SSHGroup(hosts, connection_pool=pool, **self._group_options(**pool_options))
+        show_stdout = True
+        show_stderr = True
+        with pool:
+            while True:
+                try:
+                    cmd = input("[cloud]$ ")
+                except KeyboardInterrupt:
+                    break
+                if not cmd:
+                    continue
+                if cmd == 'exit':
+                    break
+                if grouped:
+                    if daemon is not None:
+                        results = daemon.run_commands(hosts, [cmd])
+                    else:
+                        results = group.run_command(cmd)
+                    print(results.display(show_stdout=show_stdout, show_stderr=show_stderr, show_summary=False, grouped=True))
+                    continue
+                if daemon is not None:
+                    events = daemon.stream_commands(hosts, [cmd])
+                else:
+                    events = group.stream_command(cmd)
+                results = self._stream(events, show_stdout=show_stdout, show_stderr=show_stderr)
+                failures = results.display(show_summary=False)
+                if failures:
+                    print(failures)
+
+    def _print_results(self, results, output_format, show_timings=False, **display_options):
+        if output_format == 'text':
+            print(results.display(**display_options))
+        else:
+            results.write(sys.stdout, output_format)
+        if show_timings:
+            self._print_timings(results.timings(), output_format, results.concurrency)
+
+    def _print_timings(self, timings, output_format, concurrency=None):
+        # Keep stdout machine-readable when exporting
+        log = sys.stdout if output_format == 'text' else sys.stderr
+        print(timings.display(), file=log)
+        if concurrency:
+            sizes = [size for seconds, size in concurrency]
+            print('Pool size: started at {}, peaked at {}, ended at {} ({} changes)'.format(
+                sizes[0], max(sizes), sizes[-1], len(sizes) - 1
+            ), file=log)
+
+    def _export(self, events, output_format, show_timings=False):
+        """ Write a row per host as each one finishes, keeping nothing
+        but the timings """
+        writer = get_writer(output_format, sys.stdout)
+        timed = {}
+        for host, stream, data in events:
+            if stream == 'exit':
+                writer.write(host, data)
+                if show_timings:
+                    timed[host] = SSHResult(duration=data.duration, timings=data.timings)
+            elif stream == 'pending':
+                print('{}: Still running'.format(host), file=sys.stderr)
+        if show_timings:
+            self._print_timings(TimingSummary(timed), output_format)
+
+    def _stream(self, events, show_stdout=True, show_stderr=True):
+        """ Print host output as it arrives and collect the final results """
+        results = SSHGroupResult()
+        for host, stream, data in events:
+            if stream == 'exit':
+                results._add_result(host, data)
+            elif stream == 'pending':
+                print('{}: Still running'.format(host))
+            elif stream == 'stdout' and show_stdout:
+                print('{}<<out>>: {}'.format(host, data), flush=True)
+            elif stream == 'stderr' and show_stderr:
+                print('{}<<err>>: {}'.format(host, data), flush=True)
+        return results
+
+    def enforce(self, policy=None, name=None, tags=None, env=None, query=None, summary=False, use_daemon=False, grouped=False,
+                output_format='text', show_timings=False, **group_options):
+        log = sys.stdout if output_format == 'text' else sys.stderr
+        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env, 'query': query})
+        if not hosts:
+            print('No hosts found!', file=log)
+            return False
+        else:
+            print('Found these hosts:', file=log)
+            for host in hosts:
+                print('\t', host, file=log)
+
         policy = policies.Dir(options={'path': '/tmp/my-policy-dir'})
-        results = self.cloud.enforce_policy(policy, hosts)
-        print(results.display(show_stderr=True))
+        daemon = self._daemon(use_daemon)
+        if output_format != 'text':
+            if daemon is not None:
+                events = daemon.stream_handler(hosts, policy.shell_handler(), policy,
+                                               group_options=self._group_options(capture=MemoryCapture, **group_options))
+            else:
+                events = SSHGroup(hosts, **self._group_options(capture=MemoryCapture, **group_options)).stream_handler(
+                    policy.shell_handler(), policy)
+            self._export(events, output_format, show_timings)
+            return
+        if daemon is not None:
+            results = daemon.run_handler(hosts, policy.shell_handler(), policy,
+                                         group_options=self._group_options(**group_options))
+        else:
+            results = self.cloud.enforce_policy(policy, hosts, **self._group_options(**group_options))
+        self._print_results(results, output_format, show_timings, show_stderr=True, grouped=grouped)
 
-    def register(self, hostname=None, name=None, tags=None, env='default', user=None, password=None, ask_for_pass=False):
+    def register(self, hostname=None, name=None, tags=None, env='default', user=None, password=None, ask_for_pass=False, port=22, via=None):
         """ Register a new host """
         if ask_for_pass:
             password = getpass.getpass('Enter password: ')
@@ -263,7 +646,8 @@ class CLIHandler():
         print('Registering host [{}] {} ({}) (Tags: {}) :: {}'.format(
             env, name, hostname, tags, self.cloud
         ))
-        host = Host(hostname, name=name, username=user, password=password, env=env, cloud=self.cloud)
+        host = Host(hostname, name=name, username=user, password=password, env=env, cloud=self.cloud,
+                    port=port, via=via)
         results = host.ping()
         if results.success():
             print('Connection test successful. Saving host.')
@@ -272,7 +656,7 @@ class CLIHandler():
             add_anyway = input('Connection test failed. Save host anyway? (y/n): ')
             if add_anyway != 'y':
                 return False
-        self.cloud._hosts[host.name] = host
+        self.cloud.add_host(host)
         self.cloud._save()
 
     def encrypt(self, message=None):
@@ -287,22 +671,36 @@ class CLIHandler():
         original = aes2.decrypt(ciphertext)
         print('{} == {}? {}'.format(message, original, original==message))
 
-    def task(self, task=None, name=None, tags=None, env=None, summary=False):
-        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env})
+    def task(self, task=None, name=None, tags=None, env=None, query=None, summary=False, use_daemon=False, grouped=False,
+             output_format='text', show_timings=False, **group_options):
+        log = sys.stdout if output_format == 'text' else sys.stderr
+        hosts = self.cloud.query({'name': name, 'tags': tags, 'env': env, 'query': query})
         if not hosts:
-            print('No hosts found!')
+            print('No hosts found!', file=log)
             return False
         else:
-            print('Found these hosts:')
+            print('Found these hosts:', file=log)
             for host in hosts:
-                print('\t', host)
+                print('\t', host, file=log)
 
         task = self.cloud.get_task(task)
         if task is None:
-            print('No task with that name found')
+            print('No task with that name found', file=log)
             return False
-        results = task.run(hosts)
-        print(results)
+        daemon = self._daemon(use_daemon)
+        if output_format != 'text':
+            options = self._group_options(capture=MemoryCapture, **group_options)
+            if daemon is not None:
+                events = daemon.stream_handler(hosts, TaskShellHandler, task, group_options=options)
+            else:
+                events = SSHGroup(hosts, **options).stream_handler(TaskShellHandler, task)
+            self._export(events, output_format, show_timings)
+            return
+        if daemon is not None:
+            results = daemon.run_handler(hosts, TaskShellHandler, task, group_options=self._group_options(**group_options))
+        else:
+            results = task.run(hosts, **self._group_options(**group_options))
+        self._print_results(results, output_format, show_timings, grouped=grouped)
 
     def create_task(self, task_type=None, task_name=None, options=None):
         cls = self.cloud._task_types.get(task_type)
@@ -0,0 +1,315 @@
+import asyncio
+import asyncssh
+import concurrent.futures
+import io
+import paramiko
+import socket
+import time
+from .net import (SSHSession, SSHResult, SSHGroupResult, SSHError, NetworkError, AuthError, CommandTimeout,
+                  BaseShellHandler, CommandResult)
+from .capture import MemoryCapture
+
+_client_keys = {}
+
+def client_key(pkey):
+    """ A paramiko private key as an asyncssh key, converted once per process """
+    blob = pkey.asbytes()
+    key = _client_keys.get(blob)
+    if key is None:
+        pem = io.StringIO()
+        pkey.write_private_key(pem)
+        key = _client_keys.setdefault(blob, asyncssh.import_private_key(pem.getvalue()))
+    return key
+
+class BlockingClient():
+    """ Synchronous view of an AsyncSSHSession for handlers without an
+    async_shell. Only usable from a handler thread, never from the loop. """
+    def __init__(self, session):
+        self.session = session
+        self.host = session.host
+        self.output = session.output
+
+    def execute(self, cmd, record=True):
+        future = asyncio.run_coroutine_threadsafe(self.session.execute(cmd, record=record), self.session.loop)
+        return future.result()
+
+    def execute_many(self, cmds):
+        future = asyncio.run_coroutine_threadsafe(self.session.execute_many(cmds), self.session.loop)
+        return future.result()
+
+    def submit(self, cmd):
+        """ Like SSHSession.submit, a concurrent.futures.Future """
+        return asyncio.run_coroutine_threadsafe(self.session._execute(cmd), self.session.loop)
+
+class TimedClient(asyncssh.SSHClient):
+    """ Notes when key exchange is over and authentication starts """
+    def __init__(self):
+        self.authenticating = None
+
+    def begin_auth(self, username):
+        self.authenticating = time.monotonic()
+
+class CaptureSession(asyncssh.SSHClientSession):
+    """ Writes a channel's output straight into its captures """
+    def __init__(self, stdout, stderr):
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def data_received(self, data, datatype):
+        if datatype == asyncssh.EXTENDED_DATA_STDERR:
+            self.stderr.write(data)
+        else:
+            self.stdout.write(data)
+
+class JumpConnections():
+    """ One connection per jump host for a run, shared by the hosts behind it """
+    def __init__(self):
+        self._connections = {}
+
+    def connect(self, via, connect):
+        if via not in self._connections:
+            self._connections[via] = asyncio.ensure_future(connect(via))
+        # A host giving up on the jump host mustn't cancel it for the others
+        return asyncio.shield(self._connections[via])
+
+    def close(self):
+        for future in self._connections.values():
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled() and future.exception() is None:
+                future.result().close()
+
+class AsyncSSHSession():
+    MAX_CHANNELS = SSHSession.MAX_CHANNELS
+    ENCODING = SSHSession.ENCODING
+
+    def __init__(self, host, handler, loop, capture=MemoryCapture, max_channels=None, jumps=None,
+                 handler_executor=None, connect_timeout=None, command_timeout=None):
+        """ Synchronous handlers run on handler_executor, by default the
+        loop's, which also resolves host names. """
+        self.host = host
+        self.jumps = jumps
+        self.handler = handler
+        self.loop = loop
+        self.handler_executor = handler_executor
+        self.capture = capture
+        self.max_channels = max_channels or self.MAX_CHANNELS
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self._channel_slots = asyncio.Semaphore(self.max_channels)
+        self.conn = None
+        self.output = []
+        self.result = None
+        self.timings = {}
+
+    def _add_timings(self, timings):
+        for phase, seconds in timings.items():
+            self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def _options(self, host):
+        credentials = host.credentials()
+        # Like the threaded session's AutoAddPolicy, any host key is accepted
+        options = {'username': credentials.get('username'), 'known_hosts': None}
+        if 'password' in credentials:
+            options['password'] = credentials['password']
+        pkey = credentials.get('pkey')
+        if isinstance(pkey, paramiko.agent.AgentKey):
+            # Agent keys can't be exported; asyncssh asks the agent at
+            # SSH_AUTH_SOCK to sign with the same key instead
+            options['agent_identities'] = [pkey.asbytes()]
+        elif pkey is not None:
+            options['client_keys'] = [client_key(pkey)]
+        return options
+
+    async def connect(self, host, timings):
+        """ A new authenticated connection to host; how long each step
+        took is added to timings. """
+        started = time.monotonic()
+        options = self._options(host)
+        via = host.get_via()
+        if via is not None:
+            if self.jumps is None:
+                raise ValueError('Connecting through a jump host needs jumps')
+            options['tunnel'] = await self.jumps.connect(via, lambda via: self.connect(via, {}))
+            timings['tunnel'] = time.monotonic() - started
+        else:
+            options['sock'] = await self._open_socket(host, timings)
+        client = TimedClient()
+        handshake = time.monotonic()
+        try:
+            conn = await asyncssh.connect(host.hostname, host.port, client_factory=lambda: client, **options)
+        except BaseException:
+            if 'sock' in options:
+                options['sock'].close()
+            raise
+        authenticating = client.authenticating or time.monotonic()
+        timings['kex'] = authenticating - handshake
+        timings['auth'] = time.monotonic() - authenticating
+        return conn
+
+    async def _open_socket(self, host, timings):
+        started = time.monotonic()
+        addresses = await self.loop.getaddrinfo(host.hostname, host.port, type=socket.SOCK_STREAM)
+        resolved = time.monotonic()
+        timings['dns'] = resolved - started
+        error = None
+        for family, kind, proto, name, address in addresses:
+            sock = socket.socket(family, kind, proto)
+            sock.setblocking(False)
+            try:
+                await self.loop.sock_connect(sock, address)
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            timings['tcp'] = time.monotonic() - resolved
+            return sock
+        raise error
+
+    async def run(self):
+        started = time.monotonic()
+        result = await self._run()
+        result.duration = time.monotonic() - started
+        result.timings = dict(self.timings)
+        return result
+
+    async def _run(self):
+        try:
+            self.conn = await asyncio.wait_for(self.connect(self.host, self.timings), self.connect_timeout)
+        except asyncio.TimeoutError:
+            self.result = SSHResult(executed=False, error=NetworkError('Connect timed out'), timed_out=True)
+            return self.result
+        except asyncssh.PermissionDenied as e:
+            self.result = SSHResult(executed=False, error=AuthError(str(e)))
+            return self.result
+        except (OSError, asyncssh.Error) as e:
+            self.result = SSHResult(executed=False, error=SSHError(str(e)))
+            return self.result
+        except Exception as e:
+            self.result = SSHResult(executed=False, error=e)
+            return self.result
+
+        try:
+            shell = getattr(self.handler, 'async_shell', None)
+            if shell is None:
+                await self.run_sync(self.handler.shell)
+            else:
+                await shell(self)
+        except CommandTimeout as e:
+            self.result = SSHResult(executed=True, output=self.output, error=e, timed_out=True)
+            return self.result
+        finally:
+            self.conn.close()
+        self.result = SSHResult(executed=True, output=self.output)
+        return self.result
+
+    async def run_sync(self, shell):
+        """ Run a synchronous shell(client) callable on a handler thread """
+        return await self.loop.run_in_executor(self.handler_executor, shell, BlockingClient(self))
+
+    async def execute(self, cmd, record=True):
+        cmd_result = await self._execute(cmd)
+        if record:
+            self.output.append(cmd_result)
+        return cmd_result
+
+    def submit(self, cmd):
+        """ Start a command on a new channel and return its asyncio.Task;
+        the command's result is not added to the session output. """
+        return self.loop.create_task(self._execute(cmd))
+
+    async def execute_many(self, cmds):
+        cmd_results = await asyncio.gather(*[self.submit(cmd) for cmd in cmds])
+        self.output.extend(cmd_results)
+        return cmd_results
+
+    async def _execute(self, cmd):
+        async with self._channel_slots:
+            try:
+                return await asyncio.wait_for(self._run_channel(cmd), self.command_timeout)
+            except asyncio.TimeoutError:
+                raise CommandTimeout('Command timed out after {}s'.format(self.command_timeout))
+
+    async def _run_channel(self, cmd):
+        started = time.monotonic()
+        stdout = self.capture()
+        stderr = self.capture()
+        channel, session = await self.conn.create_session(lambda: CaptureSession(stdout, stderr), cmd, encoding=None)
+        executing = time.monotonic()
+        try:
+            await channel.wait_closed()
+        finally:
+            # Closing the channel also stops a command that timed out
+            channel.close()
+        exit_status = channel.get_exit_status()
+        if exit_status is None:
+            exit_status = -1
+        stdout.close()
+        stderr.close()
+        finished = time.monotonic()
+        timings = {'exec': executing - started, 'drain': finished - executing}
+        self._add_timings(timings)
+        return CommandResult(exit_status, stdout, stderr, encoding=self.ENCODING, duration=finished - started,
+                             timings=timings)
+
+class AsyncSSHGroup():
+    """ Runs hosts as coroutines on a single event loop, over asyncssh.
+
+    max_concurrency bounds how many hosts are in flight at once. Name
+    lookups and asyncssh's option loading run on the loop's executor, and
+    handlers without an async_shell on another; run_handler gives each
+    max_blocking_threads threads. Connections and commands take none.
+    """
+    def __init__(self, hosts, max_concurrency=200, max_blocking_threads=32, capture=MemoryCapture, max_channels=None,
+                 connect_timeout=None, command_timeout=None):
+        self.hosts = hosts
+        self.capture = capture
+        self.max_channels = max_channels
+        self.max_concurrency = max_concurrency
+        self.max_blocking_threads = max_blocking_threads
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+
+    def run_command(self, command, stop_on_error=True):
+        return self.run_commands([command], stop_on_error=stop_on_error)
+
+    def run_commands(self, commands, stop_on_error=True):
+        return self.run_handler(BaseShellHandler, commands, stop_on_error=stop_on_error)
+
+    def run_handler(self, Handler, *args, **kwargs):
+        return asyncio.run(self._run_handler(Handler, *args, **kwargs))
+
+    async def _run_handler(self, Handler, *args, **kwargs):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_blocking_threads)
+        asyncio.get_running_loop().set_default_executor(executor)
+        return await self.run_handler_async(Handler, *args, **kwargs)
+
+    async def run_handler_async(self, Handler, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        handler_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_blocking_threads)
+        results = SSHGroupResult()
+        jumps = JumpConnections()
+
+        async def run_host(host):
+            async with semaphore:
+                session = AsyncSSHSession(host, Handler(*args, **kwargs), loop, capture=self.capture,
+                                          max_channels=self.max_channels, jumps=jumps,
+                                          handler_executor=handler_executor, connect_timeout=self.connect_timeout,
+                                          command_timeout=self.command_timeout)
+                try:
+                    result = await session.run()
+                except Exception as e:
+                    result = SSHResult(executed=False, error=e)
+            results._add_result(host, result)
+
+        try:
+            await asyncio.gather(*[run_host(host) for host in self.hosts])
+        finally:
+            jumps.close()
+            handler_executor.shutdown(wait=False)
+        return results
@@ -0,0 +1,127 @@
+import io
+import tempfile
+
+class MemoryCapture():
+    """ Keeps all of a stream's output in memory """
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.size = 0
+
+    @property
+    def truncated(self):
+        return False
+
+    def write(self, data):
+        self.size += len(data)
+        self.buffer.write(data)
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+    def close(self):
+        pass
+
+class DiscardCapture():
+    """ Keeps nothing, only counts the bytes seen """
+    def __init__(self):
+        self.size = 0
+
+    @property
+    def truncated(self):
+        return self.size > 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def getvalue(self):
+        return b''
+
+    def close(self):
+        pass
+
+class HeadTailCapture():
+    """ Keeps the first `head` and last `tail` bytes of a stream """
+    OMITTED = '\n... [{} bytes omitted] ...\n'
+
+    def __init__(self, head=65536, tail=65536):
+        self.head_size = head
+        self.tail_size = tail
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+
+    @property
+    def truncated(self):
+        return self.size > len(self.head) + len(self.tail)
+
+    def write(self, data):
+        self.size += len(data)
+        room = self.head_size - len(self.head)
+        if room > 0:
+            self.head.extend(data[:room])
+            data = data[room:]
+        if not data or not self.tail_size:
+            return
+        self.tail.extend(data)
+        # Trim only once the tail has doubled so trimming stays linear
+        if len(self.tail) > 2 * self.tail_size:
+            del self.tail[:len(self.tail) - self.tail_size]
+
+    def getvalue(self):
+        tail = self.tail[-self.tail_size:] if self.tail_size else b''
+        omitted = self.size - len(self.head) - len(tail)
+        if omitted > 0:
+            return bytes(self.head) + self.OMITTED.format(omitted).encode('utf-8') + bytes(tail)
+        return bytes(self.head + tail)
+
+    def close(self):
+        if self.tail_size:
+            del self.tail[:-self.tail_size]
+        else:
+            self.tail = bytearray()
+
+class StoredCapture():
+    """ Output already captured elsewhere, e.g. sent back from a worker """
+    def __init__(self, data, size=None, truncated=False):
+        self.data = data
+        self.size = len(data) if size is None else size
+        self.truncated = truncated
+
+    def getvalue(self):
+        return self.data
+
+    def close(self):
+        pass
+
+class SpillCapture():
+    """ Keeps output in memory up to `threshold` bytes, then in a temp file """
+    def __init__(self, threshold=1048576, dir=None):
+        self.threshold = threshold
+        self.file = tempfile.SpooledTemporaryFile(max_size=threshold, dir=dir)
+        self.size = 0
+
+    @property
+    def truncated(self):
+        return False
+
+    @property
+    def spilled(self):
+        return self.size > self.threshold
+
+    def write(self, data):
+        self.size += len(data)
+        self.file.write(data)
+
+    def getvalue(self):
+        position = self.file.tell()
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(position)
+        return data
+
+    def close(self):
+        self.file.flush()
+
+    def __reduce__(self):
+        # Temp files can't be pickled; send the captured bytes instead
+        return (StoredCapture, (self.getvalue(), self.size, self.truncated))
@@ -1,6 +1,7 @@
 from quickconfig import Configuration
-from .security import generate_secret_key, KeyPair, AESEncryption
-from .net import SSHGroup
+from .security import generate_secret_key, LazyKeyPair, AESEncryption, get_agent_keys
+from .net import SSHGroup, SSHConnectionPool
+from .inventory import Inventory
 from . import policies
 from .utils import import_obj
 import re
@@ -19,14 +20,50 @@ class Cloud():
         self._load_keys(config.get('keys', {}))
         self._load_modules(config.get('modules', []))
         self._load_datasource(**kwargs)
+        self._inventory = None
+        self.health = self._load_health()
+
+    def _load_health(self):
+        """ The HealthCache runs use to skip dead hosts, if any """
+        return None
 
     def _load_keys(self, key_source):
+        # Keys are only read and decrypted once a host needs them, so
+        # commands that never connect don't pay for it
         keys = {}
         for key_name, key_data in key_source.items():
-            key = KeyPair(password=self.config.get('secret_key'), **key_data)
+            key = LazyKeyPair(password=self.config.get('secret_key'), **key_data)
             keys[key_name] = key
         self.keys = keys
         self.key = keys.get('default', None)
+        self._keys_by_fingerprint = None
+
+    def get_key(self, ref):
+        """ A key by name or by fingerprint, including ssh-agent keys """
+        key = self.keys.get(ref)
+        if key is not None:
+            return key
+        if self._keys_by_fingerprint is None:
+            index = {}
+            try:
+                for key in get_agent_keys():
+                    index[key.fingerprint()] = key
+            except Exception:
+                # No usable agent
+                pass
+            # Keys whose fingerprint needs them decrypted wait for a miss
+            for key in self.keys.values():
+                known = key.known_fingerprint()
+                if known is not None:
+                    index[known] = key
+            self._keys_by_fingerprint = index
+        key = self._keys_by_fingerprint.get(ref)
+        if key is None:
+            for key in self.keys.values():
+                if key.known_fingerprint() is None:
+                    self._keys_by_fingerprint[key.fingerprint()] = key
+            key = self._keys_by_fingerprint.get(ref)
+        return key
 
     def _load_datasource(self, **data):
         # Datasource
@@ -57,24 +94,46 @@ class Cloud():
             self._task_types.update(module.get_task_types())
 
     def query(self, filters, single=False):
-        matches = []
+        """ Hosts matching a query string (see pycloud.core.inventory) or
+        a dict of filters, ordered by name: 'query', 'env', 'tags' (one or a
+        list, all required) and 'name', a regex matched at the start. """
+        if isinstance(filters, str):
+            filters = {'query': filters}
+        inventory = self.inventory
+        candidates = []
+        if filters.get('query'):
+            candidates.append(inventory.match(filters['query']))
+        env = filters.get('env', None)
+        if env:
+            candidates.append(inventory.by_env.get(env, set()))
+        tags = filters.get('tags', None)
+        if isinstance(tags, str):
+            tags = [tags]
+        for tag in tags or []:
+            candidates.append(inventory.by_tag.get(tag, set()))
+        if candidates:
+            candidates.sort(key=len)
+            names = sorted(candidates[0].intersection(*candidates[1:]))
+        else:
+            names = inventory.names
         name_pattern = filters.get('name', None)
         if name_pattern:
             name_pattern = re.compile(name_pattern)
-        tags = filters.get('tags', None)
-        env = filters.get('env', None)
-        for host in self.hosts:
-            if name_pattern and not name_pattern.match(host.name):
-                continue
-            if tags and tags not in host.tags:
-                continue
-            if env and host.env != env:
-                continue
-            if single:
-                return host
-            else:
-                matches.append(host)
-        return matches
+            names = [name for name in names if name_pattern.match(name)]
+        if single:
+            return inventory.get(names[0]) if names else None
+        return [inventory.get(name) for name in names]
+
+    def search(self, text):
+        """ Hosts matching a query, e.g. 'tag=ubuntu and env!=prod' """
+        return self.query(text)
+
+    @property
+    def inventory(self):
+        """ The hosts, indexed for queries """
+        if self._inventory is None:
+            self._inventory = Inventory(self._hosts.values())
+        return self._inventory
 
     @property
     def hosts(self):
@@ -83,6 +142,11 @@ class Cloud():
     def get_host(self, name):
         return self._hosts.get(name)
 
+    def add_host(self, host):
+        self._hosts[host.name] = host
+        if self._inventory is not None:
+            self._inventory.add(host)
+
     @property
     def tasks(self):
         return self._tasks.values()
@@ -117,13 +181,15 @@ class Cloud():
     def decrypt(self, ciphertext):
         return AESEncrypt(self.config('secret_key')).decrypt(ciphertext)
 
-    def enforce_policy(self, policy, hosts):
-        group = SSHGroup(hosts)
+    def enforce_policy(self, policy, hosts, connection_pool=None, **group_options):
+        group_options.setdefault('health', self.health)
+        group = SSHGroup(hosts, connection_pool=connection_pool, **group_options)
         results = group.run_handler(policy.shell_handler(), policy)
         return results
 
 class Host():
-    def __init__(self, hostname, username=None, password=None, pkey=None, name=None, env=None, tags=None, cloud=None):
+    def __init__(self, hostname, username=None, password=None, pkey=None, name=None, env=None, tags=None, cloud=None,
+                 port=22, via=None, key=None):
         if name is None:
             name = hostname
 
@@ -135,8 +201,34 @@ class Host():
         self.env = env
         self.tags = tags
         self.cloud = cloud
+        self.port = port
+        # Jump host: a Host, or the name of one in the cloud
+        self.via = via
+        # Name or fingerprint of one of the cloud's keys
+        self.key = key
+        self._credentials = None
+        self._credentials_source = None
+
+    def get_via(self):
+        if isinstance(self.via, str):
+            if self.cloud is None:
+                raise ValueError('Cannot resolve jump host {} without a cloud'.format(self.via))
+            via = self.cloud.get_host(self.via)
+            if via is None:
+                raise ValueError('Unknown jump host: ' + self.via)
+            return via
+        return self.via
 
     def credentials(self):
+        """ Keyword arguments for paramiko's connect. Resolved once and
+        reused until the host's username, password or keys change. """
+        source = (self.username, self.password, self.pkey, self.key)
+        if self._credentials is None or self._credentials_source != source:
+            self._credentials = self._resolve_credentials()
+            self._credentials_source = source
+        return self._credentials
+
+    def _resolve_credentials(self):
         username = self.username
         if not self.username:
             print('Falling back to root user')
@@ -148,7 +240,12 @@ class Host():
             creds['password'] = self.password
         elif self.pkey:
             creds['pkey'] = self.pkey.as_paramiko()
-        elif self.cloud:
+        elif self.key:
+            key = self.cloud.get_key(self.key) if self.cloud else None
+            if key is None:
+                raise ValueError('Unknown key for {}: {}'.format(self.name, self.key))
+            creds['pkey'] = key.as_paramiko()
+        elif self.cloud and self.cloud.key:
             creds['pkey'] = self.cloud.key.as_paramiko()
         return creds
 
@@ -175,15 +272,17 @@ class BaseOperation():
     def get_type_name(self):
         return self.__class__.__name__
 
-    def get_hosts(self):
+    def get_hosts(self, task=None):
         return self.hosts    
 
     def get_tasks(self):
         return self.tasks
 
     def run(self):
-        for task in self.get_tasks():
-            task.run(self.get_hosts(task))
+        # Tasks share one connection per host for the whole operation
+        with SSHConnectionPool() as pool:
+            for task in self.get_tasks():
+                task.run(self.get_hosts(task), connection_pool=pool)
 
 class TaskShellHandler():
     def __init__(self, task):
@@ -192,6 +291,13 @@ class TaskShellHandler():
     def shell(self, client):
         self.task.shell(client)
 
+    async def async_shell(self, client):
+        shell = getattr(self.task, 'async_shell', None)
+        if shell is None:
+            await client.run_sync(self.task.shell)
+        else:
+            await shell(client)
+
 class BaseTask():
     required_options = []
 
@@ -206,8 +312,8 @@ class BaseTask():
     def get_type_name(self):
         return self.__class__.__name__
 
-    def run(self, hosts):
-        group = SSHGroup(hosts)
+    def run(self, hosts, **group_options):
+        group = SSHGroup(hosts, **group_options)
         return group.run_handler(TaskShellHandler, self)
 
 class HostQuery():
@@ -0,0 +1,270 @@
+""" Deciding how many hosts an SSHGroup works on at once, and which.
+
+Limits cap the hosts running at once per environment, tag or any other
+attribute; see Limit and HostQueue.
+
+AdaptiveConcurrency searches for the pool size a run can sustain, the
+way TCP sizes its congestion window. It starts at floor and, in slow
+start, adds a slot for every host that connects cleanly until the first
+sign of trouble. After that it adds one slot per limit hosts (additive
+increase). Congestion cuts the limit by decrease (multiplicative
+decrease), never below floor. Congestion means:
+
+- connects reset, timed out or dropped before the SSH banner, which is
+  how sshd's MaxStartups and overloaded bastions look from here.
+- handshakes (kex and auth) getting slower than latency_factor times the
+  fastest one seen.
+
+Hosts that were already running when the limit was cut cannot cut it
+again, so one burst of failures backs off once rather than collapsing
+to the floor. history holds (seconds into the run, limit) for every
+change of the limit.
+"""
+import collections
+import threading
+import time
+
+CONGESTION_ERRORS = ('reset by peer', 'protocol banner', 'timed out', 'timeout', 'broken pipe', 'eof')
+
+class AdaptiveConcurrency():
+    LATENCY_WEIGHT = 0.2
+    # Handshakes this much over the fastest are never congestion; loopback
+    # and LAN handshakes vary by more than latency_factor on their own.
+    LATENCY_SLACK = 0.05
+
+    def __init__(self, floor=2, ceiling=100, initial=None, decrease=0.5, latency_factor=2.0):
+        if floor < 1 or ceiling < floor:
+            raise ValueError('Need 1 <= floor <= ceiling, got {} and {}'.format(floor, ceiling))
+        self.floor = floor
+        self.ceiling = ceiling
+        self.initial = initial or floor
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self._changed = threading.Condition()
+        self.start()
+
+    def __reduce__(self):
+        return (AdaptiveConcurrency, (self.floor, self.ceiling, self.initial, self.decrease, self.latency_factor))
+
+    def start(self):
+        """ Reset for a new run """
+        with self._changed:
+            self.limit = float(min(max(self.initial, self.floor), self.ceiling))
+            self.running = 0
+            self.slow_start = True
+            self.epoch = 0
+            self.baseline = None
+            self.latency = None
+            self.closed = False
+            self.started = time.monotonic()
+            self.history = [(0.0, int(self.limit))]
+
+    @property
+    def peak(self):
+        return max(limit for seconds, limit in self.history)
+
+    def acquire(self):
+        """ Wait for a free slot; returns a token for release, or None once
+        closed. """
+        with self._changed:
+            self._changed.wait_for(lambda: self.closed or self.running < int(self.limit))
+            if self.closed:
+                return None
+            self.running += 1
+            return self.epoch
+
+    def release(self, token, result=None):
+        """ Free the slot of token and learn from the result of a host we
+        tried to connect to; None if we didn't. """
+        if token is None:
+            return
+        with self._changed:
+            self.running -= 1
+            signal = self._signal(result)
+            if signal == 'congested':
+                if token == self.epoch:
+                    self._set_limit(self.limit * self.decrease)
+                    self.slow_start = False
+                    self.epoch += 1
+            elif signal == 'ok':
+                if self.slow_start:
+                    self._set_limit(self.limit + 1)
+                else:
+                    self._set_limit(self.limit + 1 / self.limit)
+            self._changed.notify_all()
+
+    def close(self):
+        """ Wake up and turn away every waiting worker """
+        with self._changed:
+            self.closed = True
+            self._changed.notify_all()
+
+    def _set_limit(self, limit):
+        previous = int(self.limit)
+        self.limit = min(max(limit, self.floor), self.ceiling)
+        if int(self.limit) != previous:
+            self.history.append((time.monotonic() - self.started, int(self.limit)))
+
+    def _signal(self, result):
+        """ 'congested', 'ok', or None if the result says nothing about load
+        (reused connections, hosts that are simply down). """
+        if result is None:
+            return None
+        if not result.executed:
+            error = str(result.error or '').lower()
+            if result.timed_out or any(marker in error for marker in CONGESTION_ERRORS):
+                return 'congested'
+        timings = result.timings or {}
+        if 'kex' not in timings:
+            return None
+        handshake = timings['kex'] + timings.get('auth', 0)
+        if self.baseline is None or handshake < self.baseline:
+            self.baseline = handshake
+        if self.latency is None:
+            self.latency = handshake
+        else:
+            self.latency += self.LATENCY_WEIGHT * (handshake - self.latency)
+        if self.latency > max(self.baseline * self.latency_factor, self.baseline + self.LATENCY_SLACK):
+            return 'congested'
+        return 'ok'
+
+def merge_histories(histories):
+    """ The combined limit of limiters running side by side, e.g. one per
+    worker process, as one history. Each is timed from its own start. """
+    limits = [0] * len(histories)
+    merged = []
+    for seconds, i, limit in sorted((seconds, i, limit) for i, history in enumerate(histories)
+                                    for seconds, limit in history):
+        limits[i] = limit
+        if merged and merged[-1][0] == seconds:
+            merged.pop()
+        merged.append((seconds, sum(limits)))
+    return merged
+
+class Limit():
+    """ At most limit hosts at once per value of key.
+
+    key is a Host attribute ('env', 'tags', ...) or a function of the
+    host; a list of values, like tags, counts the host under each. limits
+    sets the cap per value and limit is for values not in it, None for
+    none:
+
+        Limit('env', limits={'prod': 2, 'dev': 50})
+        Limit('tags', limits={'database': 1})
+        Limit('rack', 1)
+    """
+    def __init__(self, key, limit=None, limits=None):
+        # A cap of 0 would leave its hosts waiting forever
+        caps = list((limits or {}).values()) + [limit]
+        if any(cap is not None and cap < 1 for cap in caps):
+            raise ValueError('Limits must be at least 1, got {}'.format(min(cap for cap in caps if cap is not None)))
+        self.key = key
+        self.limit = limit
+        self.limits = limits or {}
+
+    def values(self, host):
+        if callable(self.key):
+            values = self.key(host)
+        elif not hasattr(host, self.key):
+            # A typo like 'tag' for 'tags' would otherwise cap nothing
+            raise ValueError('Cannot limit by {}: {} has no such attribute'.format(self.key, host))
+        else:
+            values = getattr(host, self.key)
+        if values is None:
+            return []
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        return [value for value in values if self.cap(value) is not None]
+
+    def cap(self, value):
+        return self.limits.get(value, self.limit)
+
+    def __str__(self):
+        key = getattr(self.key, '__name__', self.key)
+        caps = ['{}={}'.format(value, limit) for value, limit in self.limits.items()]
+        if self.limit is not None:
+            caps.append('each={}'.format(self.limit))
+        return '{}: {}'.format(key, ', '.join(caps))
+
+class HostQueue():
+    """ The hosts of a run waiting for a worker.
+
+    get() hands out the longest waiting host whose limits all have room,
+    so a throttled environment never holds up the hosts behind it, and
+    every Limit applies at once: prod at most 4 and databases at most 1
+    keeps prod databases to one at a time. Workers call done(host) when
+    they finish with it. None, put() once per worker, stops one worker
+    after the eligible hosts. A host may be queued more than once; each
+    done(host) frees the slots of one of its dispatches.
+
+    Hosts are kept in a queue per combination of limits they fall under,
+    so finding the next one costs the number of combinations, not hosts.
+    """
+    def __init__(self, limits=None):
+        self.limits = limits or []
+        self._queues = collections.OrderedDict()
+        self._slots = collections.defaultdict(list)
+        self._running = collections.Counter()
+        self._stops = 0
+        self._order = 0
+        self._changed = threading.Condition()
+
+    def put(self, host):
+        with self._changed:
+            if host is None:
+                self._stops += 1
+            else:
+                slots = self._host_slots(host)
+                self._queues.setdefault(slots, collections.deque()).append((self._order, host))
+                self._order += 1
+            self._changed.notify_all()
+
+    def get(self):
+        """ The next eligible host, waiting for one if need be """
+        with self._changed:
+            while True:
+                host = self._next()
+                if host is not None:
+                    return host
+                if self._stops:
+                    self._stops -= 1
+                    return None
+                self._changed.wait()
+
+    def done(self, host):
+        with self._changed:
+            dispatches = self._slots.get(host)
+            if dispatches:
+                for slot in dispatches.pop():
+                    self._running[slot] -= 1
+                if not dispatches:
+                    del self._slots[host]
+            self._changed.notify_all()
+
+    def take_all(self):
+        """ Remove and return every waiting host """
+        with self._changed:
+            hosts = [host for order, host in sorted(item for queue in self._queues.values() for item in queue)]
+            self._queues.clear()
+            return hosts
+
+    def _host_slots(self, host):
+        return tuple((i, value) for i, limit in enumerate(self.limits) for value in limit.values(host))
+
+    def _has_room(self, slots):
+        return all(self._running[slot] < self.limits[slot[0]].cap(slot[1]) for slot in slots)
+
+    def _next(self):
+        best = None
+        for slots, queue in self._queues.items():
+            if queue and (best is None or queue[0][0] < self._queues[best][0][0]) and self._has_room(slots):
+                best = slots
+        if best is None:
+            return None
+        order, host = self._queues[best].popleft()
+        if not self._queues[best]:
+            del self._queues[best]
+        for slot in best:
+            self._running[slot] += 1
+        self._slots[host].append(best)
+        return host
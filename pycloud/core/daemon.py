@@ -0,0 +1,295 @@
+""" Background process that keeps SSH connections open between CLI runs.
+
+Like OpenSSH's ControlMaster, but for the whole fleet: the daemon holds an
+SSHConnectionPool and runs handlers for clients that connect to its Unix
+socket, so repeated commands skip the handshakes. Start it with
+`minicloud.py daemon start` or `python -m pycloud.core.daemon`.
+
+Requests and replies are pickles, so the socket is only ever accessible
+to the user who started the daemon.
+"""
+import argparse
+import os
+import pickle
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from .net import SSHGroup, SSHGroupResult, SSHConnectionPool, HostSpec, BaseShellHandler
+from .capture import MemoryCapture
+
+DEFAULT_SOCKET = '~/.pycloud-mux.sock'
+HEADER = struct.Struct('!I')
+
+class DaemonError(Exception):
+    """ The daemon failed to serve a request """
+    pass
+
+def send_message(sock, message):
+    data = pickle.dumps(message)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+def recv_message(sock):
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    data = _recv_exactly(sock, size)
+    if data is None:
+        raise EOFError('Connection closed mid-message')
+    return pickle.loads(data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1048576))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+class MuxDaemon():
+    """ Serves runs over a Unix socket from one shared connection pool.
+
+    Connections unused for idle_timeout seconds are closed; once none are
+    left and no client has been seen for idle_timeout the daemon exits.
+    """
+    REAP_INTERVAL = 5
+
+    def __init__(self, path=DEFAULT_SOCKET, idle_timeout=600, max_connections=1000, max_pool_size=100):
+        self.path = os.path.expanduser(path)
+        self.idle_timeout = idle_timeout
+        self.max_pool_size = max_pool_size
+        self.pool = SSHConnectionPool(max_connections=max_connections, idle_timeout=idle_timeout)
+        self.stopped = threading.Event()
+        self.active = 0
+        self.last_seen = time.monotonic()
+        self.lock = threading.Lock()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(64)
+        listener.settimeout(self.REAP_INTERVAL)
+        try:
+            while not self.stopped.is_set():
+                try:
+                    conn, addr = listener.accept()
+                except socket.timeout:
+                    self._reap()
+                    continue
+                if self.stopped.is_set():
+                    conn.close()
+                    break
+                thread = threading.Thread(target=self._serve, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.pool.close_all()
+
+    def _reap(self):
+        self.pool.expire()
+        with self.lock:
+            idle = not self.active and time.monotonic() - self.last_seen > self.idle_timeout
+        if idle and not len(self.pool):
+            self.stopped.set()
+
+    def _allowed(self, conn):
+        peercred = getattr(socket, 'SO_PEERCRED', None)
+        if peercred is None:
+            # Only the socket's file mode protects us here
+            return True
+        creds = conn.getsockopt(socket.SOL_SOCKET, peercred, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+    def _serve(self, conn):
+        with self.lock:
+            self.active += 1
+        try:
+            if not self._allowed(conn):
+                return
+            request = recv_message(conn)
+            if request is not None:
+                self._handle(conn, request)
+        except (OSError, EOFError):
+            # The client went away; a run in progress stops with it
+            pass
+        except Exception as e:
+            # Tell the client rather than leave it waiting on a closed socket
+            try:
+                send_message(conn, {'type': 'error', 'error': '{}: {}'.format(type(e).__name__, e)})
+            except (OSError, EOFError):
+                pass
+        finally:
+            conn.close()
+            with self.lock:
+                self.active -= 1
+                self.last_seen = time.monotonic()
+
+    def _handle(self, conn, request):
+        kind = request.get('type')
+        if kind == 'ping':
+            send_message(conn, {'pid': os.getpid(), 'connections': len(self.pool)})
+        elif kind == 'stop':
+            self.stopped.set()
+            send_message(conn, {'pid': os.getpid()})
+            # Wake the accept loop so it sees we're stopping
+            wake = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                wake.connect(self.path)
+            except OSError:
+                pass
+            wake.close()
+        elif kind == 'run':
+            self._run(conn, request)
+
+    def _run(self, conn, request):
+        hosts = request['hosts']
+        index = {host: i for i, host in enumerate(hosts)}
+        options = dict(request.get('options', {}))
+        options.setdefault('max_pool_size', self.max_pool_size)
+        group = SSHGroup(hosts, connection_pool=self.pool, **options)
+        events = group.stream_handler(request['handler'], *request['args'], **request['kwargs'])
+        try:
+            for host, name, data in events:
+                if name == 'exit':
+                    data = data.portable()
+                send_message(conn, (index[host], name, data))
+        finally:
+            events.close()
+        send_message(conn, None)
+
+class DaemonClient():
+    """ Runs handlers through a MuxDaemon instead of connecting directly.
+    Hosts are sent as HostSpecs, with their credentials. """
+    START_TIMEOUT = 5
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.path = os.path.expanduser(path)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _request(self, request):
+        sock = self._connect()
+        try:
+            send_message(sock, request)
+            return self._receive(sock)
+        finally:
+            sock.close()
+
+    def _receive(self, sock):
+        message = recv_message(sock)
+        if isinstance(message, dict) and message.get('type') == 'error':
+            raise DaemonError(message['error'])
+        return message
+
+    def status(self):
+        """ The daemon's pid and open connections, or None if it isn't running """
+        try:
+            return self._request({'type': 'ping'})
+        except OSError:
+            return None
+
+    def available(self):
+        return self.status() is not None
+
+    def start(self, idle_timeout=600):
+        if self.available():
+            return True
+        cmd = [sys.executable, '-m', 'pycloud.core.daemon', '--socket', self.path, '--idle-timeout', str(idle_timeout)]
+        # Make sure the daemon imports the same pycloud we run from
+        package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+        with open(os.devnull, 'r+b') as devnull:
+            subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull, env=env, start_new_session=True)
+        deadline = time.monotonic() + self.START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.available():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def stop(self):
+        try:
+            return self._request({'type': 'stop'}) is not None
+        except OSError:
+            return False
+
+    def stream_handler(self, hosts, Handler, *args, **kwargs):
+        """ Like SSHGroup.stream_handler, with SSHGroup's options (timeouts,
+        rollout, capture...) passed as group_options. """
+        group_options = kwargs.pop('group_options', {})
+        hosts = list(hosts)
+        shared = {}
+        request = {
+            'type': 'run',
+            'hosts': [HostSpec(host, shared) for host in hosts],
+            'handler': Handler,
+            'args': args,
+            'kwargs': kwargs,
+            'options': group_options,
+        }
+        sock = self._connect()
+        try:
+            send_message(sock, request)
+            while True:
+                event = self._receive(sock)
+                if event is None:
+                    return
+                position, name, data = event
+                yield (hosts[position], name, data)
+        finally:
+            sock.close()
+
+    def stream_commands(self, hosts, commands, stop_on_error=True, **group_options):
+        return self.stream_handler(hosts, BaseShellHandler, commands, stop_on_error=stop_on_error,
+                                   group_options=group_options)
+
+    def run_handler(self, hosts, Handler, *args, **kwargs):
+        group_options = kwargs.pop('group_options', {})
+        group_options.setdefault('capture', MemoryCapture)
+        results = SSHGroupResult()
+        for host, name, data in self.stream_handler(hosts, Handler, *args, group_options=group_options, **kwargs):
+            if name == 'exit':
+                results._add_result(host, data)
+            elif name == 'pending':
+                results._add_pending(host)
+        return results
+
+    def run_commands(self, hosts, commands, stop_on_error=True, **group_options):
+        return self.run_handler(hosts, BaseShellHandler, commands, stop_on_error=stop_on_error,
+                                group_options=group_options)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Keep SSH connections open for minicloud.py')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--idle-timeout', type=float, default=600)
+    parser.add_argument('--max-connections', type=int, default=1000)
+    parser.add_argument('--max-pool-size', type=int, default=100)
+    options = parser.parse_args(argv)
+    MuxDaemon(options.socket, idle_timeout=options.idle_timeout, max_connections=options.max_connections,
+              max_pool_size=options.max_pool_size).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+""" Machine-readable result output, one row per host.
+
+Writers take (host, SSHResult) pairs as hosts finish, so a run can be
+exported while it is still going:
+
+    writer = get_writer('jsonl', sys.stdout)
+    for host, event, data in group.stream_commands(commands):
+        if event == 'exit':
+            writer.write(host, data)
+"""
+import csv
+import json
+
+def result_row(host, result):
+    """ The fields exported for one host """
+    commands = []
+    for cmd_result in result.output:
+        commands.append({
+            'exit_code': cmd_result.exit_code,
+            'duration': getattr(cmd_result, 'duration', None),
+            'stdout': cmd_result.stdout,
+            'stderr': cmd_result.stderr,
+        })
+    return {
+        'host': getattr(host, 'name', None) or str(host),
+        'hostname': getattr(host, 'hostname', None),
+        'env': getattr(host, 'env', None),
+        'status': str(result),
+        'success': result.success(),
+        'error': None if result.error is None else str(result.error),
+        'duration': result.duration,
+        'timings': result.timings,
+        'commands': commands,
+    }
+
+class JSONLinesWriter():
+    """ One JSON object per host and line, commands nested """
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, host, result):
+        self.fp.write(json.dumps(result_row(host, result)) + '\n')
+        self.fp.flush()
+
+class CSVWriter():
+    """ One CSV row per host; exit codes and durations of the commands
+    are space separated and their output concatenated. """
+    FIELDS = ['host', 'hostname', 'env', 'status', 'success', 'error', 'duration',
+              'exit_codes', 'command_durations', 'stdout', 'stderr']
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.writer = csv.DictWriter(fp, self.FIELDS)
+        self.writer.writeheader()
+
+    def write(self, host, result):
+        row = result_row(host, result)
+        commands = row.pop('commands')
+        del row['timings']
+        row['duration'] = self._seconds(row['duration'])
+        row['exit_codes'] = ' '.join(str(command['exit_code']) for command in commands)
+        row['command_durations'] = ' '.join(self._seconds(command['duration']) for command in commands)
+        row['stdout'] = ''.join(command['stdout'] for command in commands)
+        row['stderr'] = ''.join(command['stderr'] for command in commands)
+        self.writer.writerow(row)
+        self.fp.flush()
+
+    def _seconds(self, duration):
+        return '' if duration is None else '{:.3f}'.format(duration)
+
+WRITERS = {
+    'jsonl': JSONLinesWriter,
+    'csv': CSVWriter,
+}
+
+def get_writer(format, fp):
+    try:
+        Writer = WRITERS[format]
+    except KeyError:
+        raise ValueError('Unknown result format: {} (expected one of {})'.format(format, ', '.join(sorted(WRITERS))))
+    return Writer(fp)
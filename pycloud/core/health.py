@@ -0,0 +1,163 @@
+""" Remembers which hosts could be reached, so dead ones fail fast.
+
+A HealthCache records every connect attempt per host: consecutive
+failures, the last error and a moving average of the handshake time. It
+works as a circuit breaker: after failure_threshold failures in a row a
+host's circuit opens and runs fail it at once, instead of waiting out a
+connect timeout. Once reset_timeout seconds have passed a single run may
+probe it again (half-open). A successful probe closes the circuit; each
+failed one doubles the wait, up to max_reset_timeout.
+
+With a path the cache is kept on disk as JSON between runs. Saving only
+writes the hosts this process saw, merged over the file, so separate
+processes sharing it don't undo each other's updates.
+"""
+import json
+import os
+import threading
+import time
+
+class HostHealth():
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(self, failures=0, last_failure=None, last_error=None, last_success=None, latency=None):
+        self.failures = failures
+        self.last_failure = last_failure
+        self.last_error = last_error
+        self.last_success = last_success
+        # Moving average of the seconds taken to connect
+        self.latency = latency
+        self.probing = None
+
+    def succeeded(self, latency=None):
+        self.failures = 0
+        self.last_success = time.time()
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+        self.probing = None
+
+    def failed(self, error):
+        self.failures += 1
+        self.last_failure = time.time()
+        self.last_error = str(error)
+        self.probing = None
+
+    def to_dict(self):
+        return {
+            'failures': self.failures,
+            'last_failure': self.last_failure,
+            'last_error': self.last_error,
+            'last_success': self.last_success,
+            'latency': self.latency,
+        }
+
+class HealthCache():
+    def __init__(self, path=None, failure_threshold=3, reset_timeout=300, max_reset_timeout=3600):
+        self.path = path and os.path.expanduser(path)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.hosts = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self.load()
+
+    def __reduce__(self):
+        # Worker processes and the connection daemon get their own copy
+        # and share the host states through the file
+        return (HealthCache, (self.path, self.failure_threshold, self.reset_timeout, self.max_reset_timeout))
+
+    def key(self, host):
+        return '{}@{}:{}'.format(getattr(host, 'name', host), getattr(host, 'hostname', ''), getattr(host, 'port', 22))
+
+    def get(self, host):
+        """ The HostHealth of host, or None if it has never been tried """
+        with self._lock:
+            return self.hosts.get(self.key(host))
+
+    def _wait(self, health):
+        """ Seconds an open circuit stays shut before the next probe """
+        doublings = health.failures - self.failure_threshold
+        return min(self.reset_timeout * 2 ** doublings, self.max_reset_timeout)
+
+    def is_open(self, health):
+        return health is not None and health.failures >= self.failure_threshold
+
+    def allow(self, host):
+        """ Whether a run should try host now. While a circuit is half-open
+        only one caller gets to probe it. """
+        now = time.time()
+        with self._lock:
+            health = self.hosts.get(self.key(host))
+            if not self.is_open(health):
+                return True
+            wait = self._wait(health)
+            if now - health.last_failure < wait:
+                return False
+            if health.probing is not None and now - health.probing < wait:
+                return False
+            health.probing = now
+            return True
+
+    def describe(self, host):
+        """ Why host is being skipped """
+        health = self.get(host)
+        if health is None:
+            return 'Host is healthy'
+        retry = max(health.last_failure + self._wait(health) - time.time(), 0)
+        return 'Host unhealthy after {} failed connects (last: {}); next probe in {:.0f}s'.format(
+            health.failures, health.last_error, retry
+        )
+
+    def record_success(self, host, latency=None):
+        self._update(host, lambda health: health.succeeded(latency))
+
+    def record_failure(self, host, error):
+        self._update(host, lambda health: health.failed(error))
+
+    def _update(self, host, change):
+        key = self.key(host)
+        with self._lock:
+            health = self.hosts.get(key)
+            if health is None:
+                health = self.hosts[key] = HostHealth()
+            change(health)
+            self._dirty.add(key)
+
+    def unhealthy(self):
+        """ Keys of the hosts whose circuit is open """
+        with self._lock:
+            return sorted(key for key, health in self.hosts.items() if self.is_open(health))
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return {key: HostHealth(**value) for key, value in data.items()}
+
+    def load(self):
+        if not self.path:
+            return
+        hosts = self._read()
+        with self._lock:
+            self.hosts = hosts
+            self._dirty = set()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            hosts = self._read()
+            for key in self._dirty:
+                hosts[key] = self.hosts[key]
+            self._dirty = set()
+            data = {key: health.to_dict() for key, health in hosts.items()}
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
@@ -0,0 +1,242 @@
+""" Indexed hosts and the query language to find them.
+
+    tag=ubuntu and env!=prod or name~web*
+    (env=prod or env=staging) and not tag=legacy
+    web*                            # short for name~web*
+
+Terms compare a field (name, env, tag or tags, hostname) with = and !=, or
+match a glob with ~ and !~. and binds tighter than or; not and
+parentheses work as usual. Values may be quoted.
+
+An Inventory keeps a set of host names per env and per tag and the names
+in sorted order, so a term is a dict lookup or a range of the name index,
+and a query is set algebra on those sets: negations in an and only
+remove names from the other terms' results, and non-matching hosts are
+never looked at. Leading wildcards (name~*web) and hostname terms need a
+scan.
+"""
+import bisect
+import collections
+import fnmatch
+import functools
+import re
+
+class QueryError(ValueError):
+    pass
+
+FIELDS = {'name': 'name', 'env': 'env', 'tag': 'tags', 'tags': 'tags', 'hostname': 'hostname'}
+TOKEN = re.compile(r'\s*(?:(\()|(\))|(!=|!~|=|~)|"([^"]*)"|\'([^\']*)\'|([^\s()=!~"\']+))')
+WILDCARDS = re.compile(r'[*?\[]')
+
+def host_tags(host):
+    tags = getattr(host, 'tags', None) or []
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    return set(tag.strip() for tag in tags if tag.strip())
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise QueryError('Cannot parse query at: ' + text[position:])
+        opening, closing, operator, double, single, word = match.groups()
+        if opening or closing:
+            tokens.append(('paren', opening or closing))
+        elif operator:
+            tokens.append(('op', operator))
+        elif word is not None and word.lower() in ('and', 'or', 'not'):
+            tokens.append((word.lower(), word))
+        else:
+            value = word if word is not None else (double if double is not None else single)
+            tokens.append(('value', value))
+        position = match.end()
+    return tokens
+
+class Parser():
+    """ Query text to a tree of tuples:
+    ('or', [nodes]), ('and', [nodes]), ('not', node), (field, operator, value) """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise QueryError('Empty query')
+        node = self._or()
+        if self.position < len(self.tokens):
+            raise QueryError('Unexpected {!r} in query: {}'.format(self.tokens[self.position][1], self.text))
+        return node
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def _take(self, kind):
+        token_kind, value = self._peek()
+        if token_kind != kind:
+            raise QueryError('Expected {} in query: {}'.format(kind, self.text))
+        self.position += 1
+        return value
+
+    def _or(self):
+        nodes = [self._and()]
+        while self._peek()[0] == 'or':
+            self.position += 1
+            nodes.append(self._and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def _and(self):
+        nodes = [self._not()]
+        while self._peek()[0] == 'and':
+            self.position += 1
+            nodes.append(self._not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def _not(self):
+        if self._peek()[0] == 'not':
+            self.position += 1
+            return ('not', self._not())
+        return self._term()
+
+    def _term(self):
+        if self._peek() == ('paren', '('):
+            self.position += 1
+            node = self._or()
+            if self._peek() != ('paren', ')'):
+                raise QueryError('Missing ) in query: ' + self.text)
+            self.position += 1
+            return node
+        value = self._take('value')
+        if self._peek()[0] != 'op':
+            # A bare word matches names
+            return ('name', '~', value)
+        operator = self._take('op')
+        field = FIELDS.get(value.lower())
+        if field is None:
+            raise QueryError('Unknown field {} (expected one of {})'.format(value, ', '.join(sorted(FIELDS))))
+        node = (field, operator.lstrip('!'), self._take('value'))
+        if operator.startswith('!'):
+            return ('not', node)
+        return node
+
+@functools.lru_cache(maxsize=256)
+def parse_query(text):
+    return Parser(text).parse()
+
+class Inventory():
+    """ Hosts by name, with indexes on env, tags and name prefixes """
+    def __init__(self, hosts=()):
+        self.hosts = {}
+        self.by_env = collections.defaultdict(set)
+        self.by_tag = collections.defaultdict(set)
+        # The env and tags each host was indexed under
+        self._keys = {}
+        for host in hosts:
+            if host.name in self.hosts:
+                self._unindex(self.hosts[host.name])
+            self._index(host)
+        self.names = sorted(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __iter__(self):
+        return iter(self.hosts.values())
+
+    def get(self, name):
+        return self.hosts.get(name)
+
+    def add(self, host):
+        """ Index host, replacing any host of the same name. Call again
+        after changing a host's env or tags. """
+        if host.name in self.hosts:
+            self.remove(self.hosts[host.name])
+        self._index(host)
+        bisect.insort(self.names, host.name)
+
+    def remove(self, host):
+        self._unindex(self.hosts[host.name])
+        del self.names[bisect.bisect_left(self.names, host.name)]
+
+    def _index(self, host):
+        tags = host_tags(host)
+        self.hosts[host.name] = host
+        self._keys[host.name] = (host.env, tags)
+        self.by_env[host.env].add(host.name)
+        for tag in tags:
+            self.by_tag[tag].add(host.name)
+
+    def _unindex(self, host):
+        name = host.name
+        del self.hosts[name]
+        env, tags = self._keys.pop(name)
+        self._discard(self.by_env, env, name)
+        for tag in tags:
+            self._discard(self.by_tag, tag, name)
+
+    def _discard(self, index, key, name):
+        names = index[key]
+        names.discard(name)
+        if not names:
+            del index[key]
+
+    def select(self, query):
+        """ Hosts matching a query, ordered by name """
+        return [self.hosts[name] for name in sorted(self.match(query))]
+
+    def match(self, query):
+        """ Names of the hosts matching a query, as a set """
+        if isinstance(query, str):
+            query = parse_query(query)
+        return set(self._evaluate(query))
+
+    def _evaluate(self, node):
+        # Terms return the index's own sets; they are never modified
+        kind = node[0]
+        if kind == 'or':
+            names = set()
+            for child in node[1]:
+                names |= self._evaluate(child)
+            return names
+        if kind == 'and':
+            included = [self._evaluate(child) for child in node[1] if child[0] != 'not']
+            excluded = [self._evaluate(child[1]) for child in node[1] if child[0] == 'not']
+            if included:
+                included.sort(key=len)
+                names = included[0].intersection(*included[1:])
+            else:
+                names = self.hosts.keys()
+            for other in excluded:
+                names = names - other
+            return names
+        if kind == 'not':
+            return self.hosts.keys() - self._evaluate(node[1])
+        field, operator, value = node
+        if field == 'name':
+            return self._match_names(operator, value)
+        if field == 'hostname':
+            test = (lambda hostname: fnmatch.fnmatchcase(hostname, value)) if operator == '~' else value.__eq__
+            return set(name for name, host in self.hosts.items() if test(str(host.hostname)))
+        index = self.by_env if field == 'env' else self.by_tag
+        if operator == '=':
+            return index.get(value, frozenset())
+        matches = [index[key] for key in fnmatch.filter((key for key in index if key is not None), value)]
+        if len(matches) == 1:
+            return matches[0]
+        return set().union(*matches)
+
+    def _match_names(self, operator, pattern):
+        if operator == '=' or not WILDCARDS.search(pattern):
+            return {pattern} if pattern in self.hosts else set()
+        prefix = pattern[:WILDCARDS.search(pattern).start()]
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix + '\U0010ffff') if prefix else len(self.names)
+        candidates = self.names[start:end]
+        if pattern == prefix + '*':
+            return set(candidates)
+        return set(fnmatch.filter(candidates, pattern))
@@ -1,6 +1,22 @@
 import paramiko
+import collections
+import math
+import concurrent.futures
+import hashlib
+import io
+import multiprocessing
 import threading
+import queue
+import random
+import selectors
+import socket
 import time
+from .capture import MemoryCapture, DiscardCapture, StoredCapture
+from .utils import compact_names
+from .export import get_writer
+from .timing import TimingSummary
+from .concurrency import HostQueue, merge_histories
+from .transfer import LocalManifest, PushHandler, PullHandler, RelayHandler, TransferResult, BandwidthLimiter, TransferSlots, fanout_tree
 
 class SSHError():
     def __init__(self, message):
@@ -15,13 +31,69 @@ class NetworkError(SSHError):
 class AuthError(SSHError):
     pass
 
+class CommandTimeout(Exception):
+    pass
+
+class CommandResult():
+    """ Exit code and captured output of one command.
+
+    Unpacks like the (exit_code, stdout, stderr) tuple handlers expect, but
+    keeps the raw captures and only decodes stdout/stderr when read.
+    """
+    def __init__(self, exit_code, stdout, stderr, encoding='utf-8', duration=None, timings=None):
+        self.exit_code = exit_code
+        self.stdout_capture = stdout
+        self.stderr_capture = stderr
+        self.encoding = encoding
+        self.duration = duration
+        self.timings = timings or {}
+
+    @property
+    def stdout_bytes(self):
+        return self.stdout_capture.getvalue()
+
+    @property
+    def stderr_bytes(self):
+        return self.stderr_capture.getvalue()
+
+    @property
+    def stdout(self):
+        return self.stdout_bytes.decode(self.encoding, 'replace')
+
+    @property
+    def stderr(self):
+        return self.stderr_bytes.decode(self.encoding, 'replace')
+
+    def __iter__(self):
+        return iter((self.exit_code, self.stdout, self.stderr))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return 'CommandResult({!r}, {!r}, {!r})'.format(*self)
+
 class SSHResult():
-    def __init__(self, executed=True, output=None, error=None):
+    def __init__(self, executed=True, output=None, error=None, skipped=False, timed_out=False, duration=None,
+                 timings=None):
         self.executed = executed
         self.output = output or []
         self.error = error
+        self.skipped = skipped
+        self.timed_out = timed_out
+        # Seconds from connecting to the handler finishing, and per phase
+        # (see pycloud.core.timing)
+        self.duration = duration
+        self.timings = timings or {}
 
     def __str__(self):
+        if self.skipped:
+            return 'Skipped'
+        if self.timed_out:
+            return 'Timed out: ' + str(self.error)
         if not self.executed:
             if self.error:
                 return 'Error:' + str(self.error)
@@ -33,26 +105,147 @@ class SSHResult():
             return 'Failed'
 
     def success(self):
-        if self.error:
+        if self.error or self.skipped:
             return False
-        for exit_code, stdout, stderr in self.output:
-            if exit_code != 0:
+        for cmd_result in self.output:
+            if cmd_result.exit_code != 0:
                 return False
         return True
 
+    def failed(self):
+        return not self.skipped and not self.success()
+
+    def portable(self):
+        """ Prepares the result to be pickled to another process;
+        arbitrary exceptions may not survive the trip """
+        if self.error is not None and not isinstance(self.error, (SSHError, CommandTimeout)):
+            self.error = SSHError(str(self.error))
+        return self
+
+class ResultGroup():
+    """ Hosts whose results were identical: same status, exit codes and output """
+    def __init__(self, result):
+        self.result = result
+        self.hosts = []
+
+    @property
+    def label(self):
+        return compact_names(getattr(host, 'name', None) or str(host) for host in self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
 class SSHGroupResult():
+    """ Results of a run, per host.
+
+    Identical command output is interned as it is added, so a thousand
+    hosts printing the same thing hold one copy of it.
+    """
     def __init__(self):
         self.results = {}
+        self.pending = set()
+        self._changed = threading.Condition()
+        self._interned = {}
+        self._writers = []
+        # (seconds into the run, pool size) with adaptive concurrency
+        self.concurrency = []
 
     def _add_result(self, host, result):
-        self.results[host] = result
+        with self._changed:
+            self._intern(result)
+            self.results[host] = result
+            self.pending.discard(host)
+            for writer in self._writers:
+                writer.write(host, result)
+            self._changed.notify_all()
+
+    def _add_pending(self, host):
+        with self._changed:
+            self.pending.add(host)
+
+    def _intern(self, result):
+        for cmd_result in result.output:
+            if isinstance(cmd_result, CommandResult):
+                cmd_result.stdout_capture = self._intern_capture(cmd_result.stdout_capture)
+                cmd_result.stderr_capture = self._intern_capture(cmd_result.stderr_capture)
+
+    def _intern_capture(self, capture):
+        if getattr(capture, 'spilled', False):
+            # Already on disk, reading it back would cost more than it saves
+            return capture
+        data = capture.getvalue()
+        key = (hashlib.sha256(data).digest(), capture.size, capture.truncated)
+        stored = self._interned.get(key)
+        if stored is None:
+            stored = self._interned[key] = StoredCapture(data, capture.size, capture.truncated)
+        return stored
+
+    def wait(self, timeout=None):
+        """ Wait for stragglers still running in the background; returns
+        False if some are still pending after timeout seconds. """
+        with self._changed:
+            return self._changed.wait_for(lambda: not self.pending, timeout)
 
     def __str__(self):
         return self.display()
 
-    def display(self, show_stderr=False, show_stdout=False, show_summary=True):
+    def add_writer(self, writer):
+        """ Hand every result to writer (see pycloud.core.export) as it
+        is added, starting with those already in. """
+        with self._changed:
+            self._writers.append(writer)
+            for host, result in self.results.items():
+                writer.write(host, result)
+
+    def write(self, fp, format='jsonl'):
+        """ Write a row per host to fp as jsonl or csv """
+        writer = get_writer(format, fp)
+        for host, result in list(self.results.items()):
+            writer.write(host, result)
+
+    def timings(self):
+        """ A TimingSummary of the phases of every host's session """
+        return TimingSummary(dict(self.results))
+
+    def groups(self):
+        """ ResultGroups of hosts with identical results, largest first """
+        groups = {}
+        digests = {}
+        for host, result in list(self.results.items()):
+            key = self._result_key(result, digests)
+            if key not in groups:
+                groups[key] = ResultGroup(result)
+            groups[key].hosts.append(host)
+        return sorted(groups.values(), key=lambda group: (-len(group), group.label))
+
+    def _result_key(self, result, digests):
+        outputs = []
+        for cmd_result in result.output:
+            if isinstance(cmd_result, CommandResult):
+                outputs.append((
+                    cmd_result.exit_code,
+                    self._capture_digest(cmd_result.stdout_capture, digests),
+                    self._capture_digest(cmd_result.stderr_capture, digests),
+                ))
+            else:
+                outputs.append(tuple(cmd_result))
+        return (str(result), tuple(outputs))
+
+    def _capture_digest(self, capture, digests):
+        # Interned captures are shared, so each distinct output is hashed once
+        digest = digests.get(id(capture))
+        if digest is None:
+            digest = digests[id(capture)] = hashlib.sha256(capture.getvalue()).digest()
+        return digest
+
+    def display(self, show_stderr=False, show_stdout=False, show_summary=True, grouped=False):
+        """ grouped prints each distinct result once under a compact list
+        of the hosts that returned it, like clush -b """
+        if grouped:
+            return self._display_grouped(show_stderr, show_stdout, show_summary)
         output = []
-        for host, result in self.results.items():
+        results = list(self.results.items())
+        for host, result in results:
             for exit_code, stdout, stderr in result.output:
                 if show_stdout and stdout:
                     for line in stdout.splitlines():
@@ -60,76 +253,571 @@ class SSHGroupResult():
                 if show_stderr and stderr:
                     for line in stderr.splitlines():
                         output.append('{}<<err>>: {}'.format(host, line))
-        for host, result in self.results.items():
+        for host, result in results:
             if not result.executed or show_summary:
                 output.append('{}: {}'.format(host, result))
         return '\n'.join(output)
 
+    def _display_grouped(self, show_stderr, show_stdout, show_summary):
+        output = []
+        for group in self.groups():
+            result = group.result
+            lines = []
+            for exit_code, stdout, stderr in result.output:
+                if show_stdout and stdout:
+                    lines.extend(stdout.splitlines())
+                if show_stderr and stderr:
+                    lines.extend('<<err>>: ' + line for line in stderr.splitlines())
+            if not result.executed or show_summary:
+                lines.append(str(result))
+            if not lines:
+                continue
+            rule = '-' * 16
+            output.extend([rule, '{} ({})'.format(group.label, len(group)), rule])
+            output.extend(lines)
+        return '\n'.join(output)
+
     def success(self):
-        for result in self.results.values():
-            if not result.no_errors():
+        if self.pending:
+            return False
+        for result in list(self.results.values()):
+            if not result.success():
                 return False
         return True
 
-class SSHSession(threading.Thread):
+    def skipped(self):
+        return [host for host, result in list(self.results.items()) if result.skipped]
+
+    def timed_out(self):
+        return [host for host, result in list(self.results.items()) if result.timed_out]
+
+class OutputStream():
+    """ Collects one channel stream (stdout or stderr) of a command.
+
+    Bytes are written to the capture (see pycloud.core.capture); with
+    on_line every complete line is also decoded and handed over as soon as
+    it arrives.
+    """
+    MAX_LINE_BYTES = 65536
+
+    def __init__(self, capture, on_line=None, encoding='utf-8'):
+        self.capture = capture
+        self.on_line = on_line
+        self.encoding = encoding
+        self.partial = bytearray()
+
+    def write(self, data):
+        self.capture.write(data)
+        if self.on_line is None:
+            return
+        self.partial.extend(data)
+        if b'\n' in data:
+            lines = self.partial.split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self._emit(line)
+        if len(self.partial) >= self.MAX_LINE_BYTES:
+            self._emit(self.partial)
+            self.partial = bytearray()
+
+    def _emit(self, line):
+        self.on_line(line.decode(self.encoding, 'replace'))
+
+    def close(self):
+        self.capture.close()
+        if self.on_line is not None and self.partial:
+            self._emit(self.partial)
+            self.partial = bytearray()
+
+class SSHClient(paramiko.SSHClient):
+    """ paramiko's client with hooks to run once the connection closes,
+    e.g. to release the jump host it was tunneled through, and the
+    timings of its handshake. """
+    def __init__(self):
+        super(SSHClient, self).__init__()
+        self.on_close = []
+        self.timings = {}
+        self.authenticating = None
+
+    def _auth(self, *args, **kwargs):
+        # Key exchange is done once paramiko starts authenticating
+        self.authenticating = time.monotonic()
+        return super(SSHClient, self)._auth(*args, **kwargs)
+
+    def close(self):
+        super(SSHClient, self).close()
+        callbacks, self.on_close = self.on_close, []
+        for callback in callbacks:
+            callback()
+
+class PooledConnection():
+    def __init__(self, client):
+        self.client = client
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    def alive(self):
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (OSError, EOFError, paramiko.ssh_exception.SSHException):
+            return False
+        return True
+
+class SSHConnectionPool():
+    """ Authenticated connections kept open per Host between runs.
+
+    Sessions acquire a host's connection instead of connecting and release
+    it when their handler is done. Connections idle for longer than
+    idle_timeout are closed, and at most max_connections are kept; when the
+    pool is full the least recently used idle connection is evicted, or the
+    new connection is simply closed on release.
+    """
+    def __init__(self, max_connections=100, idle_timeout=300):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._connections = collections.OrderedDict()
+        self._connecting = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close_all()
+
+    def acquire(self, host, connect):
+        client = self._reuse(host)
+        if client is not None:
+            return client
+
+        # One handshake per host: sessions that need the same host at the
+        # same time (e.g. a shared jump host) wait for the first to connect.
+        with self._lock:
+            connecting = self._connecting.setdefault(host, threading.Lock())
+        stale = []
+        try:
+            with connecting:
+                client = self._reuse(host)
+                if client is not None:
+                    return client
+                client = connect(host)
+                with self._lock:
+                    if len(self._connections) >= self.max_connections:
+                        stale.extend(self._evict())
+                    if len(self._connections) < self.max_connections:
+                        conn = PooledConnection(client)
+                        conn.users = 1
+                        self._connections[host] = conn
+        finally:
+            # Also when connect fails, or unreachable hosts would pile up here
+            with self._lock:
+                self._connecting.pop(host, None)
+        self._close(stale)
+        return client
+
+    def _reuse(self, host):
+        with self._lock:
+            stale = self._expire()
+            conn = self._connections.get(host)
+            if conn is not None:
+                # Claimed so it can't expire or be evicted while we check it
+                conn.users += 1
+        self._close(stale)
+        if conn is None:
+            return None
+        # The check talks to the host, which must not hold up the others
+        alive = conn.alive()
+        with self._lock:
+            if alive:
+                conn.last_used = time.monotonic()
+                if self._connections.get(host) is conn:
+                    self._connections.move_to_end(host)
+                return conn.client
+            if self._connections.get(host) is conn:
+                del self._connections[host]
+        self._close([conn])
+        return None
+
+    def release(self, host, client, discard=False):
+        with self._lock:
+            conn = self._connections.get(host)
+            if conn is None or conn.client is not client:
+                # Never pooled; nothing else can reuse it
+                conn = None
+            else:
+                conn.users -= 1
+                conn.last_used = time.monotonic()
+                if discard and conn.users <= 0:
+                    del self._connections[host]
+                    conn = None
+                else:
+                    return
+        client.close()
+
+    def expire(self):
+        """ Close the connections idle for longer than idle_timeout """
+        with self._lock:
+            stale = self._expire()
+        self._close(stale)
+
+    def close_all(self):
+        with self._lock:
+            conns = list(self._connections.values())
+            self._connections.clear()
+        self._close(conns)
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = []
+        for host, conn in list(self._connections.items()):
+            if conn.users <= 0 and now - conn.last_used > self.idle_timeout:
+                expired.append(self._connections.pop(host))
+        return expired
+
+    def _evict(self):
+        for host, conn in self._connections.items():
+            if conn.users <= 0:
+                del self._connections[host]
+                return [conn]
+        return []
+
+    def _close(self, conns):
+        for conn in conns:
+            conn.client.close()
+
+class SSHSession():
     HOST_KEY_POLICY = paramiko.AutoAddPolicy()
     MAX_RECV_BYTES = 1000000
-    CYCLE_WAIT_TIME = .1
+    READY_TIMEOUT = 1
+    MAX_CHANNELS = 10
     ENCODING = 'utf-8'
+    # Large SFTP windows keep pipelined writes flowing on high-latency links
+    SFTP_WINDOW_SIZE = 16777216
+    SFTP_MAX_PACKET_SIZE = 32768 + 1024
+    MAX_RETRY_BACKOFF = 30
     
-    def __init__(self, host, handler):
+    def __init__(self, host, handler, pool=None, listener=None, capture=MemoryCapture, max_channels=None,
+                 connect_timeout=None, command_timeout=None, jump_pool=None, health=None, include_unhealthy=False,
+                 retries=0, retry_backoff=0.5):
+        """ health (a HealthCache) fails hosts with an open circuit at once
+        unless include_unhealthy, and records how connecting went. retries
+        is how often to retry a connect that failed on the network, waiting
+        retry_backoff seconds, doubling each time. """
         self.host = host
+        self.health = health
+        self.include_unhealthy = include_unhealthy
+        self.retries = retries
+        self.retry_backoff = retry_backoff
         self.handler = handler
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(self.HOST_KEY_POLICY)
+        self.pool = pool
+        self.jump_pool = jump_pool
+        self.listener = listener
+        self.capture = capture
+        # sshd refuses sessions past MaxSessions (10 by default)
+        self.max_channels = max_channels or self.MAX_CHANNELS
+        self._channel_slots = threading.BoundedSemaphore(self.max_channels)
+        self._channels = set()
+        self._channel_threads = None
+        self._channel_threads_lock = threading.Lock()
+        self._sftp = None
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.cancelled = threading.Event()
+        self.client = None
         self.output = []
-        super(SSHSession, self).__init__()
+        self.result = None
+        self.timings = {}
+        self._timings_lock = threading.Lock()
+        self.connect_attempts = 0
 
-    def run(self):
+    def connect(self, host):
+        """ A new authenticated client for host; how long each step took
+        is left in client.timings. """
+        client = SSHClient()
+        client.set_missing_host_key_policy(self.HOST_KEY_POLICY)
+        started = time.monotonic()
+        via = host.get_via()
+        if via is not None:
+            sock = self._tunnel(client, via, host)
+            client.timings['tunnel'] = time.monotonic() - started
+        else:
+            sock = self._open_socket(client, host)
+        handshake = time.monotonic()
         try:
-            self.client.connect(
-                self.host.hostname, 
-                **self.host.credentials()
+            client.connect(
+                host.hostname,
+                port=host.port,
+                sock=sock,
+                timeout=self.connect_timeout,
+                banner_timeout=self.connect_timeout,
+                auth_timeout=self.connect_timeout,
+                **host.credentials()
             )
-        except (OSError, paramiko.ssh_exception.SSHException) as e:
-            self.result = SSHResult(executed=False, error=SSHError(str(e)))
+        except Exception:
+            client.close()
+            sock.close()
+            raise
+        authenticating = client.authenticating or time.monotonic()
+        client.timings['kex'] = authenticating - handshake
+        client.timings['auth'] = time.monotonic() - authenticating
+        return client
+
+    def _open_socket(self, client, host):
+        """ Resolve and connect to host ourselves, rather than leaving it to
+        paramiko, so name lookups and TCP connects are timed apart. """
+        started = time.monotonic()
+        addresses = socket.getaddrinfo(host.hostname, host.port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        resolved = time.monotonic()
+        client.timings['dns'] = resolved - started
+        error = None
+        for family, kind, proto, name, address in addresses:
+            sock = socket.socket(family, kind, proto)
+            sock.settimeout(self.connect_timeout)
+            try:
+                sock.connect(address)
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            # Commands are small request/response exchanges; don't let
+            # Nagle hold back channel opens and closes.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client.timings['tcp'] = time.monotonic() - resolved
+            return sock
+        raise error
+
+    def _tunnel(self, client, via, host):
+        """ Open a direct-tcpip channel to host through the jump host's
+        connection, which is shared by every host behind it. """
+        if self.jump_pool is None:
+            raise ValueError('Connecting through a jump host needs a jump_pool')
+        bastion = self.jump_pool.acquire(via, self.connect)
+        try:
+            channel = bastion.get_transport().open_channel(
+                'direct-tcpip',
+                (host.hostname, host.port),
+                ('127.0.0.1', 0),
+                timeout=self.connect_timeout
+            )
+        except Exception:
+            self.jump_pool.release(via, bastion)
+            raise
+        client.on_close.append(lambda: self.jump_pool.release(via, bastion))
+        return channel
+
+    def run(self):
+        started = time.monotonic()
+        result = self._run()
+        result.duration = time.monotonic() - started
+        result.timings = dict(self.timings)
+        return result
+
+    def _open(self):
+        """ Connect, retrying network errors with exponential backoff;
+        returns an SSHResult only if the host could not be reached. """
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            self.connect_attempts += 1
+            try:
+                if self.pool is not None:
+                    self.client = self.pool.acquire(self.host, self._connect)
+                else:
+                    self.client = self._connect(self.host)
+            except paramiko.ssh_exception.AuthenticationException as e:
+                # The host is up; our credentials are the problem
+                self._record_health()
+                return SSHResult(executed=False, error=AuthError(str(e)))
+            except (OSError, paramiko.ssh_exception.SSHException) as e:
+                if attempt < self.retries and not self.cancelled.wait(self._backoff(attempt)):
+                    attempt += 1
+                    continue
+                self._record_health(error=e)
+                if isinstance(e, socket.timeout):
+                    return SSHResult(executed=False, error=NetworkError('Connect timed out'), timed_out=True)
+                return SSHResult(executed=False, error=SSHError(str(e)))
+            except Exception as e:
+                return SSHResult(executed=False, error=e)
+            # Reused pool connections say nothing about connect latency
+            latency = time.monotonic() - started if 'kex' in self.timings else None
+            self._record_health(latency=latency)
+            return None
+
+    def _backoff(self, attempt):
+        delay = min(self.retry_backoff * 2 ** attempt, self.MAX_RETRY_BACKOFF)
+        # Jitter keeps a fleet of retries from arriving in lockstep
+        return delay * random.uniform(0.5, 1)
+
+    def _record_health(self, error=None, latency=None):
+        if self.health is None:
+            return
+        if error is None:
+            self.health.record_success(self.host, latency)
+        else:
+            self.health.record_failure(self.host, error)
+
+    def _connect(self, host):
+        client = self.connect(host)
+        self._add_timings(client.timings)
+        return client
+
+    def _add_timings(self, timings):
+        with self._timings_lock:
+            for phase, seconds in timings.items():
+                self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def _run(self):
+        if self.health is not None and not self.include_unhealthy and not self.health.allow(self.host):
+            self.result = SSHResult(executed=False, error=NetworkError(self.health.describe(self.host)))
             return self.result
-        except paramiko.ssh_exception.AuthenticationException as e:
-            self.result = SSHResult(executed=False, error=AuthError())
+        self.result = self._open()
+        if self.result is not None:
             return self.result
-        except Exception as e:
-            self.result = SSHResult(executed=False, error=e)
+
+        try:
+            self.handler.shell(self)
+        except CommandTimeout as e:
+            self.result = SSHResult(executed=True, output=self.output, error=e, timed_out=True)
             return self.result
-            
-        self.handler.shell(self)
+        finally:
+            if self._channel_threads is not None:
+                # Commands the handler submitted finish before the
+                # connection goes
+                self._channel_threads.shutdown()
+            if self._sftp is not None:
+                self._sftp.close()
+                self._channels.discard(self._sftp.get_channel())
+            if self.pool is not None:
+                self.pool.release(self.host, self.client)
+            else:
+                self.client.close()
         self.result = SSHResult(executed=True, output=self.output)
-        self.client.close()
         return self.result
 
-    def execute(self, cmd):
-        channel = self.client.get_transport().open_session()
-        stdout = b''
-        stderr = b''
-        channel.exec_command(cmd)
-        exit_status = None
-        while True:
-            if channel.exit_status_ready():
-                exit_status = channel.recv_exit_status()
-            if channel.recv_stderr_ready():
-                stderr += channel.recv_stderr(self.MAX_RECV_BYTES)
-            if channel.recv_ready():
-                stdout += channel.recv(self.MAX_RECV_BYTES)
-            if exit_status is not None:
-                break
-            time.sleep(self.CYCLE_WAIT_TIME)
-        cmd_result = (
-            exit_status, 
-            stdout.decode(self.ENCODING),
-            stderr.decode(self.ENCODING)
-        )
-        self.output.append(cmd_result)
+    def cancel(self):
+        """ Stop the session from another thread, killing running commands """
+        self.cancelled.set()
+        for channel in list(self._channels):
+            channel.close()
+
+    def _output_stream(self, name):
+        on_line = None
+        if self.listener is not None:
+            on_line = lambda line: self.listener(self.host, name, line)
+        return OutputStream(self.capture(), on_line=on_line, encoding=self.ENCODING)
+
+    def _drain(self, channel, stdout, stderr):
+        # The channel's fileno is a pipe paramiko marks readable whenever
+        # stdout or stderr data arrives or the channel closes, so we sleep in
+        # the selector until there is something to read. The exit status
+        # may arrive before the last of the output, so we read until EOF.
+        deadline = None
+        if self.command_timeout is not None:
+            deadline = time.monotonic() + self.command_timeout
+        selector = selectors.DefaultSelector()
+        selector.register(channel, selectors.EVENT_READ)
+        try:
+            while True:
+                if self.cancelled.is_set():
+                    raise CommandTimeout('Command cancelled')
+                while channel.recv_ready():
+                    stdout.write(channel.recv(self.MAX_RECV_BYTES))
+                while channel.recv_stderr_ready():
+                    stderr.write(channel.recv_stderr(self.MAX_RECV_BYTES))
+                if channel.eof_received or channel.closed:
+                    if not channel.recv_ready() and not channel.recv_stderr_ready():
+                        break
+                    continue
+                wait = self.READY_TIMEOUT
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        raise CommandTimeout('Command timed out after {}s'.format(self.command_timeout))
+                selector.select(wait)
+        finally:
+            selector.close()
+        return channel.recv_exit_status()
+
+    def _execute(self, cmd, forward_agent=False):
+        if self.cancelled.is_set():
+            raise CommandTimeout('Command cancelled')
+        with self._channel_slots:
+            started = time.monotonic()
+            timings = {}
+            channel = self.client.get_transport().open_session(timeout=self.command_timeout)
+            self._channels.add(channel)
+            try:
+                stdout = self._output_stream('stdout')
+                stderr = self._output_stream('stderr')
+                if forward_agent:
+                    paramiko.agent.AgentRequestHandler(channel)
+                channel.exec_command(cmd)
+                executing = time.monotonic()
+                timings['exec'] = executing - started
+                exit_status = self._drain(channel, stdout, stderr)
+                timings['drain'] = time.monotonic() - executing
+            finally:
+                # Closing the channel also kills a command that timed out
+                channel.close()
+                self._channels.discard(channel)
+                self._add_timings(timings)
+            duration = time.monotonic() - started
+        stdout.close()
+        stderr.close()
+        return CommandResult(exit_status, stdout.capture, stderr.capture, encoding=self.ENCODING, duration=duration,
+                             timings=timings)
+
+    def execute(self, cmd, record=True, forward_agent=False):
+        """ record=False leaves the result out of the session output;
+        forward_agent lets the command use our ssh-agent, e.g. to ssh on. """
+        cmd_result = self._execute(cmd, forward_agent=forward_agent)
+        if record:
+            self.output.append(cmd_result)
         return cmd_result
 
+    def sftp(self):
+        """ The session's SFTP client, opened on first use """
+        if self._sftp is None:
+            self._sftp = paramiko.SFTPClient.from_transport(
+                self.client.get_transport(),
+                window_size=self.SFTP_WINDOW_SIZE,
+                max_packet_size=self.SFTP_MAX_PACKET_SIZE
+            )
+            channel = self._sftp.get_channel()
+            channel.settimeout(self.command_timeout)
+            self._channels.add(channel)
+        return self._sftp
+
+    def submit(self, cmd):
+        """ Start a command on a new channel and return its
+        concurrent.futures.Future; the command's result is not added to the
+        session output. At most max_channels run at once. """
+        # Opening a channel and starting its command each wait on a server
+        # reply, so the channels are driven from a few threads to overlap
+        # those round trips. The threads last as long as the session.
+        with self._channel_threads_lock:
+            if self._channel_threads is None:
+                self._channel_threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_channels)
+        return self._channel_threads.submit(self._execute, cmd)
+
+    def execute_many(self, cmds):
+        """ Run independent commands at the same time, each on its own
+        channel of this host's connection, and return their results in
+        order. """
+        cmds = list(cmds)
+        if len(cmds) < 2:
+            return [self.execute(cmd) for cmd in cmds]
+        futures = [self.submit(cmd) for cmd in cmds]
+        cmd_results = [future.result() for future in futures]
+        self.output.extend(cmd_results)
+        return cmd_results
+
 class BaseShellHandler():
     def __init__(self, commands, stop_on_error=True):
         self.commands = commands
@@ -139,16 +827,247 @@ class BaseShellHandler():
     def shell(self, client):
         for command in self.commands:
             result = client.execute(command)
-            exit_code, stdout, stderr = result
-            if self.stop_on_error and exit_code != 0:
+            if self.stop_on_error and result.exit_code != 0:
                 break
 
+    async def async_shell(self, client):
+        for command in self.commands:
+            result = await client.execute(command)
+            if self.stop_on_error and result.exit_code != 0:
+                break
+
+class Rollout():
+    """ Splits a run into batches for rolling deployments.
+
+    batch_size and canary are host counts or percentages of all hosts
+    ('10%'). The canary batch runs first and must fully succeed. Once the
+    failed hosts exceed max_failure_ratio of all hosts no more hosts are
+    dispatched; they are reported as skipped. pause is the number of
+    seconds to wait between batches.
+    """
+    def __init__(self, batch_size=1, canary=0, max_failure_ratio=None, pause=0):
+        self.batch_size = batch_size
+        self.canary = canary
+        self.max_failure_ratio = max_failure_ratio
+        self.pause = pause
+
+    def _count(self, size, total):
+        if isinstance(size, str) and size.endswith('%'):
+            size = int(total * float(size[:-1]) / 100)
+            return max(size, 1)
+        return int(size)
+
+    def batches(self, hosts):
+        hosts = list(hosts)
+        canary = min(self._count(self.canary, len(hosts)), len(hosts))
+        if canary:
+            yield hosts[:canary]
+        batch_size = max(self._count(self.batch_size, len(hosts)), 1)
+        for i in range(canary, len(hosts), batch_size):
+            yield hosts[i:i + batch_size]
+
+    def should_abort(self, failures, total, canary=False):
+        if canary:
+            return failures > 0
+        if self.max_failure_ratio is None:
+            return False
+        return failures > self.max_failure_ratio * total
+
+class HostSpec():
+    """ Picklable stand-in for a Host with its credentials resolved.
+
+    Used to hand hosts to worker processes. A private key travels as PEM
+    text inside the pickle, i.e. only over the pipe to the worker, and is
+    turned back into a paramiko key on first use there. ssh-agent keys
+    can't leave the agent: only the public key is sent and the worker signs
+    through its own agent connection. Pass the same
+    specs dict for a whole shard so hosts behind one jump host share its
+    spec, and with it the connection to it.
+    """
+    _agent = None
+    _agent_lock = threading.Lock()
+
+    def __init__(self, host, specs=None):
+        self.hostname = host.hostname
+        self.port = host.port
+        self.name = host.name
+        self.env = host.env
+        self.tags = host.tags
+        self.label = str(host)
+        credentials = dict(host.credentials())
+        pkey = credentials.pop('pkey', None)
+        self.key_class = None
+        self.private_key = None
+        self.agent_key = None
+        if isinstance(pkey, paramiko.agent.AgentKey):
+            self.agent_key = pkey.asbytes()
+        elif pkey is not None:
+            buf = io.StringIO()
+            pkey.write_private_key(buf)
+            self.key_class = type(pkey)
+            self.private_key = buf.getvalue()
+        self._credentials = credentials
+        self._pkey = None
+        self.via = None
+        via = host.get_via()
+        if via is not None:
+            if specs is None:
+                specs = {}
+            if via not in specs:
+                specs[via] = HostSpec(via, specs)
+            self.via = specs[via]
+
+    def get_via(self):
+        return self.via
+
+    def key(self):
+        return (self.name, self.hostname, self.port, self._credentials.get('username'), self.via)
+
+    def __eq__(self, other):
+        # Specs sent separately for the same host, e.g. by successive
+        # requests to a daemon, must find the same pooled connection
+        return isinstance(other, HostSpec) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_pkey'] = None
+        return state
+
+    def credentials(self):
+        credentials = dict(self._credentials)
+        if self._pkey is None:
+            if self.private_key is not None:
+                self._pkey = self.key_class.from_private_key(io.StringIO(self.private_key))
+            elif self.agent_key is not None:
+                self._pkey = self._find_agent_key()
+        if self._pkey is not None:
+            credentials['pkey'] = self._pkey
+        return credentials
+
+    def _find_agent_key(self):
+        # One agent connection per process, shared by all specs
+        with HostSpec._agent_lock:
+            if HostSpec._agent is None:
+                HostSpec._agent = paramiko.Agent()
+        for key in HostSpec._agent.get_keys():
+            if key.asbytes() == self.agent_key:
+                return key
+        raise ValueError('Key not found in ssh-agent for ' + self.label)
+
+    def __str__(self):
+        return self.label
+
+def run_shard(specs, Handler, handler_args, handler_kwargs, group_options):
+    """ Worker process entry point for SSHGroup(processes=N) """
+    results = SSHGroup(specs, **group_options).run_handler(Handler, *handler_args, **handler_kwargs)
+    return [results.results[spec].portable() for spec in specs], results.concurrency
+
+class PoolRun():
+    """ State shared between an SSHGroup run and its worker threads """
+    def __init__(self, Handler, handler_args, handler_kwargs, events, stream=False):
+        self.Handler = Handler
+        self.handler_args = handler_args
+        self.handler_kwargs = handler_kwargs
+        self.events = events
+        self.stream = stream
+        self.pending = HostQueue()
+        self.stopped = threading.Event()
+        self.active = {}
+        self.lock = threading.Lock()
+        self.jump_pool = None
+        self.owns_jump_pool = False
+        self.limiter = None
+
+    def close(self):
+        if self.owns_jump_pool:
+            self.jump_pool.close_all()
+        if self.limiter is not None:
+            self.limiter.close()
+
+    def take_pending(self):
+        return self.pending.take_all()
+
+    def cancel_active(self, hosts):
+        with self.lock:
+            sessions = [self.active[host] for host in hosts if host in self.active]
+        for session in sessions:
+            session.cancel()
+
 class SSHGroup():
-    CYCLE_WAIT_TIME = .1
+    STREAM_QUEUE_SIZE = 1000
+    PUT_TIMEOUT = 1
 
-    def __init__(self, hosts, max_pool_size=10):
+    def __init__(self, hosts, max_pool_size=10, connection_pool=None, capture=None, max_channels=None, rollout=None,
+                 connect_timeout=None, command_timeout=None, deadline=None, quorum=None, stragglers='cancel',
+                 processes=None, health=None, include_unhealthy=False, retries=0, retry_backoff=0.5, adaptive=None,
+                 limits=None):
+        """ capture is a factory for the per-stream output captures from
+        pycloud.core.capture, e.g. functools.partial(HeadTailCapture, 4096,
+        4096). By default run_* keeps everything and stream_* nothing.
+        max_channels caps the concurrent channels of execute_many per host.
+        rollout (a Rollout) runs the hosts in batches, in order.
+
+        connect_timeout and command_timeout (seconds) apply to each host and
+        each command; deadline is for the whole run. Once the deadline passes,
+        or once the quorum ratio of hosts is done, the run returns: hosts
+        still running are cancelled and reported as timed out, hosts not
+        started as skipped. With stragglers='finish' a quorum run instead
+        leaves them running; run_* results list them as pending until they
+        complete in the background (see SSHGroupResult.wait).
+
+        processes=N shards run_* across N worker processes, each running
+        its own pool of max_pool_size threads, so paramiko's crypto is not
+        bound to one core. Handlers, their arguments and capture must be
+        picklable; connection pools, rollouts, quorums and limits are not
+        shared across processes and are not supported in this mode.
+
+        health (a pycloud.core.health.HealthCache) fails hosts known to be
+        down at once, unless include_unhealthy, and is saved after the run.
+        Connects that fail on the network are retried retries times with
+        exponential backoff starting at retry_backoff seconds.
+
+        adaptive (a pycloud.core.concurrency.AdaptiveConcurrency) replaces
+        the fixed max_pool_size: the run starts adaptive.ceiling threads
+        but lets only as many work as the current limit allows, which
+        grows while handshakes stay fast and shrinks on resets, connect
+        timeouts and rising handshake latency. run_* results record the
+        limit over time in SSHGroupResult.concurrency. With processes each
+        process adapts its own limit and the results record their sum.
+
+        limits (pycloud.core.concurrency.Limit) cap the hosts running at
+        once per environment, tag or other attribute, e.g. two in prod and
+        one database; the other workers carry on with hosts under no full
+        limit.
+        """
         self.hosts = hosts
+        self.adaptive = adaptive
+        self.limits = limits
+        if adaptive is not None:
+            max_pool_size = adaptive.ceiling
         self.pool_size = min(len(self.hosts), max_pool_size)
+        self.connection_pool = connection_pool
+        self.capture = capture
+        self.max_channels = max_channels
+        self.rollout = rollout
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.deadline = deadline
+        self.quorum = quorum
+        self.stragglers = stragglers
+        self.processes = processes
+        self.health = health
+        self.include_unhealthy = include_unhealthy
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        if processes and (connection_pool is not None or rollout is not None or quorum is not None or limits):
+            raise ValueError('processes cannot be combined with connection_pool, rollout, quorum or limits')
+        for limit in limits or []:
+            # Fail on a bad attribute name before any host runs
+            for host in hosts:
+                limit.values(host)
 
     def run_command(self, command, stop_on_error=True):
         return self.run_commands([command], stop_on_error=stop_on_error)
@@ -157,32 +1076,406 @@ class SSHGroup():
         return self.run_handler(BaseShellHandler, commands, stop_on_error=stop_on_error)
 
     def run_handler(self, Handler, *args, **kwargs):
+        if self.processes and self.processes > 1 and len(self.hosts) > 1:
+            return self._exec_processes(Handler, args, kwargs)
         return self._exec_pool(Handler, args, kwargs)
 
+    def push(self, local_path, remote_path, check='mtime', limit=None):
+        """ Copy a local file or directory to every host over SFTP.
+
+        Files whose remote copy already matches are skipped: check='mtime'
+        compares size and modification time, check='hash' the sha256, and
+        check=None copies everything. limit caps the bandwidth of the whole
+        push in bytes per second, shared by all hosts.
+        """
+        manifest = LocalManifest(local_path, hash=check == 'hash')
+        limiter = None
+        if limit:
+            limiter = BandwidthLimiter(limit)
+        return self.run_handler(PushHandler, manifest, remote_path, check=check, limiter=limiter)
+
+    def distribute(self, local_path, remote_path, fanout=3, forward_agent=True):
+        """ Copy one local file to every host through a relay tree.
+
+        We push the file to the first fanout hosts; each host that has a
+        verified copy then sends it over ssh to fanout more (see
+        RelayHandler), so the controller's uplink is used fanout times and
+        the time grows with log(hosts). Every copy is checked against the
+        file's sha256. A host whose relay fails gets a direct push instead
+        and carries on relaying to its own part of the tree.
+        """
+        children = fanout_tree(self.hosts, fanout)
+        manifest = LocalManifest(local_path, hash=True)
+        if manifest.is_dir:
+            raise ValueError('distribute sends a single file, not a directory')
+        local, remote_path = manifest.remote_paths(remote_path)[0]
+        pool = self.connection_pool
+        if pool is None:
+            pool = SSHConnectionPool()
+        results = SSHGroupResult()
+        outstanding = [0]
+        done = threading.Condition()
+
+        def run_session(host, handler):
+            session = SSHSession(host, handler, pool=pool, jump_pool=pool, connect_timeout=self.connect_timeout,
+                                 command_timeout=self.command_timeout, **self._health_options())
+            try:
+                return session.run()
+            except Exception as e:
+                return SSHResult(executed=False, error=e)
+
+        def deliver(host, parent):
+            result = None
+            if parent is not None:
+                relayed = run_session(parent, RelayHandler(host, remote_path, local.sha256, local.mode, forward_agent))
+                if relayed.success():
+                    action = 'Relayed from {}:'.format(parent)
+                    result = SSHResult(output=[TransferResult(remote_path, local.size, action=action)])
+            if result is None:
+                result = run_session(host, PushHandler(manifest, remote_path, check=None, verify=True))
+            results._add_result(host, result)
+            # Children of a host without the file fall back to us
+            sender = host if result.success() else None
+            for child in children[host]:
+                send(child, sender)
+            with done:
+                outstanding[0] -= 1
+                done.notify_all()
+
+        # Relays only wait on remote hosts, so every host may get a thread
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.hosts), 1))
+        def send(host, parent):
+            with done:
+                outstanding[0] += 1
+            executor.submit(deliver, host, parent)
+
+        try:
+            for host in children[None]:
+                send(host, None)
+            with done:
+                done.wait_for(lambda: outstanding[0] == 0)
+        finally:
+            executor.shutdown(wait=True)
+            if self.connection_pool is None:
+                pool.close_all()
+            self._save_health()
+        return results
+
+    def pull(self, remote_path, local_dir, compress=False, offset=0, length=None, tail=None,
+             max_transfers=None, limit=None):
+        """ Fetch a remote path or glob from every host into
+        local_dir/<host name>/, streaming each file to disk.
+
+        compress gzips the local copies. offset and length, or tail (the
+        last tail bytes), fetch only part of each file. max_transfers caps
+        the files in flight across all hosts and limit the bandwidth in
+        bytes per second.
+        """
+        slots = None
+        if max_transfers:
+            slots = TransferSlots(max_transfers)
+        limiter = None
+        if limit:
+            limiter = BandwidthLimiter(limit)
+        return self.run_handler(PullHandler, remote_path, local_dir, compress=compress, offset=offset,
+                                length=length, tail=tail, slots=slots, limiter=limiter)
+
+    def stream_command(self, command, stop_on_error=True):
+        return self.stream_commands([command], stop_on_error=stop_on_error)
+
+    def stream_commands(self, commands, stop_on_error=True):
+        return self.stream_handler(BaseShellHandler, commands, stop_on_error=stop_on_error)
+
+    def stream_handler(self, Handler, *args, **kwargs):
+        """ Run a handler, yielding output as it arrives.
+
+        Yields (host, 'stdout' | 'stderr', line) for every line a host prints
+        and finally (host, 'exit', SSHResult) once the host is done, or
+        (host, 'pending', None) for stragglers left running. Output is not
+        kept in the results unless the group has a capture, and a slow
+        consumer blocks the hosts rather than letting output pile up.
+        """
+        run = PoolRun(Handler, args, kwargs, queue.Queue(maxsize=self.STREAM_QUEUE_SIZE), stream=True)
+        return self._iter_pool(run)
+
+    def _put(self, run, event):
+        while not run.stopped.is_set():
+            try:
+                run.events.put(event, timeout=self.PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def _capture(self, stream):
+        if self.capture is not None:
+            return self.capture
+        if stream:
+            return DiscardCapture
+        return MemoryCapture
+
+    def _session(self, run, host):
+        listener = None
+        if run.stream:
+            listener = lambda host, name, line: self._put(run, (host, name, line))
+        return SSHSession(
+            host,
+            run.Handler(*run.handler_args, **run.handler_kwargs),
+            pool=self.connection_pool,
+            jump_pool=run.jump_pool,
+            listener=listener,
+            capture=self._capture(run.stream),
+            max_channels=self.max_channels,
+            connect_timeout=self.connect_timeout,
+            command_timeout=self.command_timeout,
+            **self._health_options()
+        )
+
+    def _health_options(self):
+        return {
+            'health': self.health,
+            'include_unhealthy': self.include_unhealthy,
+            'retries': self.retries,
+            'retry_backoff': self.retry_backoff,
+        }
+
+    def _save_health(self):
+        if self.health is not None:
+            self.health.save()
+
+    def _worker(self, run):
+        # Each worker serves hosts until it reads the stop marker (None), so
+        # the number of threads is fixed by the pool size, not the host count.
+        while not run.stopped.is_set():
+            token = None
+            if run.limiter is not None:
+                # With adaptive concurrency only limit of the workers run
+                token = run.limiter.acquire()
+                if token is None or run.stopped.is_set():
+                    return
+            host = run.pending.get()
+            if host is None:
+                if run.limiter is not None:
+                    run.limiter.release(token)
+                return
+            session = None
+            result = None
+            try:
+                # A Handler that fails to build fails its host, not the worker
+                session = self._session(run, host)
+                with run.lock:
+                    run.active[host] = session
+                result = session.run()
+            except Exception as e:
+                result = SSHResult(executed=False, error=e)
+            finally:
+                with run.lock:
+                    run.active.pop(host, None)
+                run.pending.done(host)
+                if run.limiter is not None:
+                    connected = session is not None and session.connect_attempts
+                    run.limiter.release(token, result if connected else None)
+            self._put(run, (host, 'exit', result))
+
+    def _time_left(self, deadline):
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def _iter_pool(self, run, on_straggler=None):
+        hosts = list(self.hosts)
+        deadline = None
+        if self.deadline is not None:
+            deadline = time.monotonic() + self.deadline
+        quorum = None
+        if self.quorum is not None:
+            quorum = math.ceil(self.quorum * len(hosts))
+        run.pending = HostQueue(self.limits)
+        if self.adaptive is not None:
+            run.limiter = self.adaptive
+            run.limiter.start()
+        # Hosts behind the same jump host share one connection to it
+        run.jump_pool = self.connection_pool
+        if run.jump_pool is None and any(host.get_via() is not None for host in hosts):
+            run.jump_pool = SSHConnectionPool()
+            run.owns_jump_pool = True
+
+        workers = []
+        for i in range(self.pool_size):
+            worker = threading.Thread(target=self._worker, args=(run,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        if self.rollout is None:
+            batches = [hosts]
+        else:
+            batches = list(self.rollout.batches(hosts))
+        done = 0
+        failures = 0
+        aborted = False
+        cut_off = False
+        handed_off = False
+        try:
+            for number, batch in enumerate(batches):
+                if aborted:
+                    for host in batch:
+                        yield (host, 'exit', SSHResult(executed=False, skipped=True))
+                    continue
+                if number and self.rollout.pause:
+                    # Never pause past the deadline
+                    pause = self.rollout.pause
+                    if deadline is not None:
+                        pause = min(pause, self._time_left(deadline))
+                    time.sleep(pause)
+                if deadline is not None and not self._time_left(deadline):
+                    # Out of time before the batch started: it and the rest are skipped
+                    aborted = True
+                    for host in batch:
+                        yield (host, 'exit', SSHResult(executed=False, skipped=True))
+                    continue
+                canary = number == 0 and bool(self.rollout and self.rollout.canary)
+                outstanding = collections.OrderedDict((host, True) for host in batch)
+                for host in batch:
+                    run.pending.put(host)
+
+                # Block on the event queue instead of polling the workers
+                while outstanding:
+                    try:
+                        event = run.events.get(timeout=self._time_left(deadline))
+                    except queue.Empty:
+                        aborted = cut_off = True
+                        for event in self._cut_off(run, outstanding, 'Deadline passed'):
+                            yield event
+                        break
+                    host, name, result = event
+                    if host not in outstanding:
+                        continue
+                    if name != 'exit':
+                        yield event
+                        continue
+                    del outstanding[host]
+                    done += 1
+                    failed = result.failed()
+                    if failed:
+                        failures += 1
+                    yield event
+
+                    if quorum is not None and done >= quorum and (outstanding or number + 1 < len(batches)):
+                        aborted = True
+                        if self.stragglers == 'finish':
+                            # Leave the stragglers, including any later
+                            # batches, to the workers and stop reporting
+                            for later in batches[number + 1:]:
+                                for host in later:
+                                    outstanding[host] = True
+                                    run.pending.put(host)
+                            for host in outstanding:
+                                yield (host, 'pending', None)
+                            handed_off = True
+                            self._finish_stragglers(run, workers, outstanding, on_straggler)
+                            return
+                        cut_off = True
+                        for event in self._cut_off(run, outstanding, 'Cancelled after quorum'):
+                            yield event
+                        break
+                    if aborted or self.rollout is None or not failed:
+                        continue
+                    if self.rollout.should_abort(failures, len(hosts), canary=canary):
+                        # Stop dispatching; whatever is still queued is skipped
+                        aborted = True
+                        for host in run.take_pending():
+                            del outstanding[host]
+                            yield (host, 'exit', SSHResult(executed=False, skipped=True))
+        finally:
+            if not handed_off:
+                # Also reached when a streaming consumer stops early; the
+                # workers drop their remaining events and exit after their
+                # current host.
+                run.stopped.set()
+                for worker in workers:
+                    run.pending.put(None)
+                run.close()
+                self._save_health()
+        if not cut_off:
+            for worker in workers:
+                worker.join()
+
+    def _cut_off(self, run, outstanding, reason):
+        """ Ends a run early: queued hosts are skipped, running ones cancelled """
+        run.stopped.set()
+        for host in run.take_pending():
+            del outstanding[host]
+            yield (host, 'exit', SSHResult(executed=False, skipped=True))
+        run.cancel_active(list(outstanding))
+        for host in list(outstanding):
+            del outstanding[host]
+            yield (host, 'exit', SSHResult(executed=False, error=SSHError(reason), timed_out=True))
+
+    def _finish_stragglers(self, run, workers, outstanding, on_straggler):
+        def collect():
+            while outstanding:
+                host, name, result = run.events.get()
+                if name == 'exit' and host in outstanding:
+                    del outstanding[host]
+                    if on_straggler is not None:
+                        on_straggler(host, result)
+            run.stopped.set()
+            for worker in workers:
+                run.pending.put(None)
+            run.close()
+            self._save_health()
+        collector = threading.Thread(target=collect)
+        collector.daemon = True
+        collector.start()
+
     def _exec_pool(self, Handler, handler_args, handler_kwargs):
-        queue = set(self.hosts)
-        threads = set() 
-        all_complete = set()
+        results = SSHGroupResult()
+        run = PoolRun(Handler, handler_args, handler_kwargs, queue.Queue())
+        for host, event, result in self._iter_pool(run, on_straggler=results._add_result):
+            if event == 'pending':
+                results._add_pending(host)
+            else:
+                results._add_result(host, result)
+        if self.adaptive is not None:
+            results.concurrency = list(self.adaptive.history)
+        return results
 
+    def _exec_processes(self, Handler, handler_args, handler_kwargs):
+        hosts = list(self.hosts)
+        shards = [hosts[i::self.processes] for i in range(min(self.processes, len(hosts)))]
+        group_options = {
+            'max_pool_size': self.pool_size,
+            'capture': self.capture,
+            'max_channels': self.max_channels,
+            'connect_timeout': self.connect_timeout,
+            'command_timeout': self.command_timeout,
+            'deadline': self.deadline,
+            'adaptive': self.adaptive,
+        }
+        group_options.update(self._health_options())
         results = SSHGroupResult()
-        while len(queue) > 0 or len(threads) > 0:
-            # Remove any complete/failed threads from our queue 
-            complete = []
-            for t in list(threads):
-                if not t.is_alive():
-                    complete.append(t)
-                    all_complete.add(t)
-            for t in complete:
-                results._add_result(t.host, t.result)
-                threads.remove(t)
-
-            # Spin up threads to match pool size
-            if len(queue) > 0:
-                to_make = self.pool_size - len(threads)
-                for i in range(to_make):
-                    host = queue.pop()
-                    new_thread = SSHSession(host, Handler(*handler_args, **handler_kwargs))
-                    threads.add(new_thread)
-                    new_thread.start()
-            time.sleep(self.CYCLE_WAIT_TIME)
+        histories = []
+        # Workers are spawned rather than forked: paramiko runs threads that
+        # a fork would copy mid-flight.
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as executor:
+            futures = {}
+            for shard in shards:
+                shared = {}
+                specs = [HostSpec(host, shared) for host in shard]
+                future = executor.submit(run_shard, specs, Handler, handler_args, handler_kwargs, group_options)
+                futures[future] = shard
+            for future in concurrent.futures.as_completed(futures):
+                shard = futures[future]
+                try:
+                    shard_results, history = future.result()
+                    if history:
+                        histories.append(history)
+                except Exception as e:
+                    error = SSHError('Worker process failed: ' + str(e))
+                    shard_results = [SSHResult(executed=False, error=error) for host in shard]
+                for host, result in zip(shard, shard_results):
+                    results._add_result(host, result)
+        if self.adaptive is not None:
+            results.concurrency = merge_histories(histories)
         return results
@@ -7,6 +7,9 @@ class PolicyShellHandler(BaseShellHandler):
     def shell(self, client):
         self.policy.enforce(client)
 
+    async def async_shell(self, client):
+        await client.run_sync(self.shell)
+
 class BasePolicyType():
     required_options = []
 
@@ -0,0 +1,246 @@
+""" Several SSH jobs in flight at once, sharing one connection budget.
+
+An SSHGroup runs one job and blocks until it is done. A JobScheduler is
+for long running controllers: jobs are submitted and run side by side on
+a fixed set of max_connections workers, each working on one host of some
+job at a time.
+
+    scheduler = JobScheduler(max_connections=100)
+    deploy = scheduler.submit(hosts, TaskShellHandler, task, weight=3, concurrency=20)
+    facts = scheduler.run_commands(hosts, ['uptime'], name='facts')
+    check = scheduler.run_commands(web, ['systemctl status nginx'], priority=10)
+    check.result()                  # or `await check`, check.done(), check.progress()
+    deploy.cancel()
+
+A free worker always serves the job of the highest priority that has
+hosts waiting, so an urgent command waits for one host of a long rollout
+to finish, not for the rollout. Jobs of the same priority share the
+workers in proportion to their weight; concurrency caps a single job.
+Cancelling a job skips its waiting hosts and kills its running commands.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import inspect
+import itertools
+import threading
+
+from .capture import MemoryCapture
+from .net import SSHSession, SSHResult, SSHGroupResult, SSHConnectionPool, BaseShellHandler
+
+class Job():
+    """ Handle of a submitted job """
+    def __init__(self, scheduler, number, name, hosts, handler, priority=0, weight=1, concurrency=None,
+                 session_options=None):
+        if weight <= 0:
+            raise ValueError('Job weight must be positive')
+        self.scheduler = scheduler
+        self.number = number
+        self.name = name or 'job-{}'.format(number)
+        # Results and running sessions are keyed by host, so each runs once
+        self.hosts = list(collections.OrderedDict.fromkeys(hosts))
+        self.handler = handler
+        self.priority = priority
+        self.weight = weight
+        self.concurrency = concurrency
+        self.session_options = session_options or {}
+        self.results = SSHGroupResult()
+        self.future = concurrent.futures.Future()
+        self.pending = collections.deque(self.hosts)
+        self.active = {}
+        self.reported = 0
+        self.cancelled = False
+
+    def __str__(self):
+        return '[Job {} ({}/{} hosts done)]'.format(self.name, *self.progress())
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """ The SSHGroupResult, waiting up to timeout seconds for the job to
+        finish (concurrent.futures.TimeoutError otherwise) """
+        return self.future.result(timeout)
+
+    def progress(self):
+        """ (hosts done, hosts) """
+        return self.reported, len(self.hosts)
+
+    def running(self):
+        return len(self.active)
+
+    def cancel(self):
+        self.scheduler._cancel(self)
+
+    def _can_start(self):
+        if self.cancelled or not self.pending:
+            return False
+        return self.concurrency is None or len(self.active) < self.concurrency
+
+    def _share(self):
+        """ The job's use of the workers, relative to its weight """
+        return (len(self.active) + 1) / self.weight
+
+# Set by the scheduler itself for every session
+SCHEDULER_SESSION_ARGS = ('self', 'host', 'handler', 'pool', 'jump_pool')
+
+def check_session_options(options):
+    allowed = set(inspect.signature(SSHSession.__init__).parameters) - set(SCHEDULER_SESSION_ARGS)
+    unknown = sorted(set(options) - allowed)
+    if unknown:
+        raise ValueError('Unknown session options: ' + ', '.join(unknown))
+
+class JobScheduler():
+    def __init__(self, max_connections=50, connection_pool=None, **session_options):
+        """ max_connections is the number of hosts worked on at once across
+        all jobs. session_options (capture, connect_timeout, health...) are
+        the SSHSession defaults for every job. """
+        self.max_connections = max_connections
+        self.connection_pool = connection_pool
+        # Hosts behind the same jump host share one connection to it
+        self.jump_pool = connection_pool or SSHConnectionPool()
+        check_session_options(session_options)
+        self.session_options = dict({'capture': MemoryCapture}, **session_options)
+        self.jobs = []
+        self.closed = False
+        self._numbers = itertools.count(1)
+        self._changed = threading.Condition()
+        self._workers = []
+        for i in range(max_connections):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, hosts, Handler, *args, priority=0, weight=1, concurrency=None, name=None, session_options=None,
+               **kwargs):
+        """ Queue Handler(*args, **kwargs) on every host; returns a Job.
+
+        Higher priority jobs are served first. Jobs of equal priority
+        share the workers by weight, and concurrency caps the hosts this
+        job works on at once. session_options override the scheduler's
+        SSHSession options for this job.
+        """
+        check_session_options(session_options or {})
+        options = dict(self.session_options, **(session_options or {}))
+        with self._changed:
+            if self.closed:
+                raise RuntimeError('Scheduler is shut down')
+            job = Job(self, next(self._numbers), name, hosts, (Handler, args, kwargs), priority=priority,
+                      weight=weight, concurrency=concurrency, session_options=options)
+            self.jobs.append(job)
+            finished = self._take_if_done(job)
+            self._changed.notify_all()
+        if finished:
+            self._finish(job)
+        return job
+
+    def run_command(self, hosts, command, stop_on_error=True, **job_options):
+        return self.run_commands(hosts, [command], stop_on_error=stop_on_error, **job_options)
+
+    def run_commands(self, hosts, commands, stop_on_error=True, **job_options):
+        return self.submit(hosts, BaseShellHandler, commands, stop_on_error=stop_on_error, **job_options)
+
+    def shutdown(self, wait=True, cancel=False):
+        """ Stop taking jobs. Queued hosts still run unless cancel. """
+        with self._changed:
+            self.closed = True
+            jobs = list(self.jobs)
+            self._changed.notify_all()
+        if cancel:
+            for job in jobs:
+                job.cancel()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+            if self.connection_pool is None:
+                self.jump_pool.close_all()
+
+    def _next(self):
+        """ The job a free worker should serve next, if any """
+        best = None
+        for job in self.jobs:
+            if not job._can_start():
+                continue
+            if best is None or job.priority > best.priority or (
+                    job.priority == best.priority and job._share() < best._share()):
+                best = job
+        return best
+
+    def _worker(self):
+        while True:
+            with self._changed:
+                # After shutdown, wait until no job has hosts queued
+                self._changed.wait_for(lambda: self._next() is not None or (self.closed and not self._queued()))
+                job = self._next()
+                if job is None:
+                    return
+                host = job.pending.popleft()
+                Handler, args, kwargs = job.handler
+                session = None
+                try:
+                    session = SSHSession(host, Handler(*args, **kwargs), pool=self.connection_pool,
+                                         jump_pool=self.jump_pool, **job.session_options)
+                except Exception as e:
+                    # Fails the host; the worker lives on for other jobs
+                    result = SSHResult(executed=False, error=e)
+                else:
+                    job.active[host] = session
+            if session is not None:
+                try:
+                    result = session.run()
+                except Exception as e:
+                    result = SSHResult(executed=False, error=e)
+            job.results._add_result(host, result)
+            with self._changed:
+                job.active.pop(host, None)
+                job.reported += 1
+                finished = self._take_if_done(job)
+                self._changed.notify_all()
+            if finished:
+                self._finish(job)
+
+    def _cancel(self, job):
+        with self._changed:
+            job.cancelled = True
+            skipped = list(job.pending)
+            job.pending.clear()
+            sessions = list(job.active.values())
+        for host in skipped:
+            job.results._add_result(host, SSHResult(executed=False, skipped=True))
+        for session in sessions:
+            session.cancel()
+        with self._changed:
+            job.reported += len(skipped)
+            finished = self._take_if_done(job)
+            self._changed.notify_all()
+        if finished:
+            self._finish(job)
+
+    def _queued(self):
+        return any(job.pending and not job.cancelled for job in self.jobs)
+
+    def _take_if_done(self, job):
+        """ Called with the lock held: removes job once all its hosts are
+        reported. If it returns True, call _finish after releasing the lock. """
+        # Until then a cancel is still reporting its skipped hosts
+        if job.reported < len(job.hosts) or job not in self.jobs:
+            return False
+        self.jobs.remove(job)
+        return True
+
+    def _finish(self, job):
+        # Saving and the future's callbacks must not hold up other workers
+        health = job.session_options.get('health')
+        if health is not None:
+            health.save()
+        job.future.set_result(job.results)
@@ -5,22 +5,52 @@ from Crypto.PublicKey import RSA
 from Crypto import Random
 
 import base64
+import hashlib
 import json
 import stat
 import os
 import io
+import threading
 from base64 import b64encode, b64decode
 
+_key_cache = {}
+_agent = None
+_agent_keys = None
+_key_lock = threading.Lock()
+
 def generate_secret_key(length=128):
     random = os.urandom(length)
     key = b64encode(random).decode('utf-8')
     return key
 
-def get_agent_keys():
-    agent = Agent()
-    keys = [KeyPair(_key=key) for key in agent.get_keys()]
-    agent.close()
-    return keys
+def get_agent_keys(refresh=False):
+    """ The ssh-agent's keys. The agent connection stays open, as agent
+    keys sign through it, and the keys are cached for the process. """
+    global _agent, _agent_keys
+    with _key_lock:
+        if _agent is None or refresh:
+            if _agent is not None:
+                _agent.close()
+            _agent = Agent()
+            _agent_keys = [KeyPair(_key=key) for key in _agent.get_keys()]
+        return _agent_keys
+
+def load_private_key(path, password=None):
+    """ Read and decrypt a private key file once per process """
+    path = os.path.abspath(os.path.expanduser(path))
+    cache_key = (path, os.stat(path).st_mtime, password)
+    with _key_lock:
+        key = _key_cache.get(cache_key)
+    if key is None:
+        key = RSAKey(filename=path, password=password)
+        with _key_lock:
+            key = _key_cache.setdefault(cache_key, key)
+    return key
+
+def fingerprint(key_blob):
+    """ OpenSSH style SHA256 fingerprint of a public key blob """
+    digest = base64.b64encode(hashlib.sha256(key_blob).digest()).decode('utf-8')
+    return 'SHA256:' + digest.rstrip('=')
 
 class KeyPair():
     KEY_SIZE = 4096
@@ -30,7 +60,7 @@ class KeyPair():
         if private_key:
             self._key = RSAKey(file_obj=io.StringIO(private_key))
         elif private_key_path:
-            self._key = RSAKey(filename=private_key_path, password=password)
+            self._key = load_private_key(private_key_path, password=password)
         elif pub_data:
             if pub_data.startswith(self.SSH_PUB_KEY_PREFIX):
                 pub_data = pub_data[len(self.SSH_PUB_KEY_PREFIX):]
@@ -56,6 +86,9 @@ class KeyPair():
     def as_paramiko(self):
         return self._key
 
+    def fingerprint(self):
+        return fingerprint(self._key.asbytes())
+
     def as_pycrypto(self):
         if self._key.can_sign():
             return RSA.importKey(self.private_key_str())
@@ -86,6 +119,62 @@ class KeyPair():
         if self._key.can_sign():
             self._key.write_private_key_file(path, password=password)
 
+class LazyKeyPair(KeyPair):
+    """ A KeyPair that is only read, and decrypted, on first use.
+
+    With agent=True the key comes from the ssh-agent: the one matching
+    fingerprint, or the agent's first key. fingerprint() avoids loading
+    the key when the fingerprint is configured or a .pub file sits next
+    to private_key_path; known_fingerprint() never loads it.
+    """
+    def __init__(self, private_key=None, private_key_path=None, pub_data=None, password=None, agent=False,
+                 fingerprint=None):
+        self.private_key = private_key
+        self.private_key_path = private_key_path
+        self.pub_data = pub_data
+        self.password = password
+        self.agent = agent
+        self._fingerprint = fingerprint
+        self._loaded = None
+
+    @property
+    def loaded(self):
+        return self._loaded is not None
+
+    @property
+    def _key(self):
+        if self._loaded is None:
+            self._loaded = self._load()
+        return self._loaded
+
+    def _load(self):
+        if self.agent:
+            keys = get_agent_keys()
+            for key in keys:
+                if self._fingerprint is None or key.fingerprint() == self._fingerprint:
+                    return key.as_paramiko()
+            raise ValueError('Key not found in ssh-agent: {}'.format(self._fingerprint or 'no keys loaded'))
+        key = KeyPair(private_key=self.private_key, private_key_path=self.private_key_path,
+                      pub_data=self.pub_data, password=self.password)
+        return key.as_paramiko()
+
+    def known_fingerprint(self):
+        """ The fingerprint if it is known without loading the key, else None """
+        if self._fingerprint is None:
+            public_path = self.private_key_path and os.path.expanduser(self.private_key_path) + '.pub'
+            if self._loaded is not None:
+                self._fingerprint = super(LazyKeyPair, self).fingerprint()
+            elif public_path and os.path.exists(public_path):
+                with open(public_path) as f:
+                    blob = f.read().split()[1]
+                self._fingerprint = fingerprint(b64decode(blob.encode('utf-8')))
+        return self._fingerprint
+
+    def fingerprint(self):
+        if self.known_fingerprint() is None:
+            self._fingerprint = super(LazyKeyPair, self).fingerprint()
+        return self._fingerprint
+
 class DecryptionError(ValueError):
     pass
 
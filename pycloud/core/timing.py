@@ -0,0 +1,65 @@
+""" Where the time of a run went, phase by phase.
+
+Sessions record how long each phase took on SSHResult.timings: dns, tcp,
+tunnel (through a jump host), kex, auth, and summed over the commands,
+exec (opening the channel and starting the command) and drain (reading
+its output until it exits). Connections reused from a pool have no
+connect phases.
+"""
+import math
+
+PHASES = ['dns', 'tcp', 'tunnel', 'kex', 'auth', 'exec', 'drain', 'total']
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+class TimingSummary():
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, results):
+        self.phases = {}
+        for host, result in results.items():
+            timings = dict(result.timings)
+            if result.duration is not None:
+                timings['total'] = result.duration
+            for phase, seconds in timings.items():
+                self.phases.setdefault(phase, []).append((seconds, host))
+        for samples in self.phases.values():
+            samples.sort(key=lambda sample: sample[0])
+        self.timings = {host: result.timings for host, result in results.items()}
+
+    def percentiles(self, phase):
+        """ {50: seconds, 95: seconds, 99: seconds} for a phase """
+        values = [seconds for seconds, host in self.phases.get(phase, [])]
+        return {p: percentile(values, p) for p in self.PERCENTILES}
+
+    def slowest(self, phase='total', count=5):
+        """ The count slowest (host, seconds) for a phase, slowest first """
+        return [(host, seconds) for seconds, host in reversed(self.phases.get(phase, [])[-count:])]
+
+    def display(self, count=5):
+        phases = [phase for phase in PHASES if phase in self.phases]
+        phases += sorted(phase for phase in self.phases if phase not in PHASES)
+        output = ['{:<8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('phase', 'hosts', 'p50', 'p95', 'p99', 'max')]
+        for phase in phases:
+            samples = self.phases[phase]
+            percentiles = self.percentiles(phase)
+            output.append('{:<8} {:>6} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>8.3f}s'.format(
+                phase, len(samples), percentiles[50], percentiles[95], percentiles[99], samples[-1][0]
+            ))
+        slowest = self.slowest(count=count)
+        if slowest:
+            output.append('Slowest hosts:')
+        for host, seconds in slowest:
+            timings = self.timings[host]
+            worst = max(timings, key=timings.get) if timings else None
+            detail = ' (mostly {}: {:.3f}s)'.format(worst, timings[worst]) if worst else ''
+            output.append('  {}: {:.3f}s{}'.format(host, seconds, detail))
+        return '\n'.join(output)
+
+    def __str__(self):
+        return self.display()
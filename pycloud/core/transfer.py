@@ -0,0 +1,390 @@
+import fnmatch
+import gzip
+import hashlib
+import os
+import posixpath
+import re
+import shlex
+import stat
+import threading
+import time
+
+class BandwidthLimiter():
+    """ Token bucket shared by every host of a transfer.
+
+    rate is in bytes per second for the whole job, so hosts split the
+    bandwidth between them instead of each getting the full rate. Pickled
+    into a worker process it becomes a new bucket with the same rate.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the bytes now and sleep off any debt, so concurrent
+            # hosts queue up behind each other rather than all waking at once
+            self.tokens -= size
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def __reduce__(self):
+        return (BandwidthLimiter, (self.rate,))
+
+class TransferSlots():
+    """ Caps the number of files in flight across all hosts of a job.
+    Pickled into a worker process it becomes a new cap of the same size. """
+    def __init__(self, count):
+        self.count = count
+        self.semaphore = threading.BoundedSemaphore(count)
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+    def __reduce__(self):
+        return (TransferSlots, (self.count,))
+
+class LocalFile():
+    def __init__(self, path, relpath, hash=False):
+        info = os.stat(path)
+        self.path = path
+        self.relpath = relpath
+        self.size = info.st_size
+        self.mtime = int(info.st_mtime)
+        self.mode = stat.S_IMODE(info.st_mode)
+        self.sha256 = None
+        if hash:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1048576), b''):
+                    digest.update(block)
+            self.sha256 = digest.hexdigest()
+
+class LocalManifest():
+    """ The files under local_path, read once for all hosts """
+    def __init__(self, local_path, hash=False):
+        self.local_path = local_path
+        self.is_dir = os.path.isdir(local_path)
+        self.files = []
+        if not self.is_dir:
+            self.files.append(LocalFile(local_path, os.path.basename(local_path), hash=hash))
+            return
+        for root, dirs, files in os.walk(local_path):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, local_path).replace(os.sep, '/')
+                self.files.append(LocalFile(path, relpath, hash=hash))
+
+    def remote_paths(self, remote_path):
+        """ Pairs each file with its remote path. Like cp, a single file
+        pushed to a path ending in / keeps its name. """
+        if not self.is_dir:
+            if remote_path.endswith('/'):
+                remote_path = posixpath.join(remote_path, self.files[0].relpath)
+            return [(self.files[0], remote_path)]
+        return [(local, posixpath.join(remote_path, local.relpath)) for local in self.files]
+
+class TransferResult():
+    """ Outcome of one file transfer. Unpacks like a CommandResult so
+    transfers show up in SSHResult and SSHGroupResult like commands do. """
+    def __init__(self, path, size, skipped=False, action='Pushed', error=None):
+        self.path = path
+        self.size = size
+        self.skipped = skipped
+        self.action = action
+        self.error = error
+        self.exit_code = 0 if error is None else 1
+
+    @property
+    def stdout(self):
+        if self.error is not None:
+            return ''
+        if self.skipped:
+            return 'Unchanged {}\n'.format(self.path)
+        return '{} {} ({} bytes)\n'.format(self.action, self.path, self.size)
+
+    @property
+    def stderr(self):
+        if self.error is None:
+            return ''
+        return '{}: {}\n'.format(self.path, self.error)
+
+    def __iter__(self):
+        return iter((self.exit_code, self.stdout, self.stderr))
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return 'TransferResult({!r}, {!r}, skipped={!r})'.format(self.path, self.size, self.skipped)
+
+class PushHandler():
+    """ Copies a LocalManifest to a host over SFTP.
+
+    check decides which files are skipped: 'mtime' when the remote size and
+    modification time match, 'hash' when the remote sha256 matches (the
+    manifest must have been built with hash=True), None never skips. With
+    verify (and a hashed manifest) every copied file is checked against its
+    sha256 on the host.
+    """
+    BLOCK_SIZE = 262144
+    TEMP_SUFFIX = '.pycloud-part'
+
+    def __init__(self, manifest, remote_path, check='mtime', limiter=None, verify=False):
+        self.manifest = manifest
+        self.remote_path = remote_path
+        self.check = check
+        self.limiter = limiter
+        self.verify = verify
+
+    def shell(self, client):
+        sftp = client.sftp()
+        files = self.manifest.remote_paths(self.remote_path)
+        hashes = {}
+        if self.check == 'hash':
+            hashes = self._remote_hashes(client, [remote for local, remote in files])
+        made = set()
+        for local, remote in files:
+            if self._unchanged(sftp, local, remote, hashes):
+                client.output.append(TransferResult(remote, local.size, skipped=True))
+                continue
+            self._makedirs(sftp, posixpath.dirname(remote), made)
+            self._upload(sftp, local, remote)
+            if self.verify and local.sha256 and not verify_checksum(client, remote, local.sha256):
+                client.output.append(TransferResult(remote, local.size, error='Checksum mismatch'))
+                continue
+            client.output.append(TransferResult(remote, local.size))
+
+    def _remote_hashes(self, client, paths):
+        cmd = 'sha256sum -- {} 2>/dev/null; true'.format(' '.join(shlex.quote(path) for path in paths))
+        exit_code, stdout, stderr = client.execute(cmd, record=False)
+        hashes = {}
+        for line in stdout.splitlines():
+            digest, _, path = line.partition('  ')
+            hashes[path] = digest
+        return hashes
+
+    def _unchanged(self, sftp, local, remote, hashes):
+        if self.check == 'hash':
+            return hashes.get(remote) == local.sha256
+        if self.check == 'mtime':
+            try:
+                info = sftp.stat(remote)
+            except IOError:
+                return False
+            return info.st_size == local.size and int(info.st_mtime) == local.mtime
+        return False
+
+    def _makedirs(self, sftp, path, made):
+        if not path or path in made:
+            return
+        try:
+            sftp.stat(path)
+        except IOError:
+            self._makedirs(sftp, posixpath.dirname(path), made)
+            sftp.mkdir(path)
+        made.add(path)
+
+    def _upload(self, sftp, local, remote):
+        # Write to a temp file and rename it over the target so a failed
+        # push never leaves a half-written file in place
+        temp = remote + self.TEMP_SUFFIX
+        with open(local.path, 'rb') as source:
+            with sftp.open(temp, 'wb') as target:
+                # Don't wait for each write's ack; close() collects them
+                target.set_pipelined(True)
+                for block in iter(lambda: source.read(self.BLOCK_SIZE), b''):
+                    if self.limiter is not None:
+                        self.limiter.consume(len(block))
+                    target.write(block)
+        sftp.chmod(temp, local.mode)
+        sftp.utime(temp, (local.mtime, local.mtime))
+        try:
+            sftp.posix_rename(temp, remote)
+        except IOError:
+            # Servers without the posix-rename extension
+            try:
+                sftp.remove(remote)
+            except IOError:
+                pass
+            sftp.rename(temp, remote)
+
+def verify_checksum(client, path, sha256):
+    exit_code, stdout, stderr = client.execute(checksum_command(path, sha256), record=False)
+    return exit_code == 0
+
+def checksum_command(path, sha256):
+    return "printf '%s\\n' {} | sha256sum -c --status".format(shlex.quote('{}  {}'.format(sha256, path)))
+
+def fanout_tree(hosts, fanout):
+    """ Maps each host, and None for the controller, to the hosts it sends
+    to: the controller seeds the first fanout hosts and every host after
+    that gets the file from the host fanout places up the tree. """
+    if fanout < 1:
+        raise ValueError('fanout must be at least 1, got {}'.format(fanout))
+    hosts = list(hosts)
+    children = {None: hosts[:fanout]}
+    for i, host in enumerate(hosts):
+        first = fanout * (i + 1)
+        children[host] = hosts[first:first + fanout]
+    return children
+
+class RelayHandler():
+    """ Runs on a host that already has remote_path and sends it on to
+    target over ssh. The target only keeps the copy if its sha256 matches.
+
+    The host connects to the target itself, so it needs to be able to
+    reach and log into it: through keys of its own, or our ssh-agent with
+    forward_agent.
+    """
+    RELAY_COMMAND = 'ssh -o BatchMode=yes -o StrictHostKeyChecking=accept-new -p {port} {login} {command} < {source}'
+    TEMP_SUFFIX = PushHandler.TEMP_SUFFIX
+
+    def __init__(self, target, remote_path, sha256, mode=0o644, forward_agent=True):
+        self.target = target
+        self.remote_path = remote_path
+        self.sha256 = sha256
+        self.mode = mode
+        self.forward_agent = forward_agent
+
+    def command(self):
+        temp = self.remote_path + self.TEMP_SUFFIX
+        steps = []
+        directory = posixpath.dirname(self.remote_path)
+        if directory:
+            steps.append('mkdir -p {}'.format(shlex.quote(directory)))
+        steps.extend([
+            'cat > {}'.format(shlex.quote(temp)),
+            checksum_command(temp, self.sha256),
+            'chmod {:o} {}'.format(self.mode, shlex.quote(temp)),
+            'mv {} {}'.format(shlex.quote(temp), shlex.quote(self.remote_path)),
+        ])
+        receive = ' && '.join(steps)
+        login = self.target.hostname
+        username = self.target.credentials().get('username')
+        if username:
+            login = '{}@{}'.format(username, login)
+        return self.RELAY_COMMAND.format(
+            port=self.target.port,
+            login=shlex.quote(login),
+            command=shlex.quote(receive),
+            source=shlex.quote(self.remote_path)
+        )
+
+    def shell(self, client):
+        forward_agent = self.forward_agent and 'SSH_AUTH_SOCK' in os.environ
+        client.execute(self.command(), forward_agent=forward_agent)
+
+class PullHandler():
+    """ Copies remote files from a host into local_dir/<host name>/<path>.
+
+    remote_path may contain shell-style wildcards in any component. Files
+    are streamed to disk in chunks, gzipped on the way with compress=True.
+    offset and length fetch a byte range; tail fetches only the last tail
+    bytes. slots (a TransferSlots) and limiter (a BandwidthLimiter) are
+    shared by all hosts of the pull.
+    """
+    CHUNK_SIZE = 32768
+    MAX_REQUESTS = 64
+    MAGIC = re.compile('[*?[]')
+
+    def __init__(self, remote_path, local_dir, compress=False, offset=0, length=None, tail=None,
+                 slots=None, limiter=None):
+        self.remote_path = remote_path
+        self.local_dir = local_dir
+        self.compress = compress
+        self.offset = offset or 0
+        self.length = length
+        self.tail = tail
+        self.slots = slots
+        self.limiter = limiter
+
+    def shell(self, client):
+        sftp = client.sftp()
+        files = self._expand(sftp, self.remote_path)
+        if not files:
+            client.output.append(TransferResult(self.remote_path, 0, action='Pulled', error='No such file'))
+            return
+        local_dir = os.path.abspath(self.local_dir)
+        host_dir = os.path.normpath(os.path.join(local_dir, str(client.host.name)))
+        for remote, size in files:
+            local = os.path.normpath(os.path.join(host_dir, remote.lstrip('/')))
+            # Remote paths with .. must not write outside the host's directory
+            if not local.startswith(host_dir + os.sep) or not host_dir.startswith(local_dir + os.sep):
+                client.output.append(TransferResult(remote, 0, action='Pulled', error='Outside of ' + host_dir))
+                continue
+            if self.compress:
+                local += '.gz'
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            if self.slots is not None:
+                with self.slots:
+                    written = self._download(sftp, remote, size, local)
+            else:
+                written = self._download(sftp, remote, size, local)
+            client.output.append(TransferResult(local, written, action='Pulled'))
+
+    def _expand(self, sftp, pattern):
+        """ The regular files matching pattern, with their sizes """
+        paths = ['/' if pattern.startswith('/') else '']
+        for part in pattern.split('/'):
+            if not part:
+                continue
+            if not self.MAGIC.search(part):
+                paths = [posixpath.join(base, part) for base in paths]
+                continue
+            matches = []
+            for base in paths:
+                try:
+                    names = sftp.listdir(base or '.')
+                except IOError:
+                    continue
+                matches.extend(posixpath.join(base, name) for name in sorted(fnmatch.filter(names, part)))
+            paths = matches
+        files = []
+        for path in paths:
+            try:
+                info = sftp.stat(path)
+            except IOError:
+                continue
+            if stat.S_ISREG(info.st_mode):
+                files.append((path, info.st_size))
+        return files
+
+    def _range(self, size):
+        start = self.offset
+        if self.tail is not None:
+            start = max(size - self.tail, 0)
+        end = size
+        if self.length is not None:
+            end = min(start + self.length, size)
+        return start, max(end, start)
+
+    def _download(self, sftp, remote, size, local):
+        start, end = self._range(size)
+        chunks = [(offset, min(self.CHUNK_SIZE, end - offset)) for offset in range(start, end, self.CHUNK_SIZE)]
+        opener = gzip.open if self.compress else open
+        written = 0
+        with sftp.open(remote, 'rb') as source:
+            with opener(local, 'wb') as target:
+                # readv keeps up to MAX_REQUESTS reads in flight, so we don't
+                # wait a round trip per chunk and memory stays bounded
+                for data in source.readv(chunks, max_concurrent_prefetch_requests=self.MAX_REQUESTS):
+                    if self.limiter is not None:
+                        self.limiter.consume(len(data))
+                    target.write(data)
+                    written += len(data)
+        return written
@@ -1,4 +1,5 @@
 import importlib
+import re
 
 def import_obj(path):
     parts = path.split('.')
@@ -16,3 +17,34 @@ def dumb_argparse(args):
             params[key] = value
     return params
     
+
+NUMBERED_NAME = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+def compact_names(names):
+    """ Folds numbered names into ranges, e.g. web1 web2 web3 web07 db
+    becomes db,web[1-3,07] """
+    numbered = {}
+    parts = []
+    for name in set(names):
+        match = NUMBERED_NAME.match(name)
+        if match is None:
+            parts.append((name, name))
+        else:
+            prefix, number, suffix = match.groups()
+            numbered.setdefault((prefix, suffix), []).append(number)
+    for (prefix, suffix), numbers in numbered.items():
+        numbers.sort(key=lambda number: (int(number), len(number)))
+        if len(numbers) == 1:
+            parts.append((prefix + numbers[0] + suffix, prefix + numbers[0] + suffix))
+            continue
+        runs = [[numbers[0], numbers[0]]]
+        for number in numbers[1:]:
+            last = runs[-1][1]
+            padded = number.startswith('0') or last.startswith('0')
+            if int(number) == int(last) + 1 and (len(number) == len(last) or not padded):
+                runs[-1][1] = number
+            else:
+                runs.append([number, number])
+        ranges = ','.join(start if start == end else start + '-' + end for start, end in runs)
+        parts.append((prefix + numbers[0] + suffix, '{}[{}]{}'.format(prefix, ranges, suffix)))
+    return ','.join(text for key, text in sorted(parts))
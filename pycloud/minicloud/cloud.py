@@ -1,5 +1,6 @@
 import json
 from pycloud.core.cloud import Environment, Host, Cloud
+from pycloud.core.health import HealthCache
 from pycloud.core.security import EncryptedJsonFile 
 
 class LocalCloud(Cloud):
@@ -12,6 +13,11 @@ class LocalCloud(Cloud):
         self._tasks = {name: self._load_task(task_data) for name, task_data in data.get('tasks', {}).items()}
         self._policies = {name: self._load_policy(policy_data) for name, policy_data in data.get('policies', {}).items()}
 
+    def _load_health(self):
+        # Kept next to the datasource, unencrypted: it only holds host names
+        path = self.config.get('health_cache') or self.config.get('datasource') + '.health'
+        return HealthCache(path)
+
     def __str__(self):
         return '[LocalCloud loaded from {}]'.format(self.config.get('datasource')) 
 
@@ -32,7 +38,11 @@ class LocalCloud(Cloud):
         return source
 
     def _dump_host(self, source):
-        data = {key: getattr(source, key) for key in ('hostname', 'name', 'tags', 'env', 'username', 'password')}
+        data = {key: getattr(source, key) for key in ('hostname', 'name', 'tags', 'env', 'username', 'password', 'port')}
+        if source.via is not None:
+            data['via'] = getattr(source.via, 'name', source.via)
+        if source.key is not None:
+            data['key'] = source.key
         return data
     def _dump_env(self, source):
         data = {key: getattr(source, key) for key in ()}
@@ -16,7 +16,8 @@ setup(
         'pycloud.web',
     ],
     install_requires=[
-        'paramiko',
+        'asyncssh>=2.12',
+        'paramiko>=3.3',
         'requests',
         'pyyaml',
         'quickconfig'
@@ -0,0 +1,144 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import paramiko
+
+from pycloud.core.asyncnet import AsyncSSHGroup, client_key
+from pycloud.core.cloud import Host
+from pycloud.core.security import KeyPair
+from tests.benchmark import Fleet, ThreadSampler, fleet_hosts
+from tests.net_tests import ManyHandler, fake_host
+from tests.sshserver import FakeSSHD
+
+class SyncHandler():
+    """ A handler without an async_shell """
+    def __init__(self, commands):
+        self.commands = commands
+
+    def shell(self, client):
+        for command in self.commands:
+            client.execute(command)
+
+class AsyncSSHGroupTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(8)]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_run_commands(self):
+        results = AsyncSSHGroup(self.hosts, max_concurrency=4).run_commands(['echo hello', 'exit 3', 'echo never'])
+        for result in results.results.values():
+            self.assertEqual([output.exit_code for output in result.output], [0, 3])
+            self.assertEqual(result.output[0].stdout, 'hello\n')
+
+    def test_execute_many(self):
+        commands = ['echo {}'.format(i) for i in range(5)]
+        results = AsyncSSHGroup(self.hosts[:2], max_channels=2).run_handler(ManyHandler, commands)
+        for result in results.results.values():
+            self.assertEqual([output.stdout for output in result.output], ['0\n', '1\n', '2\n', '3\n', '4\n'])
+
+    def test_sync_handlers_with_few_threads(self):
+        # More sync handlers than handler threads; hosts waiting for one
+        # must still be able to connect
+        group = AsyncSSHGroup(self.hosts, max_concurrency=4, max_blocking_threads=2)
+        runs = []
+        run = threading.Thread(target=lambda: runs.append(group.run_handler(SyncHandler, ['true'] * 3)))
+        run.daemon = True
+        run.start()
+        run.join(20)
+        self.assertFalse(run.is_alive(), 'Run hung')
+        results = runs[0].results
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result.success() for result in results.values()))
+
+    def test_timeouts(self):
+        # Accepts the connection but never sends a banner
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        slow = fake_host(mock.Mock(port=listener.getsockname()[1]), 'slow')
+        hosts = [slow] + self.hosts[:2]
+        started = time.monotonic()
+        try:
+            group = AsyncSSHGroup(hosts, connect_timeout=0.3, command_timeout=0.3)
+            results = group.run_commands(['echo first', 'sleep 5', 'echo never'])
+        finally:
+            listener.close()
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertEqual(str(results.results[slow]), 'Timed out: Connect timed out')
+        for host in self.hosts[:2]:
+            result = results.results[host]
+            self.assertEqual(str(result), 'Timed out: Command timed out after 0.3s')
+            self.assertEqual([output.stdout for output in result.output], ['first\n'])
+
+    def test_hosts_share_one_bastion_connection(self):
+        bastion = FakeSSHD()
+        try:
+            jump = fake_host(bastion, 'bastion')
+            hosts = [fake_host(self.server, 'web{}'.format(i), via=jump) for i in range(5)]
+            results = AsyncSSHGroup(hosts).run_command('echo tunneled')
+        finally:
+            bastion.close()
+        self.assertTrue(results.success())
+        for result in results.results.values():
+            self.assertEqual(result.output[0].stdout, 'tunneled\n')
+            self.assertIn('tunnel', result.timings)
+        self.assertEqual(bastion.connections, 1)
+
+    def test_key_files_converted_once(self):
+        pkey = paramiko.RSAKey.generate(1024)
+        host = Host('127.0.0.1', name='keyed', port=self.server.port, username='deploy', pkey=KeyPair(_key=pkey))
+        results = AsyncSSHGroup([host]).run_command('echo key')
+        self.assertEqual(results.results[host].output[0].stdout, 'key\n')
+        self.assertIs(client_key(pkey), client_key(pkey))
+
+    @unittest.skipUnless(shutil.which('ssh-agent') and shutil.which('ssh-add'), 'Needs ssh-agent')
+    def test_agent_keys(self):
+        directory = tempfile.mkdtemp()
+        socket_path = os.path.join(directory, 'agent.sock')
+        agent = subprocess.Popen(['ssh-agent', '-D', '-a', socket_path], stdout=subprocess.DEVNULL)
+        try:
+            key_path = os.path.join(directory, 'id_rsa')
+            paramiko.RSAKey.generate(1024).write_private_key_file(key_path)
+            for attempt in range(50):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.1)
+            env = dict(os.environ, SSH_AUTH_SOCK=socket_path)
+            subprocess.check_call(['ssh-add', key_path], env=env, stderr=subprocess.DEVNULL)
+            with mock.patch.dict(os.environ, {'SSH_AUTH_SOCK': socket_path}):
+                keys = paramiko.Agent()
+                host = Host('127.0.0.1', name='agent', port=self.server.port, username='deploy',
+                            pkey=KeyPair(_key=keys.get_keys()[0]))
+                results = AsyncSSHGroup([host]).run_command('echo agent')
+                keys.close()
+        finally:
+            agent.terminate()
+            agent.wait()
+            shutil.rmtree(directory)
+        self.assertTrue(results.success(), str(results.results[host]))
+        self.assertEqual(results.results[host].output[0].stdout, 'agent\n')
+
+    def test_thread_bound(self):
+        with Fleet(2, latency=0.2) as fleet:
+            hosts = fleet_hosts(fleet.ports, 60)
+            before = threading.active_count()
+            with ThreadSampler() as sampler:
+                results = AsyncSSHGroup(hosts, max_concurrency=60, max_blocking_threads=2).run_commands(['true'])
+        self.assertTrue(all(result.success() for result in results.results.values()))
+        # Sixty connections at once on the two executor threads, plus the
+        # sampler and the thread asyncio.run briefly starts to shut the
+        # executor down
+        self.assertLessEqual(sampler.peak, before + 2 + 1 + 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+""" Benchmarks SSHGroup and friends against a fake fleet on loopback.
+
+    python -m tests.benchmark --sizes 10 100 1000 5000 --latency 0.02
+    python -m tests.benchmark --save baseline.json
+    python -m tests.benchmark --baseline baseline.json --tolerance 0.25
+
+The fleet (see tests.sshserver.ServerProfile) runs in its own process and
+every case in a fresh one, so peak RSS and thread counts are the client's
+alone. Each case reports wall time, client CPU time per host, peak RSS
+and peak thread count. With --baseline the run fails when a case got
+slower or heavier than the tolerance allows, which makes it usable as a
+regression gate for scheduler and transport changes.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+
+SCENARIOS = ['commands', 'adaptive', 'handler', 'policy', 'task', 'async']
+COMMANDS = ['echo one', 'echo two']
+
+class BenchHandler():
+    """ Runs its commands on concurrent channels of one connection """
+    def __init__(self, commands):
+        self.commands = commands
+
+    def shell(self, client):
+        client.execute_many(self.commands)
+
+    async def async_shell(self, client):
+        await client.execute_many(self.commands)
+
+def serve_fleet(conn, endpoints, profile_options):
+    from tests.sshserver import FakeSSHD, ServerProfile
+    servers = [FakeSSHD(profile=ServerProfile(**profile_options)) for i in range(endpoints)]
+    conn.send([server.port for server in servers])
+    conn.recv()
+    for server in servers:
+        server.close()
+
+class Fleet():
+    """ FakeSSHD endpoints in a child process; hosts are spread over them """
+    def __init__(self, endpoints, **profile_options):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=serve_fleet, args=(child, endpoints, profile_options), daemon=True)
+        self.process.start()
+        self.ports = self.conn.recv()
+
+    def close(self):
+        self.conn.send('stop')
+        self.process.join(10)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ThreadSampler():
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+def run_scenario(scenario, hosts, pool_size):
+    from pycloud.core.net import SSHGroup
+    from pycloud.core.asyncnet import AsyncSSHGroup
+    from pycloud.core.concurrency import AdaptiveConcurrency
+    from pycloud.base.policies import Dir
+    from pycloud.base.tasks import BashTask
+    if scenario == 'commands':
+        return SSHGroup(hosts, max_pool_size=pool_size).run_commands(COMMANDS)
+    if scenario == 'adaptive':
+        return SSHGroup(hosts, adaptive=AdaptiveConcurrency(ceiling=pool_size)).run_commands(COMMANDS)
+    if scenario == 'handler':
+        return SSHGroup(hosts, max_pool_size=pool_size).run_handler(BenchHandler, COMMANDS)
+    if scenario == 'policy':
+        policy = Dir(options={'path': '/tmp/pycloud-bench'})
+        # Dir prints a line per host
+        with contextlib.redirect_stdout(io.StringIO()):
+            return SSHGroup(hosts, max_pool_size=pool_size).run_handler(policy.shell_handler(), policy)
+    if scenario == 'task':
+        return BashTask('bench', {'command': COMMANDS[0]}).run(hosts, max_pool_size=pool_size)
+    if scenario == 'async':
+        return AsyncSSHGroup(hosts, max_concurrency=pool_size).run_commands(COMMANDS)
+    raise ValueError('Unknown scenario: ' + scenario)
+
+def fleet_hosts(ports, count):
+    from pycloud.core.cloud import Host
+    return [
+        Host('127.0.0.1', name='host{:05d}'.format(i), port=ports[i % len(ports)], username='bench', password='x',
+             env='bench')
+        for i in range(count)
+    ]
+
+def run_case(scenario, size, ports, pool_size):
+    """ One benchmark case; runs in its own process """
+    hosts = fleet_hosts(ports, size)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    with ThreadSampler() as sampler:
+        results = run_scenario(scenario, hosts, pool_size)
+    wall = time.monotonic() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    failed = sum(1 for result in results.results.values() if not result.success())
+    return {
+        'scenario': scenario,
+        'hosts': size,
+        'wall': wall,
+        'wall_per_host': wall / size,
+        'cpu_per_host': cpu / size,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': after.ru_maxrss / 1024.0,
+        'peak_threads': sampler.peak,
+        'failed': failed,
+    }
+
+def run_benchmarks(scenarios, sizes, pool_size=50, endpoints=100, **profile_options):
+    cases = []
+    context = multiprocessing.get_context('spawn')
+    with Fleet(min(endpoints, max(sizes)), **profile_options) as fleet:
+        for scenario in scenarios:
+            for size in sizes:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    cases.append(executor.submit(run_case, scenario, size, fleet.ports, pool_size).result())
+    return cases
+
+def compare(cases, baseline, tolerance):
+    """ Regressions of cases against a saved baseline, as messages """
+    previous = {(case['scenario'], case['hosts']): case for case in baseline}
+    regressions = []
+    for case in cases:
+        old = previous.get((case['scenario'], case['hosts']))
+        if old is None:
+            continue
+        for metric in ('wall', 'cpu_per_host', 'peak_rss_mb', 'peak_threads'):
+            if old[metric] and case[metric] > old[metric] * (1 + tolerance):
+                regressions.append('{} x{}: {} {:.4g} -> {:.4g}'.format(
+                    case['scenario'], case['hosts'], metric, old[metric], case[metric]
+                ))
+    return regressions
+
+def display(cases):
+    output = ['{:<9} {:>6} {:>9} {:>12} {:>12} {:>9} {:>8} {:>7}'.format(
+        'scenario', 'hosts', 'wall', 'wall/host', 'cpu/host', 'rss', 'threads', 'failed'
+    )]
+    for case in cases:
+        output.append('{scenario:<9} {hosts:>6} {wall:>8.2f}s {ms_wall:>10.2f}ms {ms_cpu:>10.2f}ms {peak_rss_mb:>7.0f}MB '
+                      '{peak_threads:>8} {failed:>7}'.format(
+                          ms_wall=case['wall_per_host'] * 1000, ms_cpu=case['cpu_per_host'] * 1000, **case))
+    return '\n'.join(output)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pycloud against a fake SSH fleet')
+    parser.add_argument('--scenarios', nargs='*', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--sizes', nargs='*', type=int, default=[10, 100, 1000, 5000])
+    parser.add_argument('--pool-size', type=int, default=50)
+    parser.add_argument('--endpoints', type=int, default=100, help='Listening servers the hosts are spread over')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds before each command replies')
+    parser.add_argument('--handshake-delay', type=float, default=0, help='Seconds before each handshake starts')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Share of connections dropped')
+    parser.add_argument('--output-size', type=int, default=64, help='Bytes of output per command')
+    parser.add_argument('--save', default=None, help='Write the results as JSON')
+    parser.add_argument('--baseline', default=None, help='Fail on regressions against saved results')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    options = parser.parse_args(argv)
+
+    cases = run_benchmarks(
+        options.scenarios,
+        options.sizes,
+        pool_size=options.pool_size,
+        endpoints=options.endpoints,
+        latency=options.latency,
+        handshake_delay=options.handshake_delay,
+        failure_rate=options.failure_rate,
+        output_size=options.output_size,
+    )
+    print(display(cases))
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(cases, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(cases, json.load(f), options.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
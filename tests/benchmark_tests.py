@@ -0,0 +1,34 @@
+import unittest
+
+from pycloud.core.net import SSHGroup
+from tests.benchmark import run_benchmarks, compare, display, fleet_hosts
+from tests.sshserver import FakeSSHD, ServerProfile
+
+class BenchmarkTests(unittest.TestCase):
+    def test_small_run(self):
+        cases = run_benchmarks(['commands', 'task'], [5], pool_size=5, endpoints=2, output_size=100)
+        self.assertEqual([(case['scenario'], case['hosts']) for case in cases], [('commands', 5), ('task', 5)])
+        for case in cases:
+            self.assertEqual(case['failed'], 0)
+            self.assertGreater(case['peak_threads'], 1)
+        self.assertIn('commands', display(cases))
+
+    def test_compare_flags_regressions(self):
+        old = [{'scenario': 'commands', 'hosts': 10, 'wall': 1.0, 'cpu_per_host': 0.01, 'peak_rss_mb': 50, 'peak_threads': 20}]
+        new = [dict(old[0], wall=1.5)]
+        self.assertEqual(compare(old, old, 0.2), [])
+        self.assertEqual(len(compare(new, old, 0.2)), 1)
+
+    def test_server_profile(self):
+        server = FakeSSHD(profile=ServerProfile(output_size=70000, failure_rate=0.5, seed=1))
+        try:
+            results = SSHGroup(fleet_hosts([server.port], 10), max_pool_size=10).run_command('ignored')
+        finally:
+            server.close()
+        succeeded = [result for result in results.results.values() if result.success()]
+        self.assertTrue(0 < len(succeeded) < 10)
+        for result in succeeded:
+            self.assertEqual(len(result.output[0].stdout), 70000)
+
+if __name__ == '__main__':
+    unittest.main()
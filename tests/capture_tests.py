@@ -0,0 +1,61 @@
+import functools
+import pickle
+import unittest
+
+from pycloud.core.capture import MemoryCapture, DiscardCapture, HeadTailCapture, SpillCapture, StoredCapture
+from pycloud.core.net import SSHGroup
+from tests.net_tests import fake_host
+from tests.sshserver import FakeSSHD
+
+def fill(capture, data, chunk=7):
+    for i in range(0, len(data), chunk):
+        capture.write(data[i:i + chunk])
+    capture.close()
+    return capture
+
+class CaptureTests(unittest.TestCase):
+    def test_memory_and_discard(self):
+        data = bytes(range(256)) * 4
+        self.assertEqual(fill(MemoryCapture(), data).getvalue(), data)
+        discard = fill(DiscardCapture(), data)
+        self.assertEqual((discard.getvalue(), discard.size, discard.truncated), (b'', 1024, True))
+        self.assertFalse(fill(DiscardCapture(), b'').truncated)
+
+    def test_head_tail(self):
+        data = b''.join(b'%04d\n' % i for i in range(1000))
+        capture = fill(HeadTailCapture(head=10, tail=10), data)
+        self.assertTrue(capture.truncated)
+        self.assertEqual(capture.getvalue(), data[:10] + b'\n... [4980 bytes omitted] ...\n' + data[-10:])
+        small = fill(HeadTailCapture(head=10, tail=10), data[:15])
+        self.assertEqual((small.getvalue(), small.truncated), (data[:15], False))
+        self.assertEqual(fill(HeadTailCapture(head=5, tail=0), data).getvalue(), data[:5] + b'\n... [4995 bytes omitted] ...\n')
+
+    def test_spill(self):
+        data = b'x' * 5000
+        capture = fill(SpillCapture(threshold=1000), data)
+        self.assertTrue(capture.spilled)
+        self.assertEqual(capture.getvalue(), data)
+        self.assertFalse(fill(SpillCapture(threshold=1000), data[:10]).spilled)
+        # Sent to other processes as the bytes captured
+        stored = pickle.loads(pickle.dumps(capture))
+        self.assertIsInstance(stored, StoredCapture)
+        self.assertEqual((stored.getvalue(), stored.size), (data, 5000))
+
+class GroupCaptureTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.host = fake_host(self.server, 'host0')
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_group_capture(self):
+        capture = functools.partial(HeadTailCapture, 3, 3)
+        result = SSHGroup([self.host], capture=capture).run_command('seq 1 1000').results[self.host]
+        output = result.output[0]
+        self.assertTrue(output.stdout_capture.truncated)
+        self.assertEqual(output.stdout, '1\n2\n... [3887 bytes omitted] ...\n00\n')
+        self.assertEqual(output.exit_code, 0)
+
+if __name__ == '__main__':
+    unittest.main()
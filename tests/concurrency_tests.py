@@ -0,0 +1,178 @@
+import collections
+import threading
+import time
+import unittest
+
+from pycloud.core.cloud import Host
+from pycloud.core.concurrency import AdaptiveConcurrency, Limit, HostQueue, merge_histories
+from pycloud.core.net import SSHGroup, SSHResult, SSHError, NetworkError
+from tests.benchmark import fleet_hosts
+from tests.sshserver import FakeSSHD, ServerProfile
+
+def handshake(seconds):
+    return SSHResult(timings={'kex': seconds, 'auth': 0})
+
+class AdaptiveConcurrencyTests(unittest.TestCase):
+    def test_slow_start_then_additive_increase(self):
+        limiter = AdaptiveConcurrency(floor=2, ceiling=20)
+        for i in range(4):
+            limiter.release(limiter.acquire(), handshake(0.01))
+        self.assertEqual(int(limiter.limit), 6)
+        limiter.release(limiter.acquire(), SSHResult(executed=False, error=SSHError('Connection reset by peer')))
+        self.assertEqual(int(limiter.limit), 3)
+        # About one slot per limit hosts from here on
+        for i in range(4):
+            limiter.release(limiter.acquire(), handshake(0.01))
+        self.assertEqual(int(limiter.limit), 4)
+        self.assertEqual([size for seconds, size in limiter.history], [2, 3, 4, 5, 6, 3, 4])
+
+    def test_burst_of_failures_backs_off_once(self):
+        limiter = AdaptiveConcurrency(floor=2, initial=16, ceiling=20)
+        tokens = [limiter.acquire() for i in range(8)]
+        for token in tokens:
+            limiter.release(token, SSHResult(executed=False, error=NetworkError('Connect timed out'), timed_out=True))
+        self.assertEqual(int(limiter.limit), 8)
+
+    def test_rising_latency_and_bounds(self):
+        limiter = AdaptiveConcurrency(floor=4, ceiling=6)
+        for i in range(5):
+            limiter.release(limiter.acquire(), handshake(0.01))
+        self.assertEqual(int(limiter.limit), 6)
+        for i in range(10):
+            limiter.release(limiter.acquire(), handshake(1.0))
+        self.assertEqual(int(limiter.limit), 4)
+        # Down hosts say nothing about load
+        limiter.release(limiter.acquire(), SSHResult(executed=False, error=SSHError('Connection refused')))
+        limiter.release(limiter.acquire(), None)
+        self.assertEqual(int(limiter.limit), 4)
+
+    def test_acquire_waits_for_a_slot(self):
+        limiter = AdaptiveConcurrency(floor=1, ceiling=1)
+        token = limiter.acquire()
+        waiter = threading.Thread(target=limiter.acquire)
+        waiter.start()
+        waiter.join(0.1)
+        self.assertTrue(waiter.is_alive())
+        limiter.release(token)
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+        limiter.close()
+        self.assertIsNone(limiter.acquire())
+
+    def test_group_run(self):
+        server = FakeSSHD(profile=ServerProfile(latency=0.01))
+        try:
+            adaptive = AdaptiveConcurrency(floor=2, ceiling=8)
+            results = SSHGroup(fleet_hosts([server.port], 30), adaptive=adaptive).run_command('true')
+        finally:
+            server.close()
+        self.assertTrue(all(result.success() for result in results.results.values()))
+        self.assertEqual(results.concurrency[0], (0.0, 2))
+        self.assertGreater(max(size for seconds, size in results.concurrency), 2)
+
+    def test_merge_histories(self):
+        merged = merge_histories([[(0.0, 2), (0.5, 4), (2.0, 2)], [(0.0, 2), (1.0, 3)]])
+        self.assertEqual(merged, [(0.0, 4), (0.5, 6), (1.0, 7), (2.0, 5)])
+
+    def test_process_run(self):
+        server = FakeSSHD()
+        try:
+            adaptive = AdaptiveConcurrency(floor=2, ceiling=4)
+            results = SSHGroup(fleet_hosts([server.port], 12), adaptive=adaptive, processes=2).run_command('true')
+        finally:
+            server.close()
+        self.assertTrue(all(result.success() for result in results.results.values()))
+        # Both processes' limits, added up
+        self.assertEqual(results.concurrency[0], (0.0, 4))
+        self.assertGreater(max(size for seconds, size in results.concurrency), 4)
+
+class Tracker():
+    """ Handler counting the hosts running at once per env """
+    def __init__(self, running, peaks, lock):
+        self.running = running
+        self.peaks = peaks
+        self.lock = lock
+
+    def shell(self, client):
+        env = client.host.env
+        with self.lock:
+            self.running[env] += 1
+            self.peaks[env] = max(self.peaks[env], self.running[env])
+        time.sleep(0.05)
+        with self.lock:
+            self.running[env] -= 1
+
+class LimitTests(unittest.TestCase):
+    def test_queue_skips_throttled_hosts(self):
+        hosts = [Host('10.0.0.{}'.format(i), name='prod{}'.format(i), env='prod', tags=['web']) for i in range(3)]
+        hosts += [Host('10.0.1.{}'.format(i), name='dev{}'.format(i), env='dev', tags=['database']) for i in range(3)]
+        pending = HostQueue([Limit('env', limits={'prod': 1}), Limit('tags', limits={'database': 2})])
+        for host in hosts:
+            pending.put(host)
+        got = [pending.get(), pending.get(), pending.get()]
+        self.assertEqual([host.name for host in got], ['prod0', 'dev0', 'dev1'])
+        pending.put(None)
+        # Everything left is throttled
+        self.assertIsNone(pending.get())
+        pending.done(got[0])
+        self.assertEqual(pending.get().name, 'prod1')
+        self.assertEqual([host.name for host in pending.take_all()], ['prod2', 'dev2'])
+
+    def test_nested_limits(self):
+        hosts = [Host(str(i), env='prod', tags=['database'] if i < 2 else []) for i in range(4)]
+        pending = HostQueue([Limit('env', limits={'prod': 3}), Limit('tags', limits={'database': 1})])
+        for host in hosts:
+            pending.put(host)
+        self.assertEqual([pending.get().hostname for i in range(3)], ['0', '2', '3'])
+        pending.done(hosts[2])
+        # Prod has room, but not the database tag
+        pending.put(None)
+        self.assertIsNone(pending.get())
+        pending.done(hosts[0])
+        self.assertEqual(pending.get().hostname, '1')
+
+    def test_duplicate_host_frees_each_slot(self):
+        host = Host('10.0.0.1', env='prod')
+        other = Host('10.0.0.2', env='prod')
+        pending = HostQueue([Limit('env', limits={'prod': 2})])
+        for queued in (host, host, other):
+            pending.put(queued)
+        self.assertEqual([pending.get(), pending.get()], [host, host])
+        pending.done(host)
+        pending.done(host)
+        self.assertIs(pending.get(), other)
+        pending.put(host)
+        pending.put(None)
+        # other holds one of the two prod slots; a leaked one would fill them
+        self.assertIs(pending.get(), host)
+
+    def test_unknown_attribute_rejected(self):
+        hosts = [Host('10.0.0.1', tags=['database'])]
+        with self.assertRaises(ValueError):
+            SSHGroup(hosts, limits=[Limit('tag', limits={'database': 1})])
+        SSHGroup(hosts, limits=[Limit('tags', limits={'database': 1})])
+
+    def test_caps_below_one_rejected(self):
+        with self.assertRaises(ValueError):
+            Limit('env', limits={'prod': 0})
+        with self.assertRaises(ValueError):
+            Limit('rack', 0)
+        Limit('rack', 1, limits={'a1': 2})
+
+    def test_group_run(self):
+        server = FakeSSHD()
+        try:
+            hosts = fleet_hosts([server.port], 12)
+            for i, host in enumerate(hosts):
+                host.env = 'prod' if i < 6 else 'dev'
+            running, peaks = collections.Counter(), collections.Counter()
+            group = SSHGroup(hosts, max_pool_size=8, limits=[Limit('env', limits={'prod': 2})])
+            results = group.run_handler(Tracker, running, peaks, threading.Lock())
+        finally:
+            server.close()
+        self.assertTrue(all(result.success() for result in results.results.values()))
+        self.assertEqual(peaks['prod'], 2)
+        self.assertGreater(peaks['dev'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,4 +8,8 @@ from Crypto.PublicKey import RSA
 class KeyPairTests(unittest.TestCase):
     def test_keypair(self):
         keypair = KeyPair()
-        c_key = RSA.importKey(key.public_key_str())
+        c_key = RSA.importKey(keypair.public_key_str())
+        self.assertFalse(c_key.has_private())
+        ciphertext = PKCS1_OAEP.new(c_key).encrypt(b'secret')
+        private_key = RSA.importKey(keypair.private_key_str())
+        self.assertEqual(PKCS1_OAEP.new(private_key).decrypt(ciphertext), b'secret')
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from pycloud.core.daemon import MuxDaemon, DaemonClient, DaemonError
+from tests.net_tests import fake_host
+from tests.sshserver import FakeSSHD
+
+class MuxDaemonTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(3)]
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'mux.sock')
+        self.daemon = MuxDaemon(path, idle_timeout=60)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        self.client = DaemonClient(path)
+        for i in range(100):
+            if self.client.available():
+                break
+            self.thread.join(0.05)
+
+    def tearDown(self):
+        self.client.stop()
+        self.thread.join()
+        self.server.close()
+        os.rmdir(self.dir)
+
+    def test_connections_outlive_runs(self):
+        for i in range(3):
+            results = self.client.run_commands(self.hosts, ['echo $((20 + 22))'])
+            self.assertTrue(results.success())
+            self.assertEqual(set(results.results), set(self.hosts))
+            for result in results.results.values():
+                self.assertEqual(result.output[0].stdout, '42\n')
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.client.status()['connections'], 3)
+
+    def test_stream_commands(self):
+        events = list(self.client.stream_commands(self.hosts, ['echo one; echo two']))
+        lines = [(host.name, data) for host, name, data in events if name == 'stdout']
+        self.assertEqual(sorted(lines), sorted((host.name, line) for host in self.hosts for line in ('one', 'two')))
+        exits = [host for host, name, data in events if name == 'exit' and data.success()]
+        self.assertEqual(sorted(host.name for host in exits), ['host0', 'host1', 'host2'])
+
+    def test_errors_reach_the_client(self):
+        with self.assertRaisesRegex(DaemonError, 'TypeError'):
+            self.client.run_commands(self.hosts, ['true'], no_such_option=True)
+        # The daemon carries on
+        self.assertTrue(self.client.run_commands(self.hosts, ['true']).success())
+
+if __name__ == '__main__':
+    unittest.main()
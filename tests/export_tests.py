@@ -0,0 +1,62 @@
+import csv
+import io
+import json
+import unittest
+
+from pycloud.core.capture import StoredCapture
+from pycloud.core.cloud import Host
+from pycloud.core.net import SSHGroupResult, SSHResult, CommandResult, SSHError
+from pycloud.core.export import get_writer
+
+def command(exit_code, stdout='', stderr='', duration=0.5):
+    return CommandResult(exit_code, StoredCapture(stdout.encode()), StoredCapture(stderr.encode()), duration=duration)
+
+class ResultWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.web = Host('10.0.0.1', name='web1', env='prod')
+        self.db = Host('10.0.0.2', name='db1', env='prod')
+        self.web_result = SSHResult(output=[command(0, 'up\n'), command(1, stderr='oops\n')], duration=1.25)
+        self.db_result = SSHResult(executed=False, error=SSHError('Connection refused'), duration=0.1)
+
+    def test_jsonl(self):
+        fp = io.StringIO()
+        writer = get_writer('jsonl', fp)
+        writer.write(self.web, self.web_result)
+        writer.write(self.db, self.db_result)
+        web, db = [json.loads(line) for line in fp.getvalue().splitlines()]
+        self.assertEqual(web['host'], 'web1')
+        self.assertEqual(web['hostname'], '10.0.0.1')
+        self.assertEqual(web['env'], 'prod')
+        self.assertEqual(web['status'], 'Failed')
+        self.assertEqual(web['duration'], 1.25)
+        self.assertEqual([c['exit_code'] for c in web['commands']], [0, 1])
+        self.assertEqual(web['commands'][1]['stderr'], 'oops\n')
+        self.assertEqual(db['error'], 'Connection refused')
+        self.assertEqual(db['commands'], [])
+
+    def test_csv(self):
+        fp = io.StringIO()
+        writer = get_writer('csv', fp)
+        writer.write(self.web, self.web_result)
+        rows = list(csv.DictReader(io.StringIO(fp.getvalue())))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['exit_codes'], '0 1')
+        self.assertEqual(rows[0]['command_durations'], '0.500 0.500')
+        self.assertEqual(rows[0]['duration'], '1.250')
+        self.assertEqual(rows[0]['stdout'], 'up\n')
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            get_writer('xml', io.StringIO())
+
+    def test_rows_written_as_results_arrive(self):
+        fp = io.StringIO()
+        results = SSHGroupResult()
+        results._add_result(self.web, self.web_result)
+        results.add_writer(get_writer('jsonl', fp))
+        self.assertEqual(len(fp.getvalue().splitlines()), 1)
+        results._add_result(self.db, self.db_result)
+        self.assertEqual([json.loads(line)['host'] for line in fp.getvalue().splitlines()], ['web1', 'db1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+
+from pycloud.core.cloud import Cloud, Host
+from pycloud.core.inventory import Inventory, QueryError, parse_query
+
+def make_hosts():
+    return [
+        Host('10.0.0.1', name='web1', env='prod', tags=['ubuntu', 'web']),
+        Host('10.0.0.2', name='web2', env='staging', tags=['ubuntu', 'web']),
+        Host('10.0.0.3', name='db1', env='prod', tags=['centos', 'database']),
+        Host('10.0.0.4', name='db2', env='dev', tags='ubuntu,database'),
+        Host('10.0.1.5', name='worker1', env='dev'),
+    ]
+
+class ScanCounter(dict):
+    """ A hosts dict counting the times it is walked """
+    scans = 0
+
+    def _scan(self, items):
+        self.scans += 1
+        return items
+
+    def __iter__(self):
+        return self._scan(super(ScanCounter, self).__iter__())
+
+    def keys(self):
+        return self._scan(super(ScanCounter, self).keys())
+
+    def values(self):
+        return self._scan(super(ScanCounter, self).values())
+
+    def items(self):
+        return self._scan(super(ScanCounter, self).items())
+
+class InventoryTests(unittest.TestCase):
+    def setUp(self):
+        self.inventory = Inventory(make_hosts())
+
+    def names(self, query):
+        return [host.name for host in self.inventory.select(query)]
+
+    def test_terms(self):
+        self.assertEqual(self.names('env=prod'), ['db1', 'web1'])
+        self.assertEqual(self.names('tag=database'), ['db1', 'db2'])
+        self.assertEqual(self.names('name~web*'), ['web1', 'web2'])
+        self.assertEqual(self.names('web*'), ['web1', 'web2'])
+        self.assertEqual(self.names('name~w*1'), ['web1', 'worker1'])
+        self.assertEqual(self.names('name=db2'), ['db2'])
+        self.assertEqual(self.names('env~*d*'), ['db1', 'db2', 'web1', 'worker1'])
+        self.assertEqual(self.names('hostname~10.0.1.*'), ['worker1'])
+        self.assertEqual(self.names('tag=nothing'), [])
+
+    def test_boolean_queries(self):
+        self.assertEqual(self.names('tag=ubuntu and env!=prod or name~worker*'), ['db2', 'web2', 'worker1'])
+        self.assertEqual(self.names('tag=ubuntu and (env!=prod or name~worker*)'), ['db2', 'web2'])
+        self.assertEqual(self.names('not tag=ubuntu'), ['db1', 'worker1'])
+        self.assertEqual(self.names('env!=prod and not tag=web'), ['db2', 'worker1'])
+        self.assertEqual(self.names('name!~db* and tag="web"'), ['web1', 'web2'])
+        self.assertEqual(parse_query('tag=a and not env!=b'), ('and', [('tags', '=', 'a'), ('not', ('not', ('env', '=', 'b')))]))
+
+    def test_errors(self):
+        for query in ['', 'color=red', 'env=prod and', '(env=prod', 'env=prod)']:
+            self.assertRaises(QueryError, self.inventory.match, query)
+
+    def test_updates(self):
+        host = self.inventory.get('web1')
+        host.env = 'dev'
+        self.inventory.add(host)
+        self.assertEqual(self.names('env=prod'), ['db1'])
+        self.inventory.add(Host('10.0.0.9', name='web0', env='prod'))
+        self.assertEqual(self.names('web*'), ['web0', 'web1', 'web2'])
+        self.inventory.remove(self.inventory.get('db1'))
+        self.assertEqual(self.names('env=prod'), ['web0'])
+        self.assertNotIn('database', self.names('tag=database'))
+
+    def test_large_inventory(self):
+        hosts = [
+            Host('10.{}.{}.{}'.format(i >> 16, (i >> 8) & 255, i & 255), name='host{:06d}'.format(i),
+                 env='prod' if i % 10 else 'dev', tags=['rack{}'.format(i % 1000)])
+            for i in range(100000)
+        ]
+        inventory = Inventory(hosts)
+        inventory.hosts = ScanCounter(inventory.hosts)
+        names = inventory.match('tag=rack7 and env!=dev or name~host00001*')
+        self.assertEqual(len(names), 100 + 10)
+        # Answered from the indexes, without looking at every host
+        self.assertEqual(inventory.hosts.scans, 0)
+        inventory.match('hostname~10.0.0.*')
+        self.assertEqual(inventory.hosts.scans, 1)
+
+class CloudQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.cloud = Cloud(hosts={host.name: host for host in make_hosts()})
+
+    def test_filters(self):
+        names = lambda hosts: [host.name for host in hosts]
+        self.assertEqual(names(self.cloud.query({'tags': ['ubuntu', 'web']})), ['web1', 'web2'])
+        self.assertEqual(names(self.cloud.query({'tags': 'database', 'env': 'dev'})), ['db2'])
+        self.assertEqual(names(self.cloud.query({'name': 'w', 'env': None})), ['web1', 'web2', 'worker1'])
+        self.assertEqual(names(self.cloud.query({'query': 'tag=ubuntu', 'name': 'db'})), ['db2'])
+        self.assertEqual(names(self.cloud.search('env=prod')), ['db1', 'web1'])
+        self.assertEqual(self.cloud.query({'env': 'prod'}, single=True).name, 'db1')
+        self.assertIsNone(self.cloud.query({'env': 'qa'}, single=True))
+
+    def test_add_host(self):
+        self.cloud.query('env=prod')
+        self.cloud.add_host(Host('10.0.0.6', name='db3', env='prod'))
+        self.assertEqual([host.name for host in self.cloud.query('env=prod')], ['db1', 'db3', 'web1'])
+
+if __name__ == '__main__':
+    unittest.main()
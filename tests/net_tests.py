@@ -0,0 +1,716 @@
+import gzip
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from pycloud.core.capture import SpillCapture
+from pycloud.core.cloud import Host
+from pycloud.core.health import HealthCache
+from pycloud.core.net import SSHGroup, SSHSession, SSHConnectionPool, Rollout
+from pycloud.core.transfer import BandwidthLimiter, RelayHandler, fanout_tree
+from tests.sshserver import FakeSSHD, ServerProfile
+
+def fake_host(server, name, **kwargs):
+    return Host('127.0.0.1', name=name, port=server.port, password='x', **kwargs)
+
+class Recorder():
+    """ Handler noting which worker ran it and how many ran at once """
+    def __init__(self, state, fail=()):
+        self.state = state
+        self.fail = fail
+
+    def shell(self, client):
+        with self.state.lock:
+            self.state.threads.add(threading.get_ident())
+            self.state.running += 1
+            self.state.peak = max(self.state.peak, self.state.running)
+        time.sleep(0.05)
+        with self.state.lock:
+            self.state.running -= 1
+        if client.host.name in self.fail:
+            raise ValueError('Handler failed')
+        client.execute('true')
+
+class ManyHandler():
+    def __init__(self, commands):
+        self.commands = commands
+
+    def shell(self, client):
+        client.execute_many(self.commands)
+
+    async def async_shell(self, client):
+        await client.execute_many(self.commands)
+
+class Sleeper():
+    """ Handler sleeping on the remote host for a per host time """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def shell(self, client):
+        client.execute('sleep {}'.format(self.seconds.get(client.host.name, 0)))
+
+class WhereAmI():
+    """ Handler reporting the process it runs in """
+    def shell(self, client):
+        if client.host.name == 'host0':
+            raise LookupError('Handler failed')
+        client.execute('echo {}'.format(os.getpid()))
+
+class RecorderState():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.running = 0
+        self.peak = 0
+
+class SSHGroupTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_run_commands(self):
+        hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(3)]
+        results = SSHGroup(hosts).run_commands(['echo hello', 'echo oops >&2; exit 3'], stop_on_error=False)
+        self.assertTrue(all(result.executed for result in results.results.values()))
+        for result in results.results.values():
+            first, second = result.output
+            self.assertEqual(first.stdout, 'hello\n')
+            self.assertEqual(second.exit_code, 3)
+            self.assertEqual(second.stderr, 'oops\n')
+
+    def test_grouped_results(self):
+        hosts = [fake_host(self.server, 'web{}'.format(i)) for i in range(1, 5)]
+        hosts.append(fake_host(self.server, 'db1'))
+        results = SSHGroup(hosts).run_command('echo same')
+        odd = fake_host(self.server, 'web9')
+        results._add_result(odd, SSHGroup([odd]).run_command('echo different').results[odd])
+        groups = results.groups()
+        self.assertEqual([group.label for group in groups], ['db1,web[1-4]', 'web9'])
+        outputs = [result.output[0] for result in results.results.values()]
+        # Identical output is held once
+        self.assertEqual(len(set(id(output.stdout_capture) for output in outputs)), 2)
+        text = results.display(show_stdout=True, grouped=True)
+        self.assertEqual(text.count('same'), 1)
+        self.assertIn('db1,web[1-4] (5)', text)
+
+    def test_spilled_output_is_not_read(self):
+        hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(2)]
+        capture = lambda: SpillCapture(threshold=1024)
+        reads = []
+        getvalue = SpillCapture.getvalue
+        def spy(capture):
+            if capture.spilled:
+                reads.append(capture)
+            return getvalue(capture)
+        with mock.patch.object(SpillCapture, 'getvalue', spy):
+            results = SSHGroup(hosts, capture=capture).run_commands(['head -c 100000 /dev/zero', 'exit 2', 'true'])
+            for result in results.results.values():
+                self.assertEqual([output.exit_code for output in result.output], [0, 2])
+                self.assertTrue(result.output[0].stdout_capture.spilled)
+            self.assertEqual(reads, [])
+            self.assertEqual(len(results.results[hosts[0]].output[0].stdout_bytes), 100000)
+
+    def test_phase_timings(self):
+        hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(4)]
+        results = SSHGroup(hosts).run_commands(['true', 'true'])
+        for result in results.results.values():
+            self.assertEqual(set(result.timings), {'dns', 'tcp', 'kex', 'auth', 'exec', 'drain'})
+            self.assertLessEqual(sum(result.timings.values()), result.duration)
+            self.assertEqual(set(result.output[0].timings), {'exec', 'drain'})
+        summary = results.timings()
+        self.assertEqual(len(summary.phases['kex']), 4)
+        percentiles = summary.percentiles('total')
+        self.assertTrue(percentiles[50] <= percentiles[95] <= percentiles[99])
+        slowest = summary.slowest(count=2)
+        self.assertEqual(slowest[0][1], max(result.duration for result in results.results.values()))
+        self.assertIn('p99', summary.display())
+
+class DrainTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.host = fake_host(self.server, 'host0')
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_large_output_on_both_streams(self):
+        # Neither stream may stall the other once a channel window fills
+        command = 'head -c 3000000 /dev/zero & head -c 2000000 /dev/zero >&2; wait'
+        result = SSHGroup([self.host]).run_command(command).results[self.host]
+        output = result.output[0]
+        self.assertEqual(output.exit_code, 0)
+        self.assertEqual(len(output.stdout_bytes), 3000000)
+        self.assertEqual(len(output.stderr_bytes), 2000000)
+
+    def test_wakes_on_data_not_timeout(self):
+        started = time.monotonic()
+        with mock.patch.object(SSHSession, 'READY_TIMEOUT', 60):
+            results = SSHGroup([self.host]).run_commands(['echo a; sleep 0.1; echo b >&2; sleep 0.1; exit 4', 'true'],
+                                                         stop_on_error=False)
+        # Polling on READY_TIMEOUT would take minutes
+        self.assertLess(time.monotonic() - started, 30)
+        first, second = results.results[self.host].output
+        self.assertEqual((first.exit_code, first.stdout, first.stderr), (4, 'a\n', 'b\n'))
+        self.assertEqual(second.exit_code, 0)
+
+    def test_output_after_exit_status(self):
+        server = FakeSSHD(profile=ServerProfile(status_first=True))
+        try:
+            host = fake_host(server, 'late')
+            # The status doesn't wake the selector, so wake it often
+            with mock.patch.object(SSHSession, 'READY_TIMEOUT', 0.01):
+                result = SSHGroup([host]).run_command('echo late; echo err >&2; exit 2').results[host]
+        finally:
+            server.close()
+        output = result.output[0]
+        self.assertEqual((output.exit_code, output.stdout, output.stderr), (2, 'late\n', 'err\n'))
+
+class StreamTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(3)]
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp)
+
+    def test_lines_arrive_while_running(self):
+        # Each command waits for the test to have seen its first line
+        flag = os.path.join(self.tmp, 'seen')
+        command = 'echo one; while [ ! -e {} ]; do sleep 0.01; done; echo two'.format(flag)
+        events = []
+        for host, name, data in SSHGroup(self.hosts).stream_commands([command]):
+            events.append((host.name, name, data if name != 'exit' else str(data)))
+            if len([event for event in events if event[1] == 'stdout']) == len(self.hosts):
+                open(flag, 'w').close()
+        for host in self.hosts:
+            own = [event[1:] for event in events if event[0] == host.name]
+            self.assertEqual(own, [('stdout', 'one'), ('stdout', 'two'), ('exit', 'Success')])
+
+    def test_streams_and_partial_lines(self):
+        command = 'printf "a\\nb"; echo err >&2'
+        events = list(SSHGroup(self.hosts[:1]).stream_commands([command]))
+        lines = [(name, data) for host, name, data in events if name != 'exit']
+        self.assertEqual(sorted(lines), [('stderr', 'err'), ('stdout', 'a'), ('stdout', 'b')])
+        host, name, result = events[-1]
+        self.assertEqual(name, 'exit')
+        # Streamed output is not kept
+        self.assertEqual(result.output[0].stdout, '')
+
+class ExecuteManyTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.host = fake_host(self.server, 'host0')
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp)
+
+    def barrier(self, count):
+        # Each command finishes only once all of them have started
+        return ['touch {0}/{1}; while [ $(ls {0} | wc -l) -lt {2} ]; do sleep 0.01; done; echo {1}'.format(
+            self.tmp, i, count) for i in range(count)]
+
+    def test_commands_run_at_once(self):
+        group = SSHGroup([self.host])
+        result = group.run_handler(ManyHandler, self.barrier(5)).results[self.host]
+        self.assertTrue(result.success(), result.error)
+        self.assertEqual([output.stdout for output in result.output], ['0\n', '1\n', '2\n', '3\n', '4\n'])
+
+    def test_channel_limit(self):
+        # Each command prints how many were running when it started
+        command = 'touch {0}/$$; ls {0} | wc -l; sleep 0.1; rm {0}/$$'.format(self.tmp)
+        result = SSHGroup([self.host], max_channels=2).run_handler(ManyHandler, [command] * 6).results[self.host]
+        running = [int(output.stdout) for output in result.output]
+        self.assertEqual(len(running), 6)
+        self.assertLessEqual(max(running), 2)
+
+    def test_submit_reuses_channel_threads(self):
+        class SubmitHandler():
+            def shell(self, client):
+                client.execute_many(['echo 1', 'echo 2'])
+                threads = client._channel_threads
+                self.futures = [client.submit('echo {}'.format(i)) for i in range(3, 6)]
+                client.execute_many(['echo 6', 'echo 7'])
+                self.reused = client._channel_threads is threads
+
+        handler = SubmitHandler()
+        session = SSHSession(self.host, handler, max_channels=2)
+        result = session.run()
+        self.assertTrue(result.success(), result.error)
+        self.assertTrue(handler.reused)
+        self.assertEqual([future.result().stdout for future in handler.futures], ['3\n', '4\n', '5\n'])
+        # Submitted commands are not recorded
+        self.assertEqual([output.stdout for output in result.output], ['1\n', '2\n', '6\n', '7\n'])
+
+class WorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(12)]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_fixed_workers(self):
+        state = RecorderState()
+        results = SSHGroup(self.hosts, max_pool_size=3).run_handler(Recorder, state)
+        self.assertEqual(set(results.results), set(self.hosts))
+        self.assertTrue(all(result.success() for result in results.results.values()))
+        # Three threads take turns at the twelve hosts
+        self.assertEqual(state.peak, 3)
+        self.assertEqual(len(state.threads), 3)
+
+    def test_failing_handler_keeps_workers(self):
+        state = RecorderState()
+        results = SSHGroup(self.hosts, max_pool_size=2).run_handler(Recorder, state, fail=('host0', 'host1'))
+        failed = sorted(host.name for host, result in results.results.items() if not result.success())
+        self.assertEqual(failed, ['host0', 'host1'])
+        self.assertIsInstance(results.results[self.hosts[0]].error, ValueError)
+        self.assertEqual(len(results.results), 12)
+
+    def test_handler_failing_to_build_keeps_workers(self):
+        class Unbuildable():
+            def __init__(self):
+                raise ValueError('bad handler')
+
+        runs = []
+        run = threading.Thread(target=lambda: runs.append(SSHGroup(self.hosts, max_pool_size=2).run_handler(Unbuildable)))
+        run.daemon = True
+        run.start()
+        run.join(10)
+        self.assertFalse(run.is_alive(), 'Run hung')
+        results = runs[0].results
+        self.assertEqual(len(results), 12)
+        for result in results.values():
+            self.assertFalse(result.executed)
+            self.assertEqual(str(result.error), 'bad handler')
+
+    def test_empty_group(self):
+        self.assertEqual(SSHGroup([]).run_command('true').results, {})
+
+class ProcessTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(9)]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_shards_across_processes(self):
+        results = SSHGroup(self.hosts, max_pool_size=2, processes=2).run_handler(WhereAmI)
+        self.assertEqual(set(results.results), set(self.hosts))
+        # Errors that can't be pickled come back as SSHErrors
+        self.assertEqual(str(results.results[self.hosts[0]]), 'Error:Handler failed')
+        pids = set(results.results[host].output[0].stdout for host in self.hosts[1:])
+        self.assertEqual(len(pids), 2)
+        self.assertNotIn('{}\n'.format(os.getpid()), pids)
+
+    def test_unsupported_options(self):
+        self.assertRaises(ValueError, SSHGroup, self.hosts, processes=2, rollout=Rollout())
+        self.assertRaises(ValueError, SSHGroup, self.hosts, processes=2, quorum=0.5)
+
+class HealthTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'health.json')
+        # A port nothing listens on
+        listener = FakeSSHD()
+        self.dead = fake_host(listener, 'dead')
+        listener.close()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp)
+
+    def test_circuit_opens_and_persists(self):
+        health = HealthCache(self.path, failure_threshold=2)
+        alive = fake_host(self.server, 'alive')
+        for i in range(2):
+            results = SSHGroup([alive, self.dead], health=health).run_command('true')
+            self.assertTrue(results.results[alive].success())
+        self.assertEqual(health.unhealthy(), [health.key(self.dead)])
+        self.assertIsNotNone(health.get(alive).latency)
+
+        # Saved after each run, so a new cache skips the host
+        health = HealthCache(self.path, failure_threshold=2)
+        with mock.patch('socket.getaddrinfo') as connect:
+            result = SSHGroup([self.dead], health=health).run_command('true').results[self.dead]
+        connect.assert_not_called()
+        self.assertIn('unhealthy after 2 failed connects', str(result.error))
+
+        SSHGroup([self.dead], health=health, include_unhealthy=True).run_command('true')
+        self.assertEqual(health.get(self.dead).failures, 3)
+
+    def test_half_open_probe(self):
+        health = HealthCache(failure_threshold=1, reset_timeout=60)
+        health.record_failure(self.dead, 'refused')
+        self.assertFalse(health.allow(self.dead))
+        health.get(self.dead).last_failure -= 61
+        # Only one caller probes
+        self.assertTrue(health.allow(self.dead))
+        self.assertFalse(health.allow(self.dead))
+        health.record_failure(self.dead, 'refused')
+        # and each failed probe doubles the wait
+        health.get(self.dead).last_failure -= 61
+        self.assertFalse(health.allow(self.dead))
+        health.get(self.dead).last_failure -= 60
+        self.assertTrue(health.allow(self.dead))
+        health.record_success(self.dead)
+        self.assertTrue(health.allow(self.dead))
+        self.assertEqual(health.unhealthy(), [])
+
+    def test_retries_with_backoff(self):
+        health = HealthCache()
+        with mock.patch('socket.getaddrinfo', side_effect=ConnectionRefusedError) as connect:
+            result = SSHGroup([self.dead], health=health, retries=2, retry_backoff=0.01).run_command('true').results[self.dead]
+        self.assertEqual(connect.call_count, 3)
+        self.assertFalse(result.success())
+        # One run is one failure however often it retried
+        self.assertEqual(health.get(self.dead).failures, 1)
+
+class RolloutTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(10)]
+
+    def tearDown(self):
+        self.server.close()
+
+    def statuses(self, results):
+        return [str(results.results[host]) for host in self.hosts]
+
+    def test_batches(self):
+        sizes = lambda rollout, count: [len(batch) for batch in rollout.batches(range(count))]
+        self.assertEqual(sizes(Rollout(batch_size=3), 10), [3, 3, 3, 1])
+        self.assertEqual(sizes(Rollout(batch_size='25%', canary=1), 10), [1, 2, 2, 2, 2, 1])
+        self.assertEqual(sizes(Rollout(batch_size='1%', canary='10%'), 20), [2] + [1] * 18)
+        self.assertEqual(list(Rollout(batch_size=2).batches('abcde')), [['a', 'b'], ['c', 'd'], ['e']])
+
+    def test_batches_run_one_after_another(self):
+        state = RecorderState()
+        results = SSHGroup(self.hosts, max_pool_size=10, rollout=Rollout(batch_size=3)).run_handler(Recorder, state)
+        self.assertTrue(results.success())
+        self.assertEqual(state.peak, 3)
+
+    def test_canary_failure_stops_the_rollout(self):
+        rollout = Rollout(batch_size=3, canary=1)
+        results = SSHGroup(self.hosts, rollout=rollout).run_handler(Recorder, RecorderState(), fail=('host0',))
+        self.assertEqual(self.statuses(results), ['Error:Handler failed'] + ['Skipped'] * 9)
+
+    def test_failure_ratio(self):
+        # Two failures are allowed; the third stops dispatch after its batch
+        rollout = Rollout(batch_size=2, max_failure_ratio=0.2)
+        fail = ('host1', 'host2', 'host5')
+        results = SSHGroup(self.hosts, max_pool_size=2, rollout=rollout).run_handler(Recorder, RecorderState(), fail=fail)
+        statuses = self.statuses(results)
+        self.assertEqual(statuses[:6], ['Success', 'Error:Handler failed', 'Error:Handler failed', 'Success',
+                                        'Success', 'Error:Handler failed'])
+        self.assertEqual(statuses[6:], ['Skipped'] * 4)
+        self.assertEqual(len(results.skipped()), 4)
+
+class DeadlineTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(3)]
+
+    def tearDown(self):
+        self.server.close()
+
+    def statuses(self, results):
+        return [str(results.results[host]) for host in self.hosts]
+
+    def test_rollout_pause_stops_at_deadline(self):
+        started = time.monotonic()
+        results = SSHGroup(self.hosts, rollout=Rollout(pause=30), deadline=0.5).run_command('true')
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(self.statuses(results), ['Success', 'Skipped', 'Skipped'])
+
+    def test_command_timeout(self):
+        results = SSHGroup(self.hosts[:1], command_timeout=0.3).run_commands(['echo first', 'sleep 5', 'echo never'])
+        result = results.results[self.hosts[0]]
+        self.assertEqual(str(result), 'Timed out: Command timed out after 0.3s')
+        self.assertEqual([output.stdout for output in result.output], ['first\n'])
+        self.assertEqual(results.timed_out(), [self.hosts[0]])
+
+    def test_connect_timeout(self):
+        # Accepts the connection but never sends a banner
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        started = time.monotonic()
+        try:
+            slow = fake_host(mock.Mock(port=listener.getsockname()[1]), 'slow')
+            result = SSHGroup([slow], connect_timeout=0.3).run_command('true').results[slow]
+        finally:
+            listener.close()
+        self.assertFalse(result.executed)
+        self.assertLess(time.monotonic() - started, 3)
+
+    def test_deadline(self):
+        results = SSHGroup(self.hosts, max_pool_size=1, deadline=0.5).run_command('sleep 5')
+        self.assertEqual(self.statuses(results), ['Timed out: Deadline passed', 'Skipped', 'Skipped'])
+
+    def test_quorum_cancels_stragglers(self):
+        results = SSHGroup(self.hosts, quorum=0.6).run_handler(Sleeper, {'host2': 5})
+        self.assertEqual(self.statuses(results), ['Success', 'Success', 'Timed out: Cancelled after quorum'])
+
+    def test_quorum_leaves_stragglers_running(self):
+        results = SSHGroup(self.hosts, quorum=0.6, stragglers='finish').run_handler(Sleeper, {'host2': 0.5})
+        self.assertEqual(results.pending, {self.hosts[2]})
+        self.assertNotIn(self.hosts[2], results.results)
+        self.assertTrue(results.wait(5))
+        self.assertEqual(self.statuses(results), ['Success'] * 3)
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_reuses_connections(self):
+        host = fake_host(self.server, 'host')
+        with SSHConnectionPool() as pool:
+            group = SSHGroup([host], connection_pool=pool)
+            group.run_command('true')
+            client = pool._connections[host].client
+            self.assertTrue(group.run_command('echo again').results[host].success())
+            self.assertIs(pool._connections[host].client, client)
+            self.assertEqual(len(pool), 1)
+
+    def test_failed_connect_releases_host_lock(self):
+        pool = SSHConnectionPool()
+        def refuse(host):
+            raise ConnectionRefusedError('refused')
+        for i in range(3):
+            self.assertRaises(ConnectionRefusedError, pool.acquire, 'unreachable{}'.format(i), refuse)
+        self.assertEqual(pool._connecting, {})
+
+    def test_liveness_check_does_not_block_other_hosts(self):
+        pool = SSHConnectionPool()
+        stalled = mock.Mock()
+        pool.acquire('stalled', lambda host: stalled)
+        pool.release('stalled', stalled)
+        checking = threading.Event()
+        unblock = threading.Event()
+        def alive():
+            checking.set()
+            return unblock.wait(5)
+        pool._connections['stalled'].alive = alive
+        acquired = []
+        check = threading.Thread(target=lambda: acquired.append(pool.acquire('stalled', None)))
+        check.start()
+        self.assertTrue(checking.wait(5))
+        # Another host connects and releases while the check hangs
+        other = mock.Mock()
+        self.assertIs(pool.acquire('other', lambda host: other), other)
+        pool.release('other', other)
+        unblock.set()
+        check.join(5)
+        self.assertEqual(acquired, [stalled])
+        self.assertEqual(pool._connections['stalled'].users, 1)
+
+class JumpHostTests(unittest.TestCase):
+    def setUp(self):
+        self.bastion = FakeSSHD()
+        self.target = FakeSSHD()
+        self.jump = fake_host(self.bastion, 'bastion')
+
+    def tearDown(self):
+        self.bastion.close()
+        self.target.close()
+
+    def test_hosts_share_one_bastion_connection(self):
+        hosts = [fake_host(self.target, 'web{}'.format(i), via=self.jump) for i in range(5)]
+        results = SSHGroup(hosts, max_pool_size=5).run_command('echo tunneled')
+        self.assertTrue(results.success())
+        for result in results.results.values():
+            self.assertEqual(result.output[0].stdout, 'tunneled\n')
+            self.assertIn('tunnel', result.timings)
+            self.assertNotIn('dns', result.timings)
+        self.assertEqual(self.bastion.connections, 1)
+        self.assertEqual(self.target.connections, 5)
+
+    def test_connection_pool_keeps_bastion(self):
+        hosts = [fake_host(self.target, 'web{}'.format(i), via=self.jump) for i in range(3)]
+        with SSHConnectionPool() as pool:
+            for i in range(2):
+                results = SSHGroup(hosts, connection_pool=pool).run_command('true')
+                self.assertTrue(results.success())
+            self.assertEqual(len(pool), 4)
+        self.assertEqual(self.bastion.connections, 1)
+        self.assertEqual(self.target.connections, 3)
+
+class PushTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host')]
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.local, 'conf'))
+        with open(os.path.join(self.local, 'app.bin'), 'wb') as f:
+            f.write(os.urandom(300000))
+        with open(os.path.join(self.local, 'conf', 'app.ini'), 'w') as f:
+            f.write('[app]\n')
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+    def read(self, root, path):
+        with open(os.path.join(root, path), 'rb') as f:
+            return f.read()
+
+    def pushed(self, results):
+        result = results.results[self.hosts[0]]
+        return sorted(os.path.relpath(r.path, self.remote) for r in result.output if not r.skipped)
+
+    def test_push_directory_then_skip_unchanged(self):
+        target = os.path.join(self.remote, 'app')
+        results = SSHGroup(self.hosts).push(self.local, target)
+        self.assertTrue(results.success())
+        self.assertEqual(self.pushed(results), ['app/app.bin', 'app/conf/app.ini'])
+        for path in ('app.bin', 'conf/app.ini'):
+            self.assertEqual(self.read(self.local, path), self.read(target, path))
+
+        results = SSHGroup(self.hosts).push(self.local, target)
+        self.assertEqual(self.pushed(results), [])
+
+        with open(os.path.join(self.local, 'conf', 'app.ini'), 'a') as f:
+            f.write('debug = true\n')
+        results = SSHGroup(self.hosts).push(self.local, target)
+        self.assertEqual(self.pushed(results), ['app/conf/app.ini'])
+
+    def test_push_file_by_hash(self):
+        source = os.path.join(self.local, 'app.bin')
+        results = SSHGroup(self.hosts).push(source, self.remote + '/', check='hash')
+        self.assertEqual(self.pushed(results), ['app.bin'])
+        os.utime(source, (0, 0))
+        results = SSHGroup(self.hosts).push(source, self.remote + '/', check='hash')
+        self.assertEqual(self.pushed(results), [])
+
+    def test_bandwidth_limiter(self):
+        limiter = BandwidthLimiter(100000)
+        start = time.monotonic()
+        limiter.consume(100000)
+        limiter.consume(50000)
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+class PullTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = [fake_host(self.server, 'host{}'.format(i)) for i in range(2)]
+        self.remote = tempfile.mkdtemp()
+        self.local = tempfile.mkdtemp()
+        self.data = os.urandom(200000)
+        os.makedirs(os.path.join(self.remote, 'log'))
+        with open(os.path.join(self.remote, 'log', 'app.log'), 'wb') as f:
+            f.write(self.data)
+        with open(os.path.join(self.remote, 'log', 'empty.log'), 'wb') as f:
+            pass
+        with open(os.path.join(self.remote, 'log', 'notes.txt'), 'w') as f:
+            f.write('skip me\n')
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.remote)
+        shutil.rmtree(self.local)
+
+    def local_path(self, host, name):
+        return os.path.join(self.local, host.name, self.remote.lstrip('/'), 'log', name)
+
+    def test_pull_glob_into_host_dirs(self):
+        results = SSHGroup(self.hosts, max_pool_size=2).pull(self.remote + '/log/*.log', self.local, max_transfers=1)
+        self.assertTrue(results.success())
+        for host in self.hosts:
+            with open(self.local_path(host, 'app.log'), 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+            self.assertEqual(os.path.getsize(self.local_path(host, 'empty.log')), 0)
+            self.assertFalse(os.path.exists(self.local_path(host, 'notes.txt')))
+
+    def test_pull_tail_gzipped(self):
+        results = SSHGroup(self.hosts[:1]).pull(self.remote + '/log/app.log', self.local, compress=True, tail=1000)
+        self.assertTrue(results.success())
+        with gzip.open(self.local_path(self.hosts[0], 'app.log.gz')) as f:
+            self.assertEqual(f.read(), self.data[-1000:])
+
+    def test_pull_stays_in_host_dir(self):
+        escape = self.remote + '/log' + '/..' * 20 + self.remote + '/log/app.log'
+        results = SSHGroup(self.hosts[:1]).pull(escape, self.local)
+        self.assertFalse(results.success())
+        self.assertIn('Outside of', results.results[self.hosts[0]].output[0].stderr)
+        escaped = SSHGroup([fake_host(self.server, '..')]).pull(self.remote + '/log/app.log', self.local)
+        self.assertFalse(escaped.success())
+        self.assertEqual(os.listdir(self.local), [])
+
+    def test_pull_missing(self):
+        results = SSHGroup(self.hosts[:1]).pull(self.remote + '/nothing/*', self.local)
+        self.assertFalse(results.success())
+
+class DistributeTests(unittest.TestCase):
+    def setUp(self):
+        # One server per host, each with its own login directory; base/<port>
+        # lets the relay command below find a host's directory by its port
+        self.base = tempfile.mkdtemp()
+        self.servers = []
+        self.hosts = []
+        for i in range(7):
+            root = tempfile.mkdtemp(dir=self.base)
+            server = FakeSSHD(root=root)
+            os.symlink(root, os.path.join(self.base, str(server.port)))
+            self.servers.append(server)
+            self.hosts.append(fake_host(server, 'host{}'.format(i)))
+        self.source = os.path.join(self.base, 'image.bin')
+        self.data = os.urandom(100000)
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+        shutil.rmtree(self.base)
+
+    def assertDelivered(self, results):
+        self.assertTrue(results.success(), results.display(show_stdout=True, show_stderr=True))
+        for server in self.servers:
+            with open(os.path.join(server.root, 'images', 'image.bin'), 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+
+    def test_fanout_tree(self):
+        children = fanout_tree(range(7), 2)
+        self.assertEqual(children[None], [0, 1])
+        self.assertEqual(children[0], [2, 3])
+        self.assertEqual(children[1], [4, 5])
+        self.assertEqual(children[2], [6])
+        self.assertEqual(children[6], [])
+        self.assertRaises(ValueError, fanout_tree, range(7), 0)
+        self.assertRaises(ValueError, SSHGroup(self.hosts).distribute, self.source, 'images/', fanout=0)
+
+    def test_relays_through_tree(self):
+        relay = '(cd ' + self.base + '/{port} && sh -c {command}) < {source}'
+        with mock.patch.object(RelayHandler, 'RELAY_COMMAND', relay):
+            results = SSHGroup(self.hosts).distribute(self.source, 'images/', fanout=2)
+        self.assertDelivered(results)
+        relayed = [host for host, result in results.results.items() if result.output[0].action != 'Pushed']
+        self.assertEqual(sorted(host.name for host in relayed), ['host2', 'host3', 'host4', 'host5', 'host6'])
+        # Leaves are never contacted by the controller
+        self.assertEqual([server.connections for server in self.servers], [1, 1, 1, 0, 0, 0, 0])
+
+    def test_failed_relay_falls_back_to_push(self):
+        with mock.patch.object(RelayHandler, 'RELAY_COMMAND', 'false'):
+            results = SSHGroup(self.hosts).distribute(self.source, 'images/', fanout=2)
+        self.assertDelivered(results)
+
+if __name__ == '__main__':
+    unittest.main()
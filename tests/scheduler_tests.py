@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+from pycloud.core.health import HealthCache
+from pycloud.core.scheduler import JobScheduler
+from tests.benchmark import fleet_hosts
+from tests.sshserver import FakeSSHD
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class JobSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSSHD()
+        self.hosts = fleet_hosts([self.server.port], 12)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_urgent_job_jumps_the_queue(self):
+        with JobScheduler(max_connections=2) as scheduler:
+            rollout = scheduler.run_command(self.hosts, 'sleep 0.2', name='rollout')
+            time.sleep(0.05)
+            urgent = scheduler.run_command(self.hosts[:1], 'echo now', priority=10)
+            results = urgent.result(timeout=5)
+            self.assertFalse(rollout.done())
+            self.assertLess(rollout.progress()[0], 6)
+            self.assertEqual(results.results[self.hosts[0]].output[0].stdout, 'now\n')
+            self.assertTrue(all(result.success() for result in rollout.result(timeout=10).results.values()))
+
+    def test_weighted_share_and_concurrency(self):
+        with JobScheduler(max_connections=4) as scheduler:
+            heavy = scheduler.run_command(self.hosts, 'sleep 1', weight=3)
+            light = scheduler.run_command(self.hosts, 'sleep 1')
+            time.sleep(0.3)
+            self.assertEqual((heavy.running(), light.running()), (3, 1))
+            heavy.cancel()
+            heavy.result(timeout=5)
+            # The freed workers go to the other job
+            self.assertTrue(wait_until(lambda: light.running() == 4))
+            light.cancel()
+            light.result(timeout=5)
+
+            capped = scheduler.run_command(self.hosts, 'true', concurrency=1)
+            peak = 0
+            while not capped.done():
+                peak = max(peak, capped.running())
+                time.sleep(0.005)
+        self.assertEqual(peak, 1)
+        self.assertEqual(capped.progress(), (12, 12))
+
+    def test_duplicate_hosts_run_once(self):
+        with JobScheduler(max_connections=2) as scheduler:
+            job = scheduler.run_command([self.hosts[0], self.hosts[0], self.hosts[1]], 'echo once')
+            results = job.result(timeout=5)
+        self.assertEqual(job.progress(), (2, 2))
+        self.assertEqual(set(results.results), set(self.hosts[:2]))
+
+    def test_bad_handlers_keep_workers(self):
+        class Unbuildable():
+            def __init__(self):
+                raise ValueError('bad handler')
+
+        with JobScheduler(max_connections=2) as scheduler:
+            bad = [scheduler.submit(self.hosts[:2], Unbuildable) for i in range(3)]
+            good = scheduler.run_command(self.hosts[:2], 'echo fine')
+            for job in bad:
+                results = job.result(timeout=5)
+                self.assertEqual(set(str(result.error) for result in results.results.values()), {'bad handler'})
+            self.assertEqual(good.result(timeout=5).results[self.hosts[0]].output[0].stdout, 'fine\n')
+            self.assertRaises(ValueError, scheduler.run_command, self.hosts, 'true', session_options={'timeout': 1})
+            self.assertRaises(ValueError, scheduler.run_command, self.hosts, 'true', session_options={'pool': None})
+
+    def test_cancel(self):
+        scheduler = JobScheduler(max_connections=4)
+        job = scheduler.run_command(self.hosts, 'sleep 5')
+        time.sleep(0.3)
+        job.cancel()
+        results = job.result(timeout=5)
+        self.assertEqual(len(results.results), 12)
+        statuses = sorted(set(str(result) for result in results.results.values()))
+        self.assertEqual(statuses, ['Skipped', 'Timed out: Command cancelled'])
+        scheduler.shutdown()
+        self.assertRaises(RuntimeError, scheduler.run_command, self.hosts, 'true')
+
+    def test_await(self):
+        async def main(scheduler):
+            jobs = [scheduler.run_command(self.hosts[:3], 'echo {}'.format(i)) for i in range(3)]
+            return [await job for job in jobs]
+        with JobScheduler(max_connections=4) as scheduler:
+            results = asyncio.run(main(scheduler))
+        self.assertEqual([result.results[self.hosts[0]].output[0].stdout for result in results], ['0\n', '1\n', '2\n'])
+
+    def test_finishing_does_not_block_other_jobs(self):
+        health = HealthCache()
+        saving = threading.Event()
+        with mock.patch.object(health, 'save', side_effect=lambda: saving.wait(5)):
+            with JobScheduler(max_connections=2) as scheduler:
+                slow = scheduler.run_command(self.hosts[:1], 'true', session_options={'health': health})
+                self.assertTrue(wait_until(lambda: slow.progress()[0] == 1))
+                # Still saving the health cache; the other worker carries on
+                other = scheduler.run_command(self.hosts[1:3], 'true')
+                self.assertEqual(len(other.result(timeout=2).results), 2)
+                self.assertFalse(slow.done())
+                saving.set()
+                slow.result(timeout=5)
+
+if __name__ == '__main__':
+    unittest.main()
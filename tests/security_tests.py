@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import paramiko
+
+from pycloud.core.cloud import Cloud, Host
+from pycloud.core.security import LazyKeyPair, load_private_key
+
+class LazyKeyTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'default.key')
+        self.rsa = paramiko.RSAKey.generate(1024)
+        self.rsa.write_private_key_file(self.path, password='secret')
+        with open(self.path + '.pub', 'w') as f:
+            f.write('ssh-rsa {} test\n'.format(self.rsa.get_base64()))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_loads_on_first_use(self):
+        key = LazyKeyPair(private_key_path=self.path, password='secret')
+        self.assertFalse(key.loaded)
+        self.assertEqual(key.fingerprint(), self.rsa.fingerprint)
+        self.assertFalse(key.loaded)
+        self.assertEqual(key.as_paramiko().asbytes(), self.rsa.asbytes())
+        self.assertTrue(key.loaded)
+
+    def test_key_files_decrypted_once(self):
+        self.assertIs(load_private_key(self.path, 'secret'), load_private_key(self.path, 'secret'))
+
+    def test_cloud_keys_and_host_credentials(self):
+        cloud = Cloud(config={'secret_key': 'secret', 'keys': {'default': {'private_key_path': self.path}}})
+        self.assertFalse(cloud.key.loaded)
+        self.assertIs(cloud.get_key(self.rsa.fingerprint), cloud.key)
+        self.assertFalse(cloud.key.loaded)
+
+        other = paramiko.RSAKey.generate(1024)
+        other_path = os.path.join(self.dir, 'other.key')
+        other.write_private_key_file(other_path, password='secret')
+        cloud = Cloud(config={'secret_key': 'secret', 'keys': {
+            'default': {'private_key_path': self.path},
+            'other': {'private_key_path': other_path},
+        }})
+        self.assertIs(cloud.get_key(self.rsa.fingerprint), cloud.key)
+        self.assertFalse(cloud.keys['other'].loaded)
+        self.assertIs(cloud.get_key(other.fingerprint), cloud.keys['other'])
+        self.assertTrue(cloud.keys['other'].loaded)
+
+        host = Host('10.0.0.1', username='deploy', cloud=cloud, key=self.rsa.fingerprint)
+        credentials = host.credentials()
+        self.assertEqual(credentials['pkey'].asbytes(), self.rsa.asbytes())
+        self.assertIs(host.credentials(), credentials)
+        host.password = 'hunter2'
+        self.assertEqual(host.credentials(), {'username': 'deploy', 'password': 'hunter2'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+""" In-process SSH server for the network tests and benchmarks.
+
+Accepts any credentials, runs exec requests as local shell commands,
+serves SFTP from the local filesystem and forwards direct-tcpip channels,
+so it can also stand in for a jump host. A ServerProfile makes it behave
+like a slow or flaky fleet instead.
+"""
+import os
+import paramiko
+import random
+import socket
+import subprocess
+import threading
+import time
+
+HOST_KEY = paramiko.RSAKey.generate(2048)
+
+class ServerProfile():
+    """ Delays the handshake and each command's reply, drops a share of
+    connections right after accepting them, and with output_size set
+    answers every command with that many bytes instead of running it.
+    status_first sends each command's exit status before its output,
+    which SSH allows. """
+    def __init__(self, latency=0, handshake_delay=0, failure_rate=0, output_size=None, seed=None, status_first=False):
+        self.latency = latency
+        self.handshake_delay = handshake_delay
+        self.failure_rate = failure_rate
+        self.output_size = output_size
+        self.status_first = status_first
+        self.random = random.Random(seed)
+
+    def refuse(self):
+        return self.failure_rate and self.random.random() < self.failure_rate
+
+class FakeServer(paramiko.ServerInterface):
+    def __init__(self, root=None, profile=None):
+        self.root = root
+        self.profile = profile or ServerProfile()
+        self.tunnels = {}
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.tunnels[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self._exec, args=(channel, command), daemon=True).start()
+        return True
+
+    def _exec(self, channel, command):
+        if self.profile.latency:
+            time.sleep(self.profile.latency)
+        if self.profile.output_size is not None:
+            self._finish(channel, self._send_output(channel, self.profile.output_size))
+            return
+        if self.profile.status_first:
+            proc = subprocess.run(command, shell=True, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                channel.send_exit_status(proc.returncode)
+                # Let the status reach the client well ahead of the output
+                time.sleep(0.1)
+                channel.sendall(proc.stdout)
+                channel.sendall_stderr(proc.stderr)
+            except (OSError, EOFError):
+                return
+            self._finish(channel)
+            return
+        with subprocess.Popen(command, shell=True, cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+            err = threading.Thread(target=self._pump, args=(proc.stderr.read1, channel.sendall_stderr))
+            err.start()
+            self._pump(proc.stdout.read1, channel.sendall)
+            err.join()
+        self._finish(channel, proc.returncode)
+
+    def _send_output(self, channel, size):
+        chunk = b'x' * min(size, 32768)
+        try:
+            while size > 0:
+                channel.sendall(chunk[:size])
+                size -= len(chunk)
+        except (OSError, EOFError):
+            return 1
+        return 0
+
+    def _finish(self, channel, exit_status=None):
+        # The exec reply is only sent once check_channel_exec_request
+        # returns, so leave the close to the client to keep the ordering
+        try:
+            if exit_status is not None:
+                channel.send_exit_status(exit_status)
+            channel.shutdown_write()
+            channel.settimeout(30)
+            try:
+                channel.recv(1)
+            except socket.timeout:
+                pass
+            channel.close()
+        except (OSError, EOFError):
+            # The client hung up first
+            pass
+
+    def _pump(self, read, send):
+        while True:
+            try:
+                data = read(65536)
+                if not data:
+                    return
+                send(data)
+            except (OSError, EOFError):
+                return
+
+    def forward(self, transport):
+        # paramiko only keeps weak references to channels, so session
+        # channels taken off the accept queue must be held until closed
+        sessions = set()
+        while transport.is_active():
+            channel = transport.accept(1)
+            sessions = set(session for session in sessions if not session.closed)
+            if channel is None:
+                continue
+            if channel.get_id() not in self.tunnels:
+                sessions.add(channel)
+                continue
+            sock = socket.create_connection(self.tunnels.pop(channel.get_id()))
+            threading.Thread(target=self._relay, args=(channel, sock), daemon=True).start()
+
+    def _relay(self, channel, sock):
+        back = threading.Thread(target=self._pump, args=(sock.recv, channel.sendall), daemon=True)
+        back.start()
+        self._pump(channel.recv, sock.sendall)
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        back.join()
+        sock.close()
+        channel.close()
+
+class LocalSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return LocalSFTPServer.set_attributes(self.filename, attr)
+
+class LocalSFTPServer(paramiko.SFTPServerInterface):
+    """ Relative paths resolve against root, like a login directory """
+    FLAG_MODES = {os.O_WRONLY: 'wb', os.O_RDWR: 'r+b'}
+
+    def __init__(self, server, root=None):
+        super(LocalSFTPServer, self).__init__(server)
+        self.root = root
+
+    def _path(self, path):
+        if self.root is None:
+            return path
+        return os.path.join(self.root, path)
+
+    @staticmethod
+    def set_attributes(path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def _call(self, func, *args):
+        try:
+            func(*[self._path(arg) for arg in args])
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._path(path), flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        mode = 'rb'
+        if flags & os.O_APPEND:
+            mode = 'ab'
+        elif flags & (os.O_WRONLY | os.O_RDWR):
+            mode = self.FLAG_MODES[flags & (os.O_WRONLY | os.O_RDWR)]
+        f = os.fdopen(fd, mode)
+        handle = LocalSFTPHandle(flags)
+        handle.filename = self._path(path)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        try:
+            path = self._path(path)
+            return [paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)), name) for name in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, path, attr):
+        return self.set_attributes(self._path(path), attr)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._path(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.rename, oldpath, newpath)
+
+class FakeSSHD():
+    def __init__(self, root=None, profile=None):
+        self.root = root
+        self.profile = profile or ServerProfile()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            if self.profile.refuse():
+                conn.close()
+                continue
+            # Handshakes run on their own threads so a slow one doesn't
+            # hold up the connections queued behind it
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        if self.profile.handshake_delay:
+            time.sleep(self.profile.handshake_delay)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server = FakeServer(self.root, self.profile)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(HOST_KEY)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTPServer, self.root)
+        try:
+            transport.start_server(server=server)
+        except (OSError, EOFError, paramiko.SSHException):
+            return
+        server.forward(transport)
+
+    def close(self):
+        # close() alone doesn't wake a thread blocked in accept(), which
+        # could then take connections meant for a later server
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()